@@ -0,0 +1,241 @@
+from history import bounds
+from history import clip_spans
+from history import history_cache
+from history import power_coverage
+from history import split_spans
+import storage
+
+import numpy as np
+
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+# Number of grid buckets aggregates are resampled onto by default
+DEFAULT_POINTS = 500
+
+
+def grid_step(span_ns, points) -> int:
+    """
+    Width of grid buckets giving about points buckets over a span
+    Rounded up to a multiple of the widest rollup tier that fits, so rollup buckets nest in grid buckets
+
+    :param span_ns: Length of time range in nanoseconds
+    :param points: Number of buckets wanted
+    :return: step: Bucket width in nanoseconds
+    """
+    step = max(-(-span_ns // points), 1)
+
+    for width in reversed(storage.TIER_WIDTHS.values()):
+        if step >= width:
+            return -(-step // width) * width
+
+    return step
+
+
+def forward_fill(values, until, starts) -> np.ndarray:
+    """
+    Carry each known value forward over following unknown (NaN) values, as long as they start before
+    the time the known value is carried until
+
+    :param values: Values, NaN if unknown
+    :param until: Time each value is carried until, nanoseconds since epoch
+    :param starts: Start of each value, nanoseconds since epoch
+    :return: filled
+    """
+    known = ~np.isnan(values)
+    if np.all(known):
+        return values
+
+    indexes = np.arange(len(values))
+    last_known = np.maximum.accumulate(np.where(known, indexes, -1))
+    source = np.maximum(last_known, 0)
+
+    filled = values[source]
+    filled[~known & ((last_known < 0) | (starts >= until[source]))] = np.nan
+
+    return filled
+
+
+def _latest(until, indexes, times):
+    """
+    Raise the carried until time of grid buckets to the latest of the times falling in them
+
+    :param until: Carried until time per bucket, updated in place
+    :param indexes: Bucket of each time, ascending
+    :param times: Nanoseconds since epoch
+    """
+    if len(indexes) == 0:
+        return
+
+    starts = np.flatnonzero(np.diff(indexes, prepend=-1))
+    until[indexes[starts]] = np.maximum(until[indexes[starts]], np.maximum.reduceat(times, starts))
+
+
+def resample(device_history, grid_start, step, buckets, start_ns, end_ns, max_gap=None) -> tuple:
+    """
+    Mean power of a device in each grid bucket, weighted by the seconds each data point covers in it
+    Built from rollups of tiers nesting in the grid, raw data points are only read for the ragged edges
+
+    A device is assumed to hold its power until its next data point, if that arrives within
+    max_gap_intervals of the next data points interval (the same rule as history.integrate). Polling
+    intervals differ per device and a deadband stretch is closed by a data point whose interval spans it,
+    so slow and deadband devices are carried over their own gaps. Rollups keep no intervals, they are
+    carried for max_gap_intervals of the longest interval of the device in range
+
+    :param device_history: DeviceHistory
+    :param grid_start: Start of first bucket, nanoseconds since epoch, multiple of step
+    :param step: Bucket width in nanoseconds
+    :param buckets: Number of buckets
+    :param start_ns: Start of time range
+    :param end_ns: End of time range (exclusive)
+    :param max_gap: Seconds power is carried after each data point, overrides the intervals of data points
+    :return: power: Mean power per bucket, NaN where device has no data points,
+        until: Nanoseconds since epoch the power of each bucket is carried until
+    """
+    tiers = [tier for tier, width in reversed(storage.TIER_WIDTHS.items()) if step % width == 0]
+    max_gap_intervals = bia_config.get('max_gap_intervals', 2.5)
+
+    total = np.zeros(buckets)
+    covered = np.zeros(buckets)  # Seconds covered by data points with known power
+    until = np.full(buckets, np.iinfo(np.int64).min)
+
+    if max_gap is None:
+        intervals = device_history.between(start_ns, end_ns)['interval']
+        longest = float(np.max(intervals)) if len(intervals) else bia_config['time_interval']
+        rollup_gap = int(longest * max_gap_intervals * 1_000_000_000)
+    else:
+        rollup_gap = int(max_gap * 1_000_000_000)
+
+    for tier, piece_start, piece_end in device_history.plan(start_ns, end_ns, tiers):
+        if tier == 'raw':
+            # Time covered by data points, clipped to the piece, see history.power_coverage
+            cover_starts, cover_ends, power = power_coverage(device_history.around(piece_start, piece_end))
+            cover_starts, cover_ends, inside = clip_spans(cover_starts, cover_ends, piece_start, piece_end)
+            spans, cover_buckets, cover_starts, cover_ends = split_spans(cover_starts[inside], cover_ends[inside],
+                                                                         step, grid_start)
+            seconds = (cover_ends - cover_starts) / 1e9
+            indexes = (cover_buckets - grid_start) // step
+            total += np.bincount(indexes, weights=power[inside][spans] * seconds, minlength=buckets)
+            covered += np.bincount(indexes, weights=seconds, minlength=buckets)
+
+            records = device_history.between(piece_start, piece_end)
+            if len(records) == 0:
+                continue
+
+            known = ~np.isnan(records['power'])
+            timestamps = records['timestamp'].astype('int64')
+
+            if max_gap is None:
+                # Interval of the data point after each one, the last one in history uses its own
+                following = device_history.between(piece_end, np.iinfo(np.int64).max)[:1]['interval']
+                next_intervals = np.concatenate((records['interval'][1:],
+                                                 following if len(following) else records['interval'][-1:]))
+                gaps = (next_intervals.astype('f8') * max_gap_intervals * 1_000_000_000).astype('int64')
+            else:
+                gaps = rollup_gap
+
+            _latest(until, (timestamps[known] - grid_start) // step, (timestamps + gaps)[known])
+        else:
+            rollups = device_history.rollups(tier)
+            start_index, end_index = np.searchsorted(rollups['timestamp'], [piece_start, piece_end])
+            rollups = rollups[start_index:end_index]
+            rollups = rollups[rollups['count'] > 0]
+
+            indexes = (rollups['timestamp'] - grid_start) // step
+            total += np.bincount(indexes, weights=np.nan_to_num(rollups['mean']) * rollups['seconds'],
+                                 minlength=buckets)
+            covered += np.bincount(indexes, weights=rollups['seconds'], minlength=buckets)
+            _latest(until, indexes, rollups['timestamp'] + storage.TIER_WIDTHS[tier] + rollup_gap)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(covered > 0, total / covered, np.nan), until
+
+
+def fleet_statistics(device_ids,
+                     start_time=None,
+                     end_time=None,
+                     points=DEFAULT_POINTS,
+                     max_gap=None) -> dict:
+    """
+    Aggregate history of many devices
+    Each device is resampled onto a common time grid (devices capture at slightly different times),
+    a device is assumed to hold its last power between data points, see resample
+
+    :param device_ids: Devices to aggregate
+    :param start_time: Start time to filter data points, defaults to first data point of any device
+    :param end_time: End time to filter data points, defaults to last data point of any device
+    :param points: Number of grid buckets
+    :param max_gap: Seconds a devices power is carried forward, defaults to max_gap_intervals of each
+        devices own capture intervals
+
+    :return: statistics: Dictionary of
+        timestamps: Start of each grid bucket
+        step: Grid bucket width in seconds
+        power: Total fleet power per bucket
+        device_power: Device ID to power per bucket
+        energy: Total fleet energy in KiloWatt Hours
+        device_energy: Device ID to energy in KiloWatt Hours
+        share: Device ID to fraction of fleet energy
+        mean, peak: Mean and peak of total fleet power
+        peak_time: Start of bucket with peak power
+    """
+    device_ids = [str(device_id) for device_id in device_ids]
+    device_histories = {device_id: history_cache.get(device_id) for device_id in device_ids}
+    start_ns, end_ns = bounds(start_time, end_time)
+
+    # Open bounds are narrowed to the data captured, including rollups of expired data
+    extents = [device_history.extent() for device_history in device_histories.values()]
+    first = [extent[0] for extent in extents if extent[1]]
+    if first:
+        start_ns = max(start_ns, min(first))
+        end_ns = min(end_ns, max(extent[1] for extent in extents))
+
+    device_energy = {}
+    for device_id, device_history in device_histories.items():
+        device_energy[device_id] = device_history.statistics(start_time, end_time, names=('energy',))['energy']
+    energy = float(sum(device_energy.values()))
+
+    statistics = {
+        'timestamps': np.zeros(0, dtype='datetime64[ns]'),
+        'step': 0.0,
+        'power': np.zeros(0),
+        'device_power': {device_id: np.zeros(0) for device_id in device_ids},
+        'energy': energy,
+        'device_energy': device_energy,
+        'share': {device_id: device_energy[device_id] / energy if energy else None for device_id in device_ids},
+        'mean': None,
+        'peak': None,
+        'peak_time': None,
+    }
+
+    if not first or start_ns >= end_ns:
+        return statistics
+
+    step = grid_step(end_ns - start_ns, points)
+    grid_start = start_ns // step * step
+    buckets = int(-(-(end_ns - grid_start) // step))
+    starts = grid_start + step * np.arange(buckets)
+
+    device_power = np.full((len(device_ids), buckets), np.nan)
+    for row, device_history in enumerate(device_histories.values()):
+        power, until = resample(device_history, grid_start, step, buckets, start_ns, end_ns, max_gap)
+        device_power[row] = forward_fill(power, until, starts)
+
+    reporting = np.any(~np.isnan(device_power), axis=0)
+    power = np.where(reporting, np.nansum(device_power, axis=0), np.nan)
+
+    statistics['timestamps'] = starts.astype('datetime64[ns]')
+    statistics['step'] = step / 1_000_000_000
+    statistics['power'] = power
+    statistics['device_power'] = dict(zip(device_ids, device_power))
+
+    if np.any(reporting):
+        peak_index = int(np.nanargmax(power))
+        statistics['mean'] = float(np.nanmean(power))
+        statistics['peak'] = float(power[peak_index])
+        statistics['peak_time'] = storage.from_epoch_ns(grid_start + step * peak_index)
+
+    return statistics
@@ -0,0 +1,399 @@
+import storage
+
+import numpy as np
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Dataset sizes, (devices, samples per device)
+PRESETS = {
+    'small': (200, 10_000),
+    'medium': (100, 1_000_000),
+    'large': (10, 10_000_000),
+}
+
+DEFAULT_DATA_DIRECTORY = 'bench_data'
+MANIFEST_FILE = 'benchmark.json'
+
+# Generated devices capture every CAPTURE_INTERVAL seconds, with the odd stretch of capture stopped
+CAPTURE_INTERVAL = 10
+GAP_PROBABILITY = 1 / 50_000
+UNKNOWN_PROBABILITY = 0.001
+
+# Samples written per generation chunk, bounds memory used for large devices
+CHUNK_SAMPLES = 1_000_000
+
+# Relative change in time reported as a regression or improvement
+DEFAULT_TOLERANCE = 0.1
+
+
+def device_ids(devices) -> list:
+    """
+    IDs of generated devices
+
+    :param devices: Number of devices
+    :return: device_ids
+    """
+    return [f'bench-{number:04d}' for number in range(devices)]
+
+
+def synthetic_records(samples, start_ns, rng) -> np.ndarray:
+    """
+    Realistic capture records of a single device
+    Power follows a daily cycle around a device specific base load, switches between load levels
+    now and then and is noisy. Capture intervals jitter, some polls fail (unknown power) and
+    capture is occasionally stopped for a few hours
+
+    :param samples: Number of records
+    :param start_ns: Timestamp of first record, nanoseconds since epoch
+    :param rng: numpy random Generator
+    :return: records
+    """
+    steps = CAPTURE_INTERVAL + rng.normal(0, 0.2, samples)
+    gaps = rng.random(samples) < GAP_PROBABILITY
+    steps[gaps] += rng.uniform(3600, 6 * 3600, int(np.sum(gaps)))
+    timestamps = start_ns + (np.cumsum(steps) * 1_000_000_000).astype('int64')
+
+    seconds = (timestamps - timestamps[0]) / 1_000_000_000
+    base = rng.uniform(5, 300)
+    daily = 1 + 0.3 * np.sin(2 * np.pi * seconds / 86400 + rng.uniform(0, 2 * np.pi))
+
+    # Load level changes on average every few hours
+    switches = np.cumsum(rng.random(samples) < CAPTURE_INTERVAL / (4 * 3600))
+    levels = rng.choice([0.2, 1.0, 1.5], size=int(switches[-1]) + 1, p=[0.2, 0.6, 0.2])
+
+    power = base * daily * levels[switches] * (1 + rng.normal(0, 0.01, samples))
+    power[rng.random(samples) < UNKNOWN_PROBABILITY] = np.nan
+
+    intervals = np.full(samples, CAPTURE_INTERVAL, dtype='f4')
+    return storage.make_records(timestamps, power, intervals)
+
+
+def generate(directory, devices, samples, seed=0):
+    """
+    Generate synthetic device histories, including rollups, ending now
+    Skipped if directory already holds the same dataset. Only generated devices are replaced, a directory
+    holding other devices (e.g. the live data directory) is refused
+
+    :param directory: Data directory to generate into
+    :param devices: Number of devices
+    :param samples: Samples per device
+    :param seed: Random seed
+    :raises ValueError: If directory holds devices that were not generated
+    """
+    from rollups import rebuild
+
+    # Regenerated if the rollup record layout changed since
+    dataset = {'devices': devices, 'samples': samples, 'seed': seed, 'rollup_bytes': storage.ROLLUP_DTYPE.itemsize}
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            if json.load(manifest_file) == dataset:
+                return
+
+    storage.DATA_DIRECTORY = directory
+    foreign = [device_id for device_id in storage.list_series() if not device_id.startswith('bench-')]
+    if foreign:
+        raise ValueError(f"{directory} holds devices not generated by the benchmark ({', '.join(foreign[:5])}), "
+                         f"use another --data directory")
+
+    for stale_device in storage.list_series():
+        storage.delete_series(stale_device)
+    os.makedirs(directory, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    span_ns = samples * CAPTURE_INTERVAL * 1_000_000_000
+    start_ns = storage.to_epoch_ns(datetime.datetime.now()) - span_ns
+
+    for device_id in device_ids(devices):
+        written = 0
+        next_ns = start_ns + int(rng.uniform(0, CAPTURE_INTERVAL) * 1_000_000_000)
+        while written < samples:
+            records = synthetic_records(min(CHUNK_SAMPLES, samples - written), next_ns, rng)
+            storage.append_records(device_id, records)
+            written += len(records)
+            next_ns = int(records['timestamp'][-1]) + CAPTURE_INTERVAL * 1_000_000_000
+
+        rebuild(device_id)
+
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(dataset, manifest_file)
+
+
+def measure(function, repeat, items=None, setup=None) -> dict:
+    """
+    Time a function
+
+    :param function: Function to time, called without arguments
+    :param repeat: Number of timed calls
+    :param items: Items processed per call, throughput is reported if given
+    :param setup: Function called before each timed call, not timed
+    :return: result: Dictionary of median, min and max seconds, repeat, items and items per second
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    result = {
+        'median': float(np.median(times)),
+        'min': min(times),
+        'max': max(times),
+        'repeat': repeat,
+    }
+    if items is not None:
+        result['items'] = items
+        result['throughput'] = items / result['median'] if result['median'] else None
+
+    return result
+
+
+def run_benchmarks(directory, repeat=5, points=1_000_000, writes=10_000, windows=100, seed=0) -> dict:
+    """
+    Time the data path hot paths against a generated dataset
+
+    :param directory: Data directory of generated dataset
+    :param repeat: Timed calls per benchmark
+    :param points: Data points read by get_all_data_points
+    :param writes: Data points written by write_data_point
+    :param windows: Random time windows per range query benchmark
+    :param seed: Random seed of query windows
+    :return: results: Dictionary of benchmark name to measure result
+    """
+    storage.DATA_DIRECTORY = directory
+
+    from aggregate import fleet_statistics
+    from capture import deadband_filter, write_data_point
+    from graphs import render_usage_graph
+    from history import DeviceHistory, HistoryCache, get_all_data_points
+    from rollups import rollup_writer
+    import history
+
+    all_devices = [device_id for device_id in storage.list_series() if device_id.startswith('bench-')]
+    device_id = all_devices[0]
+    device_history = DeviceHistory(device_id)
+
+    # Random one day windows within the first devices history
+    rng = np.random.default_rng(seed)
+    first_ns, end_ns = device_history.extent()
+    window_ns = 86400 * 1_000_000_000
+    window_starts = rng.integers(first_ns, max(end_ns - window_ns, first_ns + 1), windows)
+    query_windows = [(storage.from_epoch_ns(int(start)), storage.from_epoch_ns(int(start) + window_ns))
+                     for start in window_starts]
+
+    def range_queries(function):
+        def run():
+            for start_time, end_time in query_windows:
+                function(start_time, end_time)
+        return run
+
+    def read_points():
+        for _ in itertools.islice(get_all_data_points(), points):
+            pass
+
+    write_device = 'bench-write'
+    write_start = datetime.datetime.now()
+
+    def reset_write_device():
+        # Stored data and the in memory state of writers, so each call starts from an empty device
+        storage.delete_series(write_device)
+        rollup_writer.forget(write_device)
+        deadband_filter.forget(write_device)
+
+    def write_points():
+        for number in range(writes):
+            write_time = write_start + datetime.timedelta(seconds=CAPTURE_INTERVAL * number)
+            write_data_point(write_device, write_time, float(number % 100), CAPTURE_INTERVAL)
+            if number % 100 == 99:
+                storage.segment_writer.commit()  # One commit per snapshot of 100 devices
+        storage.segment_writer.commit()
+
+    def cold_cache():
+        HistoryCache(sys.maxsize).get(device_id)
+
+    results = {
+        'device_history_load': measure(lambda: DeviceHistory(device_id), repeat, len(device_history)),
+        'history_cache_cold': measure(cold_cache, repeat, len(device_history)),
+        'history_cache_warm': measure(lambda: history.history_cache.get(device_id), repeat),
+        'history_range': measure(range_queries(device_history.history), repeat, windows),
+        'mean_full': measure(lambda: device_history.mean(), repeat, len(device_history)),
+        'mean_range': measure(range_queries(device_history.mean), repeat, windows),
+        'sum_usage_full': measure(lambda: device_history.sum_usage(), repeat, len(device_history)),
+        'sum_usage_range': measure(range_queries(device_history.sum_usage), repeat, windows),
+        'statistics_all': measure(lambda: device_history.statistics(), repeat, len(device_history)),
+        'usage_graph_render': measure(lambda: render_usage_graph(device_id), repeat),
+        'fleet_statistics': measure(lambda: fleet_statistics(all_devices), repeat, len(all_devices)),
+        'get_all_data_points': measure(read_points, repeat, points),
+    }
+
+    try:
+        results['write_data_point'] = measure(write_points, repeat, writes, setup=reset_write_device)
+    finally:
+        reset_write_device()
+
+    return results
+
+
+def environment() -> dict:
+    """
+    Details of the machine and code benchmarked, stored with results
+
+    :return: environment
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE) -> list:
+    """
+    Compare fastest times against a baseline, the fastest of several calls is the least affected by
+    other load on the machine
+
+    :param results: Benchmark results
+    :param baseline: Benchmark results of the baseline
+    :param tolerance: Relative change in time treated as noise
+    :return: comparison: List of (name, baseline seconds, seconds, ratio, status), status is
+        "regression", "improvement", "unchanged", "new", "missing" or "resized" (items per call changed)
+    """
+    comparison = []
+    for name in sorted(set(results) | set(baseline)):
+        if name not in baseline:
+            comparison.append((name, None, results[name]['min'], None, 'new'))
+            continue
+        if name not in results:
+            comparison.append((name, baseline[name]['min'], None, None, 'missing'))
+            continue
+
+        baseline_seconds = baseline[name]['min']
+        seconds = results[name]['min']
+        ratio = seconds / baseline_seconds if baseline_seconds else None
+
+        if results[name].get('items') != baseline[name].get('items'):
+            status = 'resized'
+        elif ratio is None:
+            status = 'unchanged'
+        elif ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 - tolerance:
+            status = 'improvement'
+        else:
+            status = 'unchanged'
+        comparison.append((name, baseline_seconds, seconds, ratio, status))
+
+    return comparison
+
+
+def report(results, comparison=None) -> str:
+    """
+    Benchmark results as a table
+
+    :param results: Benchmark results
+    :param comparison: Result of compare, adds baseline columns
+    :return: report
+    """
+    def milliseconds(seconds):
+        return f'{seconds * 1000:.2f}' if seconds is not None else '-'
+
+    if comparison is None:
+        lines = [f"{'Benchmark':<24}{'median ms':>12}{'min ms':>12}{'items/s':>14}"]
+        for name, result in results.items():
+            throughput = result.get('throughput')
+            lines.append(f"{name:<24}{milliseconds(result['median']):>12}{milliseconds(result['min']):>12}"
+                         f"{f'{throughput:,.0f}' if throughput else '-':>14}")
+    else:
+        lines = [f"{'Benchmark':<24}{'baseline ms':>12}{'min ms':>12}{'ratio':>8}  status"]
+        for name, baseline_seconds, seconds, ratio, status in comparison:
+            lines.append(f"{name:<24}{milliseconds(baseline_seconds):>12}{milliseconds(seconds):>12}"
+                         f"{f'{ratio:.2f}' if ratio is not None else '-':>8}  {status}")
+
+    return '\n'.join(lines)
+
+
+def dataset_size(args) -> tuple:
+    """
+    Devices and samples per device from command line arguments
+
+    :param args: Parsed arguments
+    :return: devices, samples
+    """
+    devices, samples = PRESETS[args.preset]
+    return args.devices or devices, args.samples or samples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NetworkBia data path benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for command, help_text in (('generate', "Generate a synthetic dataset"),
+                               ('run', "Run benchmarks, generating the dataset if needed")):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('--preset', choices=PRESETS, default='small', help="Dataset size")
+        command_parser.add_argument('--devices', type=int, help="Number of devices, overrides preset")
+        command_parser.add_argument('--samples', type=int, help="Samples per device, overrides preset")
+        command_parser.add_argument('--data', default=DEFAULT_DATA_DIRECTORY, help="Data directory of dataset")
+        command_parser.add_argument('--seed', type=int, default=0, help="Random seed")
+
+    run_parser = subparsers.choices['run']
+    run_parser.add_argument('--repeat', type=int, default=5, help="Timed calls per benchmark")
+    run_parser.add_argument('--points', type=int, default=1_000_000, help="Data points read by get_all_data_points")
+    run_parser.add_argument('--writes', type=int, default=10_000, help="Data points written by write_data_point")
+    run_parser.add_argument('--output', help="Write results to a JSON file, e.g. to use as a baseline")
+    run_parser.add_argument('--baseline', help="JSON results to compare against, exits with 1 on a regression")
+    run_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                            help="Relative change in time treated as noise")
+
+    args = parser.parse_args()
+    devices, samples = dataset_size(args)
+
+    print(f"Generating {devices} devices x {samples:,} samples in {args.data}")
+    try:
+        generate(args.data, devices, samples, args.seed)
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.command == 'run':
+        results = run_benchmarks(args.data, args.repeat, args.points, args.writes, seed=args.seed)
+        output = {
+            'environment': environment(),
+            'dataset': {'devices': devices, 'samples': samples, 'seed': args.seed},
+            'benchmarks': results,
+        }
+
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(output, output_file, indent=2)
+
+        if args.baseline:
+            with open(args.baseline, 'r') as baseline_file:
+                baseline = json.load(baseline_file)
+            if baseline.get('dataset') != output['dataset']:
+                print(f"Warning: baseline dataset {baseline.get('dataset')} differs from {output['dataset']}")
+
+            comparison = compare(results, baseline['benchmarks'], args.tolerance)
+            print(report(results, comparison))
+            if any(status == 'regression' for *_, status in comparison):
+                sys.exit(1)
+        else:
+            print(report(results))
@@ -1,94 +1,615 @@
 from devices import DeviceType
 from devices import device_factory
 from devices import get_devices
+from devices import run_coroutine
+from deadband import DeadbandFilter
+from rollups import rollup_writer
+from status import status_cache
+import metrics
+import storage
 
-import csv
-from threading import Timer, Lock
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import heapq
+from threading import Condition, Lock, Thread
+from weakref import WeakValueDictionary
 from datetime import datetime
+import atexit
+import math
+import time
+import traceback
 import yaml
 
 # Read configuration
 with open('configuration.yaml', 'r') as config_file:
     bia_config = yaml.safe_load(config_file)
 
+# What a scheduler does when a run is due while the previous run is still going, see Periodic
+OVERRUN_POLICIES = ('skip', 'coalesce')
+
+# Schedulers exposed as metrics by name, a scheduler created under a name already taken replaces the old one
+_schedulers = WeakValueDictionary()
+_schedulers_lock = Lock()
+
+
 class Periodic(object):
     """
-    A periodic task running in threading.Timers
-    Based on https://stackoverflow.com/questions/2398661/schedule-a-repeating-event-in-python-3
+    A periodic task, run at interval boundaries (e.g. every 10 seconds on :00, :10, :20)
+    Waits use the monotonic clock and every run is scheduled from the boundary rather than from
+    the previous run, so runs do not drift. Runs never overlap, a run due while the previous
+    one is still going is an overrun and handled according to policy:
+        skip: Drop the run
+        coalesce: Run once as soon as the previous run finishes, however many runs were missed
 
     interval: Capture time interval
     function: Function to be called every interval (e.g. snapshot)
+    policy: "skip" or "coalesce"
+    name: Name used in overrun reports and as the scheduler label of its metrics
     """
-    def __init__(self, interval, function, *args, **kwargs):
-        self._lock = Lock()
-        self._timer = None
+    def __init__(self, interval, function, *args, policy='skip', name=None, **kwargs):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy {policy}")
+
+        self._condition = Condition()
+        self._generation = 0  # Changed by start/stop, so a superseded scheduling thread exits
+        self._stopped = True
+        self._running = False
+        self._pending = False
+        self._last_boundary = None
+        self._next_run = None
         self.function = function
         self.interval = interval
+        self.policy = policy
+        self.name = name or getattr(function, '__name__', 'periodic')
         self.args = args
         self.kwargs = kwargs
-        self._stopped = True
+
+        self.runs = 0
+        self.overruns = 0
+        self.last_duration = None
+        self.max_duration = None
+
+        with _schedulers_lock:
+            _schedulers[self.name] = self
 
     @property
     def stopped(self):
         return self._stopped
 
-    def start(self, from_run=False):
-        self._lock.acquire()
-        if from_run or self._stopped:
+    def start(self):
+        """
+        Start running function at every interval boundary
+        """
+        with self._condition:
+            if not self._stopped:
+                return
+
             self._stopped = False
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-        self._lock.release()
+            self._generation += 1
+            Thread(target=self._schedule, args=(self._generation,), name=f"{self.name}-scheduler",
+                   daemon=True).start()
+
+    def stop(self):
+        """
+        Stop scheduling runs, a run already going is left to finish
+        """
+        with self._condition:
+            self._stopped = True
+            self._pending = False
+            self._generation += 1
+            self._condition.notify_all()
+
+    def set_interval(self, interval):
+        """
+        Change interval, takes effect from the next interval boundary
+
+        :param interval: Seconds between runs
+        """
+        if not 0 < interval < math.inf:
+            raise ValueError("Interval must be positive")
+
+        with self._condition:
+            self.interval = interval
+            self._last_boundary = None
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Scheduling statistics, e.g. for the controls page
+
+        :return: stats
+        """
+        with self._condition:
+            next_run = None
+            if not self._stopped and self._next_run is not None:
+                next_run = max(self._next_run - time.monotonic(), 0.0)
+
+            return {
+                'interval': self.interval,
+                'policy': self.policy,
+                'running': self._running,
+                'runs': self.runs,
+                'overruns': self.overruns,
+                'last_duration': self.last_duration,
+                'max_duration': self.max_duration,
+                'next_run': next_run,
+            }
+
+    def _boundary(self):
+        """
+        Next interval boundary as a monotonic time, must be called with the condition held
+        Boundaries are multiples of interval in wall clock time, so runs line up with round times
+
+        :return: next_run
+        """
+        wall_now = time.time()
+        monotonic_now = time.monotonic()
+
+        boundary = (math.floor(wall_now / self.interval) + 1) * self.interval
+        if self._last_boundary is not None:
+            boundary = max(boundary, self._last_boundary + self.interval)  # Never run a boundary twice
+        self._last_boundary = boundary
+
+        return monotonic_now + (boundary - wall_now)
+
+    def _schedule(self, generation):
+        """
+        Scheduling thread, dispatches a run at every interval boundary
+
+        :param generation: Generation the thread was started for
+        """
+        with self._condition:
+            while self._generation == generation:
+                interval = self.interval
+                self._next_run = self._boundary()
+
+                while self._generation == generation and self.interval == interval:
+                    remaining = self._next_run - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if self._generation != generation or self.interval != interval:
+                    continue  # Stopped, or interval changed and next boundary must be recalculated
+
+                if self._running:
+                    self.overruns += 1
+                    self._pending = self.policy == 'coalesce'
+                    print(f"{self.name} overran its {self.interval}s interval "
+                          f"({'coalescing' if self._pending else 'skipping'} run, {self.overruns} overruns)")
+                    continue
+
+                self._running = True
+                Thread(target=self._run, name=self.name, daemon=True).start()
 
     def _run(self):
-        self.start(from_run=True)
-        self.function(*self.args, **self.kwargs)
+        """
+        Run function, then any run coalesced while it was going
+        """
+        while True:
+            start = time.monotonic()
+            try:
+                self.function(*self.args, **self.kwargs)
+            except Exception:
+                traceback.print_exc()
+            duration = time.monotonic() - start
 
-    def stop(self):
-        self._lock.acquire()
-        self._stopped = True
-        self._timer.cancel()
-        self._lock.release()
+            with self._condition:
+                self.runs += 1
+                self.last_duration = duration
+                self.max_duration = max(self.max_duration or 0.0, duration)
 
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
 
-def write_csv_line(device_id,
-                   time_captured,
-                   power=None):
+
+def _scheduler_metric(attribute):
+    """
+    Collector of an attribute of every scheduler, see metrics.MetricsRegistry.collect
+
+    :param attribute: Periodic attribute, e.g. "runs"
+    :return: collector
     """
-    Writs data to a devices data .csv
+    def collector():
+        with _schedulers_lock:
+            schedulers = list(_schedulers.items())
+
+        return {(name,): getattr(scheduler, attribute) for name, scheduler in schedulers}
+
+    return collector
+
+
+metrics.registry.collect('bia_scheduler_runs_total', "Runs of a periodic task", 'counter',
+                         _scheduler_metric('runs'), ('scheduler',))
+metrics.registry.collect('bia_scheduler_overruns_total',
+                         "Runs dropped or coalesced as the previous run was still going", 'counter',
+                         _scheduler_metric('overruns'), ('scheduler',))
+metrics.registry.collect('bia_scheduler_interval_seconds', "Interval of a periodic task", 'gauge',
+                         _scheduler_metric('interval'), ('scheduler',))
+
+
+def write_data_point(device_id,
+                     time_captured,
+                     power=None,
+                     interval=None,
+                     deadband=False):
+    """
+    Writes data point to a devices data segments, updating its rollups
+    Buffered by the segment writer until the snapshot is committed
 
     :param device_id: Device ID
     :param time_captured: Datetime of captured date
     :param power: Consumption of device at snapshot in Watts
+    :param interval: Capture interval in seconds, defaults to the current capture interval
+    :param deadband: Only write data point if power changed, see DeadbandFilter
+    """
+    if interval is None:
+        interval = capture_sched.interval
+
+    timestamp = storage.to_epoch_ns(time_captured)
+    if deadband:
+        samples = deadband_filter.filter(device_id, timestamp, power, interval)
+    else:
+        samples = list(deadband_filter.flush(device_id).values()) + [(timestamp, power, interval)]
+
+    if samples:
+        rollup_writer.append(device_id, storage.make_records(*zip(*samples)))
+        metrics.rows_written_total.inc(amount=len(samples))
+    else:
+        metrics.rows_suppressed_total.inc()
+
+
+def flush_deadband():
+    """
+    Write samples held back by the deadband filter, e.g. once capture is stopped
+    """
+    for device_id, sample in deadband_filter.flush().items():
+        rollup_writer.append(device_id, storage.make_records(*zip(sample)))
+        metrics.rows_written_total.inc()
+
+    storage.segment_writer.flush()
+
+
+async def _poll_devices(devices, concurrency, deadline):
     """
+    Poll all devices at once
+    Smart plugs are polled natively with asyncio, blocking drivers (napalm/scrapli) are
+    handed to a bounded worker pool. Each device gets a hard deadline, after which it is
+    treated as unreachable. Every poll is traced, see metrics.PollTrace
+
+    :param devices: Devices to poll
+    :param concurrency: Maximum number of devices polled at the same time
+    :param deadline: Seconds allowed per device
+    :return: results: List of (properties (None if unreachable), seconds taken) in same order as devices
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def poll_device(device):
+        async with semaphore:
+            trace = metrics.start_trace(device.uuid)  # Each device is polled in its own task and context
+            started = time.perf_counter()
+            if device.type == DeviceType.SMARTPLUG:
+                pending = device.async_poll()
+            else:
+                # Worker threads don't inherit the context, so phases would miss the trace
+                pending = loop.run_in_executor(executor, contextvars.copy_context().run, device.poll)
+
+            # Timed out or failed, assume unreachable
+            try:
+                result = await asyncio.wait_for(pending, timeout=deadline)
+            except asyncio.TimeoutError:
+                result, outcome = None, 'timeout'
+            except Exception:
+                result, outcome = None, 'error'
+            else:
+                outcome = 'unreachable' if result is None else 'ok'
+
+            latency = time.perf_counter() - started
+            metrics.finish_trace(trace, outcome, latency)
+
+            return result, latency
+
+    try:
+        return await asyncio.gather(*[poll_device(device) for device in devices])
+    finally:
+        # Don't wait on drivers stuck past their deadline
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def poll_devices(devices,
+                 concurrency=None,
+                 deadline=None):
+    """
+    Poll a list of devices concurrently, see _poll_devices
+    Results are also recorded in the live status cache
+
+    :param devices: Devices to poll
+    :param concurrency: Maximum number of devices polled at the same time
+    :param deadline: Seconds allowed per device
+    :return: results: Dictionary of device ID to properties (None if unreachable)
+    """
+    if concurrency is None:
+        concurrency = bia_config.get('poll_concurrency', 32)
+
+    if deadline is None:
+        deadline = bia_config.get('poll_deadline', 5)
+
+    if len(devices) == 0:
+        return {}
 
-    with open(f'data/{device_id}.csv', 'a', newline='') as csvfile:
-        device_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    # Plugs must be polled on the shared event loop their connections belong to
+    results = run_coroutine(_poll_devices(devices, concurrency, deadline))
 
-        date_str = time_captured.isoformat()
-        device_writer.writerow([date_str, power, bia_config['time_interval']])
+    for device, (result, latency) in zip(devices, results):
+        status_cache.record(device.uuid, result, latency)
+
+    return {device.uuid: result for device, (result, latency) in zip(devices, results)}
+
+
+def refresh_status():
+    """
+    Poll all devices to refresh the live status cache, without capturing data
+    Capability is fetched for reachable devices which have none cached, or older than capability_ttl
+    """
+    devices = get_devices()
+    results = poll_devices(devices)
+
+    capability_ttl = bia_config.get('capability_ttl', 3600)
+    outdated = []
+    for device in devices:
+        status = status_cache.get(device.uuid)
+        if results[device.uuid] is not None and (not status.capability or
+                                                  time.monotonic() - status.capability_time > capability_ttl):
+            outdated.append(device)
+
+    if len(outdated) == 0:
+        return
+
+    deadline = bia_config.get('poll_deadline', 5)
+    with ThreadPoolExecutor(max_workers=bia_config.get('poll_concurrency', 32)) as executor:
+        futures = {device.uuid: executor.submit(device.get_capability) for device in outdated}
+        for device_id, future in futures.items():
+            try:
+                status_cache.record_capability(device_id, future.result(timeout=deadline))
+            except Exception:
+                pass  # Keep previous capability, tried again next refresh
+
+
+def captured_power(device_stats):
+    """
+    Power to capture from a poll result
+    If device not connected (unreachable) assume power level of 0 Watts, if connected but not
+    reporting power it is unknown
+
+    :param device_stats: Properties returned by poll, None if unreachable
+    :return: power
+    """
+    if device_stats is None:
+        return 0.0
+
+    return device_stats.get('power')
+
+
+def device_schedule(device):
+    """
+    Own polling schedule of a device, set per device in inventory or per type in device_intervals
+
+    :param device: Device
+    :return: schedule: (interval, adaptive), None if device is captured by the global snapshot
+    """
+    interval = device.interval or bia_config.get('device_intervals', {}).get(device.type.value)
+    if interval is None and not device.adaptive:
+        return None
+
+    return interval or capture_sched.interval, device.adaptive
 
 
 def snapshot():
     """
-    Take single snapshot of all connected devices
+    Take single snapshot of all connected devices without their own schedule (see PollScheduler)
+    All devices are polled at once and share a single capture timestamp, their records are committed as one batch
     If device not connected (unreachable) assume power level of 0 Watts
     """
-    devices = get_devices()
+    started = time.perf_counter()
+    devices = [device for device in get_devices() if device_schedule(device) is None]
+    current_date = datetime.now()
 
     print("Snapshotting")
 
+    results = poll_devices(devices)
+
     for device in devices:
-        power = 0.0
-        if device.connected():
-            device_stats = device.get_properties()
+        write_data_point(device.uuid, current_date, captured_power(results[device.uuid]), deadband=device.deadband)
 
-            if 'power' in device_stats:
-                power = device_stats['power']
-            else:
-                power = None
+    # Records of the whole snapshot are flushed together, see SegmentWriter
+    storage.segment_writer.commit()
+
+    metrics.snapshot_seconds.observe(time.perf_counter() - started)
+
+
+class PollScheduler:
+    """
+    Polls devices with their own schedule (see device_schedule), each at its own interval
+    Devices wait in a heap ordered by when they are next due, devices falling due together are
+    polled as one batch. A device is only rescheduled once its poll finished, so polls of a
+    device never overlap
+
+    Adaptive devices halve their interval while power changes by more than adaptive_change
+    (fraction of previous power) between polls, and back off by half again while it is flat,
+    within adaptive_min_interval and adaptive_max_interval
+
+    workers: Maximum batches polled at once
+    """
+    def __init__(self, workers):
+        self._condition = Condition()
+        self._generation = 0
+        self._stopped = True
+        self._heap = []  # (due monotonic time, device ID)
+        self._intervals = {}  # device ID -> current interval
+        self._powers = {}  # device ID -> last captured power
+        self._polling = set()
+        self._executor = None
+        self.workers = workers
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def start(self):
+        """
+        Start polling, every scheduled device is polled straight away
+        """
+        with self._condition:
+            if not self._stopped:
+                return
+
+            self._stopped = False
+            self._generation += 1
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='device-poll')
+            Thread(target=self._schedule, args=(self._generation,), name="device-scheduler", daemon=True).start()
+
+    def stop(self):
+        """
+        Stop polling, polls already going are left to finish
+        """
+        with self._condition:
+            self._stopped = True
+            self._generation += 1
+            self._heap = []
+            self._intervals = {}
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._condition.notify_all()
+
+    def intervals(self) -> dict:
+        """
+        Current interval of each scheduled device
+
+        :return: intervals: Dictionary of device ID to seconds
+        """
+        with self._condition:
+            return dict(self._intervals)
+
+    def _sync(self, devices):
+        """
+        Schedule devices which gained a schedule, must be called with the condition held
+        Devices which lost their schedule are dropped when they fall due
+
+        :param devices: Devices with their own schedule, by device ID
+        """
+        now = time.monotonic()
+        for device_id, device in devices.items():
+            if device_id not in self._intervals and device_id not in self._polling:
+                self._intervals[device_id] = device_schedule(device)[0]
+                heapq.heappush(self._heap, (now, device_id))
+
+    def _schedule(self, generation):
+        """
+        Scheduling thread, dispatches due devices to the executor
+
+        :param generation: Generation the thread was started for
+        """
+        with self._condition:
+            while self._generation == generation:
+                devices = {str(device.uuid): device for device in get_devices() if device_schedule(device)}
+                self._sync(devices)
+
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, device_id = heapq.heappop(self._heap)
+                    if device_id in devices:
+                        due.append(devices[device_id])
+                        self._polling.add(device_id)
+                    else:
+                        self._intervals.pop(device_id, None)
+
+                if due:
+                    self._executor.submit(self._poll, due, generation)
+
+                # Woken at least every second to pick up inventory changes
+                remaining = self._heap[0][0] - time.monotonic() if self._heap else 1.0
+                self._condition.wait(min(max(remaining, 0.0), 1.0))
+
+    def _poll(self, devices, generation):
+        """
+        Poll a batch of devices, capture their power and reschedule them
+
+        :param devices: Due devices
+        :param generation: Generation the batch was dispatched for
+        """
+        try:
+            results = poll_devices(devices)
+        except Exception:
+            traceback.print_exc()
+            results = {}
+        current_date = datetime.now()
+
+        captured = []
+        with self._condition:
+            for device in devices:
+                device_id = str(device.uuid)
+                self._polling.discard(device_id)
+                if self._generation != generation or device_id not in self._intervals:
+                    continue
+
+                interval = self._intervals[device_id]
+                if device.uuid in results:
+                    power = captured_power(results[device.uuid])
+                    captured.append((device, power, interval))
+                    self._intervals[device_id] = self._next_interval(device, interval, power)
+
+                heapq.heappush(self._heap, (time.monotonic() + self._intervals[device_id], device_id))
+
+            self._condition.notify_all()
+
+        # Each data point records the interval it was polled after, see history.integrate
+        for device, power, interval in captured:
+            write_data_point(device.uuid, current_date, power, interval, deadband=device.deadband)
+        storage.segment_writer.commit()
+
+    def _next_interval(self, device, interval, power) -> float:
+        """
+        Interval until next poll of a device, must be called with the condition held
+
+        :param device: Device
+        :param interval: Current interval
+        :param power: Power just captured
+        :return: interval
+        """
+        base_interval, adaptive = device_schedule(device) or (interval, False)
+
+        previous = self._powers.get(str(device.uuid))
+        self._powers[str(device.uuid)] = power
+        if not adaptive:
+            return base_interval
+
+        if previous is None or power is None:
+            return interval
+
+        change = abs(power - previous) / max(abs(previous), 1.0)
+        if change > bia_config.get('adaptive_change', 0.1):
+            interval = interval / 2
+        else:
+            interval = interval * 1.5
+
+        return min(max(interval, bia_config.get('adaptive_min_interval', 2)),
+                   bia_config.get('adaptive_max_interval', 300))
 
-            current_date = datetime.now()
 
-        write_csv_line(device.uuid, current_date, power)
+deadband_filter = DeadbandFilter(absolute=bia_config.get('deadband_absolute', 0.5),
+                                 percent=bia_config.get('deadband_percent', 1),
+                                 heartbeat=bia_config.get('deadband_heartbeat', 900),
+                                 max_gap_intervals=bia_config.get('max_gap_intervals', 2.5))
+atexit.register(flush_deadband)
 
+capture_sched = Periodic(bia_config['time_interval'], snapshot,
+                         policy=bia_config.get('capture_overrun_policy', 'skip'), name='capture')
+status_sched = Periodic(bia_config.get('status_interval', 30), refresh_status, name='status')
+device_sched = PollScheduler(workers=bia_config.get('poll_workers', 4))
@@ -0,0 +1,19 @@
+from history import history_cache
+from rollups import rollup_writer
+import storage
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def data_directory(tmp_path, monkeypatch):
+    """
+    Store device data in a temporary data directory, dropping any state kept in memory for it afterwards
+    """
+    monkeypatch.setattr(storage, 'DATA_DIRECTORY', str(tmp_path))
+    yield tmp_path
+
+    storage.segment_writer.close_all()
+    for device_id in storage.list_series():
+        rollup_writer.forget(device_id)
+        history_cache.invalidate(device_id)
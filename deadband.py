@@ -0,0 +1,106 @@
+from threading import Lock
+
+
+class DeadbandFilter:
+    """
+    Change based compression of captured samples
+    A sample is only written once power moves out of the deadband around the last written sample,
+    or once heartbeat seconds have passed since it. While power stays inside the deadband the
+    latest suppressed sample is held back, and written just before the next written sample with
+    its interval set to the time it closes, so the flat stretch is stored as a single step and
+    history.integrate counts its energy exactly
+
+    absolute: Deadband in Watts
+    percent: Deadband in percent of the last written power, the wider of the two bands is used
+    heartbeat: Maximum seconds between written samples
+    max_gap_intervals: Intervals without any sample after which a stretch is broken, e.g. capture stopped
+    """
+    def __init__(self, absolute, percent, heartbeat, max_gap_intervals):
+        self._lock = Lock()
+        self._written = {}  # device ID -> (timestamp, power) of last written sample
+        self._held = {}  # device ID -> (timestamp, power, interval) of last suppressed sample
+        self.absolute = absolute
+        self.percent = percent
+        self.heartbeat = heartbeat
+        self.max_gap_intervals = max_gap_intervals
+
+    def filter(self, device_id, timestamp, power, interval) -> list:
+        """
+        Samples to write for a captured sample
+
+        :param device_id: Device ID
+        :param timestamp: Capture time, nanoseconds since epoch
+        :param power: Power in Watts, None if unknown
+        :param interval: Capture interval in seconds
+        :return: samples: List of (timestamp, power, interval), empty if suppressed
+        """
+        device_id = str(device_id)
+
+        with self._lock:
+            written = self._written.get(device_id)
+            held = self._held.pop(device_id, None)
+            last_seen = held[0] if held is not None else written[0] if written is not None else None
+
+            # Contiguous with the previous sample, otherwise the stretch ends at the previous sample
+            contiguous = (last_seen is not None and
+                          timestamp - last_seen <= interval * self.max_gap_intervals * 1_000_000_000)
+
+            if (contiguous and power is not None and written[1] is not None and
+                    abs(power - written[1]) <= max(self.absolute, abs(written[1]) * self.percent / 100)):
+                span = (timestamp - written[0]) / 1_000_000_000
+                if span < self.heartbeat:
+                    self._held[device_id] = (timestamp, power, interval)
+                    return []
+
+                # Heartbeat, sample closes the flat stretch itself
+                self._written[device_id] = (timestamp, power)
+                return [(timestamp, power, span)]
+
+            samples = []
+            if held is not None:
+                samples.append(self._close(written, held))
+
+            self._written[device_id] = (timestamp, power)
+            samples.append((timestamp, power, interval))
+            return samples
+
+    def flush(self, device_id=None) -> dict:
+        """
+        Release held back samples, e.g. on shutdown or once capture is stopped
+
+        :param device_id: Device to flush, defaults to all
+        :return: samples: Dictionary of device ID to (timestamp, power, interval)
+        """
+        with self._lock:
+            device_ids = list(self._held) if device_id is None else [str(device_id)]
+
+            samples = {}
+            for flush_id in device_ids:
+                held = self._held.pop(flush_id, None)
+                if held is not None:
+                    samples[flush_id] = self._close(self._written[flush_id], held)
+                    self._written[flush_id] = held[:2]
+
+            return samples
+
+    def forget(self, device_id):
+        """
+        Drop state of a device, e.g. once deleted
+
+        :param device_id: Device ID
+        """
+        with self._lock:
+            self._written.pop(str(device_id), None)
+            self._held.pop(str(device_id), None)
+
+    @staticmethod
+    def _close(written, held) -> tuple:
+        """
+        Held back sample closing a flat stretch, its interval covers the whole stretch
+
+        :param written: (timestamp, power) of last written sample
+        :param held: (timestamp, power, interval) of held back sample
+        :return: sample: (timestamp, power, interval)
+        """
+        span = (held[0] - written[0]) / 1_000_000_000
+        return held[0], held[1], max(span, held[2])
@@ -1,16 +1,53 @@
-from kasa import SmartPlug
-from kasa import SmartDeviceException
-from scrapli.driver.core import IOSXEDriver
-from scrapli.helper import textfsm_parse
-from scrapli import Scrapli
+from sessions import CONNECTION_ERRORS
+from sessions import session_pool
+import metrics
+import storage
 
 import asyncio
-import csv
 from enum import Enum
-import napalm
+from threading import Lock, Thread
+import hashlib
+import os
+import tempfile
+import time
 import uuid
 import json
-import os
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+_event_loop = None
+_event_loop_lock = Lock()
+
+
+def event_loop():
+    """
+    Long-lived event loop shared by all smart plugs
+    Runs in its own thread, so kasa connections can be reused across requests and snapshots
+
+    :return: loop
+    """
+    global _event_loop
+
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            Thread(target=_event_loop.run_forever, name="kasa-event-loop", daemon=True).start()
+
+    return _event_loop
+
+
+def run_coroutine(coroutine, timeout=None):
+    """
+    Run a coroutine on the shared event loop and wait for its result
+
+    :param coroutine: Coroutine to run
+    :param timeout: Seconds to wait for result
+    :return: result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, event_loop()).result(timeout)
 
 
 class DeviceType(Enum):
@@ -29,6 +66,11 @@ class Device:
         self._address = address
         self.type = None
 
+        # Polling schedule, devices without an interval are captured by the global snapshot
+        self.interval = None
+        self.adaptive = False
+        self.deadband = False  # Only capture changes in power, see deadband.DeadbandFilter
+
     @classmethod
     def new_device(cls,
                    name: str,
@@ -43,9 +85,7 @@ class Device:
         """
         device_uuid = uuid.uuid4()
 
-        with open(f'data/{device_uuid}.csv', 'w', newline='') as csvfile:
-            device_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            device_writer.writerow(['timestamp', 'power', 'interval'])
+        storage.create_series(device_uuid)
 
         return cls(name, address, device_uuid)
 
@@ -88,6 +128,39 @@ class Device:
     def is_connected(self):
         pass
 
+    def poll(self):
+        """
+        Poll device once for capture
+        Returns None if device is not connected (unreachable)
+
+        :return: properties
+        """
+        if not self.connected():
+            return None
+
+        return self.get_properties()
+
+    def inventory_details(self) -> dict:
+        """
+        Details stored for device in inventory file
+
+        :return: details
+        """
+        details = {
+            'name': self._name,
+            'type': self.type.value,
+            'address': self._address
+        }
+
+        if self.interval is not None:
+            details['interval'] = self.interval
+        if self.adaptive:
+            details['adaptive'] = True
+        if self.deadband:
+            details['deadband'] = True
+
+        return details
+
     def save(self):
         """
         Save device to inventory
@@ -95,19 +168,7 @@ class Device:
 
         :return:
         """
-
-        with open('inventory/devices.json', 'r+') as device_file:
-            raw_devices = json.load(device_file)
-
-            raw_devices[str(self._uuid)] = {
-                'name': self._name,
-                'type': self.type.value,
-                'address': self._address
-            }
-
-            device_file.seek(0)
-            json.dump(raw_devices, device_file)
-            device_file.truncate()
+        device_registry.save(self)
 
 
 class SmartPlugDevice(Device):
@@ -115,24 +176,41 @@ class SmartPlugDevice(Device):
     Kasa Smart Plug realisation of Device Interface
     Synonyms with KASA 115 currently
 
+    A single update() per poll cycle fills reachability, emeter readings and capability,
+    which are then served from the cached state until it is older than state_ttl
+
     name: Name of device
     address: IP address of device
     device_uuid: ID of address in inventory
+    state_ttl: Seconds a poll cycle is reused for
     """
 
-    def __init__(self, name, address, device_uuid):
-        asyncio.set_event_loop(asyncio.SelectorEventLoop())
+    def __init__(self, name, address, device_uuid, state_ttl=1.0):
         Device.__init__(self, name, address, device_uuid)
-        self._kasa_device = SmartPlug(self._address)
+        self._kasa_device = None  # Created on first poll
+        self._state = None
+        self._state_time = None
+        self._state_ttl = state_ttl
         self.type = DeviceType.SMARTPLUG
 
+    def poll_state(self) -> dict:
+        """
+        Get state of last poll cycle, polling the plug if state is missing or stale
+
+        :return: state
+        """
+        if self._state is None or time.monotonic() - self._state_time > self._state_ttl:
+            return run_coroutine(self.poll_cycle())
+
+        return self._state
+
     def get_stats(self):
         """
         Get power, voltage and curret
 
         :return: stats
         """
-        return asyncio.get_event_loop().run_until_complete(self.get_plug_stats())
+        return self.poll_state()['emeter']
 
     def get_capability(self):
         """
@@ -140,7 +218,7 @@ class SmartPlugDevice(Device):
 
         :return: capability
         """
-        return asyncio.get_event_loop().run_until_complete(self.get_cap_stats())
+        return self.poll_state()['capability']
 
     def connected(self):
         """
@@ -149,7 +227,7 @@ class SmartPlugDevice(Device):
 
         :return: connected
         """
-        return asyncio.get_event_loop().run_until_complete(self.is_connected())
+        return self.poll_state()['connected']
 
     def get_power(self) -> float:
         """
@@ -182,56 +260,82 @@ class SmartPlugDevice(Device):
 
         :return: properties
         """
-        device_stats = self.get_stats()
-        return {
-            'power': device_stats['power'],
-            'voltage': device_stats['voltage'],
-            'current': device_stats['power'],
-        }
+        return self._properties(self.get_stats())
 
-    async def get_plug_stats(self):
+    def poll(self):
         """
-        Async IO function to be called by get_stats function
+        Poll device once for capture, single poll cycle
 
-        :return: plug_emeter_stats
+        :return: properties
         """
-        device = self._kasa_device
-        await device.update()  # Request an update
-        return device.emeter_realtime
+        return run_coroutine(self.async_poll())
 
-    async def get_cap_stats(self) -> dict:
+    async def async_poll(self):
         """
-        Async IO function to be called by get_capability function
+        Async IO version of poll, allows plugs to be polled concurrently
 
-        :return: plug_capability
+        :return: properties
         """
+        state = await self.poll_cycle()
+        if not state['connected']:
+            return None
+
+        return self._properties(state['emeter'])
+
+    async def poll_cycle(self) -> dict:
+        """
+        Async IO function to request a single update from the plug
+        Must run on the shared event loop (see event_loop)
+
+        Shortening timeout will increase load times but slow networks may be affected
+
+        :return: state: Reachability, emeter readings and capability
+        """
+        if self._kasa_device is None:
+            from kasa import SmartPlug
+
+            self._kasa_device = SmartPlug(self._address)
+
         device = self._kasa_device
-        await device.update()  # Request an update
+        try:
+            with metrics.phase(self.uuid, 'kasa_update'):
+                await asyncio.wait_for(device.update(), timeout=0.75)
+        except:
+            state = {'connected': False, 'emeter': {}, 'capability': {}}
+        else:
+            cap_stats = {
+                'alias': device.alias,
+                'model': device.model,
+                'rssi': device.rssi,
+                'mac': device.mac,
+            }
 
-        cap_stats = {
-            'alias': device.alias,
-            'model': device.model,
-            'rssi': device.rssi,
-            'mac': device.mac,
-        }
+            state = {
+                'connected': device.is_on,
+                'emeter': dict(device.emeter_realtime),
+                'capability': {**cap_stats, **device.hw_info},
+            }
 
-        return {**cap_stats, **device.hw_info}
+        self._state = state
+        self._state_time = time.monotonic()
+        return state
 
     async def is_connected(self) -> bool:
         """
         Async IO function to check if device is connected
 
-        SShortening timeout will increase load times but slow networks may be affected
-
         :return: is_connected
         """
-        device = self._kasa_device
-        try:
-            await asyncio.wait_for(device.update(), timeout=0.75)
-        except:
-            return False
+        state = await self.poll_cycle()
+        return state['connected']
 
-        return device.is_on
+    @staticmethod
+    def _properties(device_stats) -> dict:
+        return {
+            'power': device_stats['power'],
+            'voltage': device_stats['voltage'],
+            'current': device_stats['current'],
+        }
 
 
 class CiscoDevice(Device):
@@ -249,21 +353,19 @@ class CiscoDevice(Device):
     def __init__(self, name, address, device_uuid, username, password):
         Device.__init__(self, name, address, device_uuid)
 
-        # Setup Napalm
-        self._driver = napalm.get_network_driver("ios")
-        conn_details = {
+        # Setup Napalm, driver is only loaded once the device is polled
+        self._conn_details = {
             "hostname": address,
             "username": username,
             "password": password,
             "timeout": 0.75
         }
-        self._device = self._driver(**conn_details)
         self._username = username
         self._password = password
         self.type = DeviceType.CISCO
 
         # Setup Scrapli, primarily for TextFSM parsing
-        scrapli_conn_details = {
+        self._scrapli_conn_details = {
             "host": address,
             "auth_username": username,
             "auth_password": password,
@@ -272,30 +374,88 @@ class CiscoDevice(Device):
             "transport": "paramiko"
         }
 
-        self._scrapli_device = Scrapli(**scrapli_conn_details)
-
     @classmethod
     def new_device(cls, name, address, username, password):
         device_uuid = uuid.uuid4()
 
-        with open(f'data/{device_uuid}.csv', 'w', newline='') as csvfile:
-            device_writer = csv.writer(csvfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            device_writer.writerow(['timestamp', 'power', 'interval'])
+        storage.create_series(device_uuid)
 
         return cls(name, address, device_uuid, username, password)
 
+    def _napalm_session(self, operation):
+        """
+        Run operation on a pooled, already authenticated napalm session
+        Logging in (connect) and the operation (command) are timed as poll phases
+
+        :param operation: Function taking the napalm device
+        :return: result
+        """
+        def connect():
+            import napalm
+
+            with metrics.phase(self.uuid, 'connect'):
+                device = napalm.get_network_driver("ios")(**self._conn_details)
+                device.open()
+            return device
+
+        def command(device):
+            with metrics.phase(self.uuid, 'command'):
+                return operation(device)
+
+        import napalm
+        import netmiko
+        import paramiko
+
+        return session_pool.run((self._address, "napalm", self._username),
+                                connect,
+                                command,
+                                is_alive=lambda device: device.is_alive()['is_alive'],
+                                connection_errors=CONNECTION_ERRORS + (napalm.base.exceptions.ConnectionException,
+                                                                       netmiko.exceptions.ReadException,
+                                                                       netmiko.exceptions.WriteException,
+                                                                       paramiko.SSHException))
+
+    def _scrapli_session(self, operation):
+        """
+        Run operation on a pooled, already authenticated scrapli session
+        Logging in (connect) and the operation (command) are timed as poll phases
+
+        :param operation: Function taking the scrapli driver
+        :return: result
+        """
+        def connect():
+            from scrapli import Scrapli
+
+            with metrics.phase(self.uuid, 'connect'):
+                device = Scrapli(**self._scrapli_conn_details)
+                device.open()
+            return device
+
+        def command(device):
+            with metrics.phase(self.uuid, 'command'):
+                return operation(device)
+
+        from scrapli import exceptions
+
+        return session_pool.run((self._address, "scrapli", self._username),
+                                connect,
+                                command,
+                                is_alive=lambda device: device.isalive(),
+                                connection_errors=CONNECTION_ERRORS + (exceptions.ScrapliConnectionError,
+                                                                       exceptions.ScrapliConnectionNotOpened,
+                                                                       exceptions.ScrapliTimeout))
+
     def get_stats(self) -> dict:
         """
         Get device environment stats, such as power (if supported), cpu usage, memory usage
 
         :return: stats
         """
+        import napalm
+
         try:
-            self._device.open()
-            dev_env = self._device.get_environment()
-            self._device.close()
-            return dev_env
-        except napalm.base.exceptions.ConnectionException:
+            return self._napalm_session(lambda device: device.get_environment())
+        except (napalm.base.exceptions.ConnectionException, TimeoutError):
             return {}
 
     def get_capability(self) -> dict:
@@ -304,25 +464,31 @@ class CiscoDevice(Device):
 
         :return: capability
         """
+        import napalm
+
         try:
-            self._device.open()
-            capabilities = self._device.get_facts()
-            self._device.close()
-            return capabilities
-        except napalm.base.exceptions.ConnectionException:
+            return self._napalm_session(lambda device: device.get_facts())
+        except (napalm.base.exceptions.ConnectionException, TimeoutError):
             return {}
 
     def connected(self) -> bool:
         """
         Check if device is connected
+        Reuses a pooled session if one is open, checking it is still alive. A dead session is
+        replaced by a new connection
 
         :return: connected
         """
+        import napalm
+
+        def check_alive(device):
+            if not device.is_alive()['is_alive']:
+                raise napalm.base.exceptions.ConnectionException("Session is no longer alive")
+
         try:
-            self._device.open()
-            self._device.close()
+            self._napalm_session(check_alive)
             return True
-        except napalm.base.exceptions.ConnectionException:
+        except (napalm.base.exceptions.ConnectionException, TimeoutError):
             return False
 
     def get_power(self) -> float:
@@ -332,11 +498,12 @@ class CiscoDevice(Device):
 
         :return:
         """
-        self._scrapli_device.open()
-        response = self._scrapli_device.send_command("show environment")
-        enviroment_result = textfsm_parse("textfsm_templates/r2911_show_enviroment.textfsm", response.result)[
-            0]  # Select first one, show enviroment won't have multiple instances
-        self._scrapli_device.close()
+        from scrapli.helper import textfsm_parse
+
+        response = self._scrapli_session(lambda device: device.send_command("show environment"))
+        with metrics.phase(self.uuid, 'parse'):
+            enviroment_result = textfsm_parse("textfsm_templates/r2911_show_enviroment.textfsm", response.result)[
+                0]  # Select first one, show enviroment won't have multiple instances
         return float(enviroment_result['systempower'])
 
     def get_properties(self) -> dict:
@@ -365,28 +532,181 @@ class CiscoDevice(Device):
 
         return properties
 
-    def save(self):
+    def inventory_details(self) -> dict:
         """
-        Save device to inventory
-        If already exists, overrides type and address
+        Details stored for device in inventory file, includes login
 
-        :return:
+        :return: details
         """
+        return {
+            **Device.inventory_details(self),
+            'username': self._username,
+            'password': self._password
+        }
 
-        with open('inventory/devices.json', 'r+') as device_file:
-            raw_devices = json.load(device_file)
 
-            raw_devices[str(self._uuid)] = {
-                'name': self._name,
-                'type': self.type.value,
-                'address': self._address,
-                'username': self._username,
-                'password': self._password
-            }
+class DeviceRegistry:
+    """
+    Process wide inventory of device objects
+    The inventory file is only read again once its modification time and content hash change,
+    device objects (and their sessions) are reused across reloads while their details are unchanged.
+    Changes are written to a temporary file and renamed over the inventory, so readers never
+    see a partially written file
+
+    path: Path of inventory file
+    check_interval: Seconds between checking the inventory file for changes
+    """
+    def __init__(self, path, check_interval):
+        self._lock = Lock()
+        self._devices = {}  # device ID -> device
+        self._details = {}  # device ID -> inventory details
+        self._stat = None
+        self._hash = None
+        self._checked = None
+        self.path = path
+        self.check_interval = check_interval
+
+    def get(self, device_id):
+        """
+        Get a device
+
+        :param device_id: Device ID
+        :return: device: Raises KeyError if not in inventory
+        """
+        self._refresh()
+        return self._devices[str(device_id)]
+
+    def all(self) -> list:
+        """
+        All devices in inventory order
+
+        :return: devices
+        """
+        self._refresh()
+        return list(self._devices.values())
+
+    def save(self, device):
+        """
+        Add or update a device and write the inventory
+
+        :param device: Device
+        """
+        device_id = str(device.uuid)
+
+        with self._lock:
+            self._reload()
+            self._devices[device_id] = device
+            self._details[device_id] = device.inventory_details()
+            self._write()
+
+    def delete(self, device_id):
+        """
+        Remove a device and write the inventory
+
+        :param device_id: Device ID
+        """
+        device_id = str(device_id)
+
+        with self._lock:
+            self._reload()
+            del self._details[device_id]
+            self._devices.pop(device_id, None)
+            self._write()
+
+    def _refresh(self):
+        """
+        Reload inventory if it changed, checked at most every check_interval seconds
+        """
+        if self._checked is not None and time.monotonic() - self._checked < self.check_interval:
+            return
+
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        """
+        Reload inventory if its modification time and content changed, must be called with the lock held
+        """
+        self._checked = time.monotonic()
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._stat = self._hash = None
+            self._details = {}
+            self._devices = {}
+            return
+
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if stat == self._stat:
+            return
 
-            device_file.seek(0)
-            json.dump(raw_devices, device_file)
-            device_file.truncate()
+        with open(self.path, 'rb') as device_file:
+            content = device_file.read()
+
+        self._stat = stat
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash == self._hash:
+            return  # Touched but not changed
+        self._hash = content_hash
+
+        raw_devices = json.loads(content)
+
+        devices = {}
+        for device_uuid, device_details in raw_devices.items():
+            if self._details.get(device_uuid) == device_details:
+                devices[device_uuid] = self._devices[device_uuid]
+            else:
+                devices[device_uuid] = _from_inventory(device_uuid, device_details)
+
+        self._details = raw_devices
+        self._devices = devices
+
+    def _write(self):
+        """
+        Write inventory atomically, must be called with the lock held
+        """
+        content = json.dumps(self._details).encode()
+
+        directory = os.path.dirname(self.path) or '.'
+        temporary_fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.devices-', suffix='.json')
+        try:
+            with os.fdopen(temporary_fd, 'wb') as temporary_file:
+                temporary_file.write(content)
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+        stat = os.stat(self.path)
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+        self._hash = hashlib.sha256(content).hexdigest()
+
+
+def _from_inventory(device_uuid, device_details):
+    """
+    Build a device from its inventory details
+
+    :param device_uuid: Device ID
+    :param device_details: Details stored in inventory file
+    :return: device
+    """
+    dev_type = device_details['type']
+    if dev_type == "SMARTPLUG":
+        device = SmartPlugDevice(device_details['name'], device_details['address'], device_uuid)
+    elif dev_type == "CISCO":
+        device = CiscoDevice(device_details['name'],
+                             device_details['address'],
+                             device_uuid,
+                             device_details['username'],
+                             device_details['password'])
+
+    device.interval = device_details.get('interval')
+    device.adaptive = device_details.get('adaptive', False)
+    device.deadband = device_details.get('deadband', False)
+    return device
 
 
 def get_devices(
@@ -395,48 +715,22 @@ def get_devices(
 ):
     """
     Return all devices, or, if a device_id is supplied - a specific device
+    Served from the device registry, the inventory file is only read when it changed
 
     :param device_id: Device ID of device in inventory file
     :param check_connected: Only return devices confirmed to be connected
 
     :return: devices: List of devices
     """
-    with open('inventory/devices.json') as device_file:
-        raw_devices = json.load(device_file)
-
     # Return single device if device_id supplied
     if device_id:
-        device_details = raw_devices[device_id]
-        dev_type = device_details['type']
-        if dev_type == "SMARTPLUG":
-            return SmartPlugDevice(device_details['name'], device_details['address'], device_id)
-        elif dev_type == "CISCO":
-            return CiscoDevice(device_details['name'],
-                               device_details['address'],
-                               device_id,
-                               device_details['username'],
-                               device_details['password'])
+        return device_registry.get(device_id)
 
     # Return multiple devices if no device_id supplied
-    converted_devices = []
-    for device_uuid, device_details in raw_devices.items():
-        dev_type = device_details['type']
-        if dev_type == "SMARTPLUG":
-            converted_device = SmartPlugDevice(device_details['name'], device_details['address'], device_uuid)
-        elif dev_type == "CISCO":
-            converted_device = CiscoDevice(device_details['name'],
-                                           device_details['address'],
-                                           device_uuid,
-                                           device_details['username'],
-                                           device_details['password'])
-
-        if check_connected:
-            if converted_device.connected():
-                converted_devices.append(converted_device)
-        else:
-            converted_devices.append(converted_device)
+    if check_connected:
+        return [device for device in device_registry.all() if device.connected()]
 
-    return converted_devices
+    return device_registry.all()
 
 
 def device_factory(device_name, device_type, device_address, device_username=None, device_password=None):
@@ -463,14 +757,8 @@ def delete_device(device_id):
 
     :param device_id: Device ID device in inventory
     """
-    if os.path.exists(f'data/{device_id}.csv'):
-        os.remove(f'data/{device_id}.csv')
-
-    with open('inventory/devices.json', 'r+') as device_file:
-        raw_devices = json.load(device_file)
+    storage.delete_series(device_id)
+    device_registry.delete(device_id)
 
-        del raw_devices[device_id]
 
-        device_file.seek(0)
-        json.dump(raw_devices, device_file)
-        device_file.truncate()
+device_registry = DeviceRegistry('inventory/devices.json', bia_config.get('inventory_check_interval', 2))
@@ -0,0 +1,111 @@
+import numpy as np
+
+# Downsampling methods available for graphs
+METHODS = ('lttb', 'minmax')
+
+
+def _as_float(timestamps) -> np.ndarray:
+    """
+    Timestamps as floats, so areas can be calculated
+
+    :param timestamps: datetime64 or numeric timestamps
+    :return: timestamps
+    """
+    if np.issubdtype(timestamps.dtype, np.datetime64):
+        timestamps = timestamps.astype('datetime64[ns]').astype('int64')
+
+    return timestamps.astype('float64')
+
+
+def lttb(timestamps, values, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling
+    Keeps first and last point, then from each bucket the point forming the largest triangle
+    with the previously kept point and the average of the next bucket
+
+    :param timestamps: Sorted timestamps
+    :param values: Values at each timestamp
+    :param threshold: Number of points to keep
+    :return: timestamps, values
+    """
+    length = len(timestamps)
+    if threshold >= length or threshold < 3:
+        return timestamps, values
+
+    x = _as_float(timestamps)
+    y = np.asarray(values, dtype='float64')
+
+    # Buckets between the first and last point
+    edges = np.linspace(1, length - 1, threshold - 1).astype('int64')
+
+    selected = np.zeros(threshold, dtype='int64')
+    selected[-1] = length - 1
+    previous = 0
+
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+        else:
+            next_start, next_end = length - 1, length
+        next_x = x[next_start:next_end].mean()
+        next_y = y[next_start:next_end].mean()
+
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (next_y - y[previous]))
+
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return timestamps[selected], values[selected]
+
+
+def min_max(timestamps, values, threshold):
+    """
+    Min/max per bucket downsampling
+    Keeps the lowest and highest point of each bucket in time order, so spikes always survive
+
+    :param timestamps: Sorted timestamps
+    :param values: Values at each timestamp
+    :param threshold: Number of points to keep
+    :return: timestamps, values
+    """
+    length = len(timestamps)
+    buckets = threshold // 2
+    if threshold >= length or buckets < 1:
+        return timestamps, values
+
+    edges = np.linspace(0, length, buckets + 1).astype('int64')
+
+    selected = np.zeros(buckets * 2, dtype='int64')
+    for bucket in range(buckets):
+        start, end = edges[bucket], edges[bucket + 1]
+        bucket_values = values[start:end]
+        selected[bucket * 2:bucket * 2 + 2] = sorted((start + int(np.argmin(bucket_values)),
+                                                      start + int(np.argmax(bucket_values))))
+
+    return timestamps[selected], values[selected]
+
+
+def downsample(timestamps, values, threshold, method='lttb'):
+    """
+    Reduce a series to a point budget, unknown values are dropped
+
+    :param timestamps: Sorted timestamps
+    :param values: Values at each timestamp
+    :param threshold: Number of points to keep
+    :param method: "lttb" or "minmax"
+    :return: timestamps, values
+    """
+    known = ~np.isnan(values)
+    if not np.all(known):
+        timestamps = timestamps[known]
+        values = values[known]
+
+    if method == 'lttb':
+        return lttb(timestamps, values, threshold)
+    elif method == 'minmax':
+        return min_max(timestamps, values, threshold)
+    else:
+        raise ValueError(f"Unknown downsampling method {method}")
@@ -0,0 +1,77 @@
+from history import iter_data_points
+
+import csv
+import io
+import json
+import math
+
+# Output formats of the raw data API and their content types
+FORMATS = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+CSV_COLUMNS = ('device', 'timestamp', 'power', 'interval')
+
+
+def encode_cursor(cursor) -> str:
+    """
+    Encode a page cursor for use in a URL
+
+    :param cursor: (device ID, timestamp in nanoseconds, data points with that timestamp sent)
+    :return: encoded_cursor
+    """
+    return f'{cursor[0]}:{cursor[1]}:{cursor[2]}'
+
+
+def decode_cursor(encoded_cursor):
+    """
+    Decode a page cursor from a URL
+    Raises ValueError if it is malformed
+
+    :param encoded_cursor: Cursor from encode_cursor
+    :return: cursor: (device ID, timestamp in nanoseconds, data points with that timestamp sent)
+    """
+    fields = encoded_cursor.rsplit(':', 2)
+    if len(fields) != 3 or not fields[0] or int(fields[2]) < 0:
+        raise ValueError(f"Invalid cursor {encoded_cursor}")
+
+    device_id, timestamp, sent = fields
+    return device_id, int(timestamp), int(sent)
+
+
+def stream(page, output_format='jsonl'):
+    """
+    Serialise a page of data points one line at a time
+    Unknown power is written as null (JSON lines) or an empty field (CSV)
+
+    :param page: Page from page_data_points
+    :param output_format: "jsonl" or "csv"
+    :return: lines: Generator of text
+    """
+    if output_format == 'jsonl':
+        for data_point in iter_data_points(page):
+            if math.isnan(data_point['power']):
+                data_point['power'] = None
+            yield json.dumps(data_point) + '\n'
+
+    elif output_format == 'csv':
+        line = io.StringIO()
+        writer = csv.DictWriter(line, fieldnames=CSV_COLUMNS)
+
+        writer.writeheader()
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+
+        for data_point in iter_data_points(page):
+            if math.isnan(data_point['power']):
+                data_point['power'] = ''
+            writer.writerow(data_point)
+
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+
+    else:
+        raise ValueError(f"Unknown output format {output_format}")
@@ -0,0 +1,227 @@
+from history import history_cache
+from history import GRAPH_SIZE
+from history import GRAPH_DPI
+import metrics
+import storage
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from threading import BoundedSemaphore, Lock
+import io
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+
+class ImageCache:
+    """
+    Least recently used cache of rendered images, bounded by total size in bytes
+    Each entry records the data version it was rendered from, entries of a device rendered
+    from older data are dropped as soon as a newer version is seen
+
+    max_bytes: Total size of cached images
+    """
+    def __init__(self, max_bytes):
+        self._lock = Lock()
+        self._images = OrderedDict()  # key -> (version, image)
+        self._versions = {}  # device ID -> latest data version seen
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """
+        Get a cached image
+
+        :param key: Cache key, first element must be the device ID
+        :param version: Current data version of the device
+        :return: image: Image bytes, None if not cached or stale
+        """
+        with self._lock:
+            self._invalidate(key[0], version)
+
+            entry = self._images.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._images.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, image):
+        """
+        Cache an image, evicting least recently used images to stay within max_bytes
+
+        :param key: Cache key, first element must be the device ID
+        :param version: Data version the image was rendered from
+        :param image: Image bytes
+        """
+        if len(image) > self.max_bytes:
+            return
+
+        with self._lock:
+            if self._versions.get(key[0]) != version:
+                return  # Rendered from data that has since changed
+
+            if key in self._images:
+                self.size -= len(self._images.pop(key)[1])
+
+            self._images[key] = (version, image)
+            self.size += len(image)
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._images.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, device_id):
+        """
+        Drop all cached images of a device
+
+        :param device_id: Device ID
+        """
+        with self._lock:
+            self._versions.pop(str(device_id), None)
+            self._drop(str(device_id))
+
+    def _invalidate(self, device_id, version):
+        """
+        Drop images of a device if its data version changed, must be called with the lock held
+
+        :param device_id: Device ID
+        :param version: Current data version of the device
+        """
+        if self._versions.get(device_id) != version:
+            self._versions[device_id] = version
+            self._drop(device_id)
+
+    def _drop(self, device_id):
+        """
+        Drop all images of a device, must be called with the lock held
+
+        :param device_id: Device ID
+        """
+        for key in [key for key in self._images if key[0] == device_id]:
+            self.size -= len(self._images.pop(key)[1])
+
+
+class RenderQueueFull(Exception):
+    """
+    Raised when the render pool already has as many renders queued as it allows
+    """
+
+
+class RenderPool:
+    """
+    Renders graphs in worker processes, keeping Matplotlib work off the web server threads
+    Workers are started on first use
+
+    workers: Number of worker processes
+    queue_size: Maximum renders running or waiting at once, further renders raise RenderQueueFull
+    timeout: Seconds to wait for a render before raising TimeoutError
+    """
+    def __init__(self, workers, queue_size, timeout):
+        self._lock = Lock()
+        self._executor = None
+        self._slots = BoundedSemaphore(queue_size)
+        self.workers = workers
+        self.timeout = timeout
+
+    def render(self, function, *args):
+        """
+        Run a render function in a worker process and wait for its result
+
+        :param function: Module level render function
+        :param args: Arguments for function
+        :return: result
+        """
+        if not self._slots.acquire(blocking=False):
+            raise RenderQueueFull()
+
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # Slot is held until the worker is finished, even if the caller gave up waiting
+        future.add_done_callback(lambda _: self._slots.release())
+
+        return future.result(timeout=self.timeout)
+
+    def _get_executor(self):
+        """
+        Start worker processes on first use
+
+        :return: executor
+        """
+        with self._lock:
+            if self._executor is None:
+                # Spawn rather than fork, the web server process runs threads (capture, event loop)
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+
+            return self._executor
+
+
+def render_usage_graph(device_id,
+                       start_time=None,
+                       end_time=None,
+                       size=GRAPH_SIZE,
+                       dpi=GRAPH_DPI) -> bytes:
+    """
+    Render a devices usage graph to PNG
+    Runs in a render pool worker process, each worker keeps its own history cache
+
+    :param device_id: ID of device in inventory file
+    :param start_time: Start time to filter data points
+    :param end_time: End time to filter data points
+    :param size: Figure size in inches (width, height)
+    :param dpi: Figure dots per inch
+    :return: png
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+
+    usage_graph = history_cache.get(device_id).usage_graph(start_time, end_time, size=size, dpi=dpi)
+
+    output = io.BytesIO()
+    FigureCanvas(usage_graph).print_png(output)
+    return output.getvalue()
+
+
+def usage_graph_png(device_id,
+                    start_time=None,
+                    end_time=None,
+                    size=GRAPH_SIZE,
+                    dpi=GRAPH_DPI) -> bytes:
+    """
+    Usage graph PNG, served from the image cache unless new data has been captured since
+    Rendering happens in the render pool, raises RenderQueueFull or TimeoutError if it is overloaded
+
+    :param device_id: ID of device in inventory file
+    :param start_time: Start time to filter data points
+    :param end_time: End time to filter data points
+    :param size: Figure size in inches (width, height)
+    :param dpi: Figure dots per inch
+    :return: png
+    """
+    key = (str(device_id), start_time, end_time, tuple(size), dpi)
+    version = storage.data_version(device_id)
+
+    png = image_cache.get(key, version)
+    if png is None:
+        png = render_pool.render(render_usage_graph, device_id, start_time, end_time, size, dpi)
+        image_cache.put(key, version, png)
+
+    return png
+
+
+image_cache = ImageCache(bia_config.get('graph_cache_bytes', 32 * 1024 * 1024))
+metrics.register_cache('graph', image_cache)
+render_pool = RenderPool(workers=bia_config.get('graph_workers', 2),
+                         queue_size=bia_config.get('graph_queue_size', 8),
+                         timeout=bia_config.get('graph_render_timeout', 10))
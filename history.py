@@ -1,29 +1,276 @@
-import ciso8601
-import matplotlib.pyplot as plt
 import numpy as np
 
-import csv
-import datetime
-import statistics as stats
-import os
+from downsampling import downsample
+import metrics
+import storage
+
+from collections import OrderedDict
+from threading import Lock
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+# Stored capture record, with the timestamp viewed as datetime64
+HISTORY_DTYPE = np.dtype([
+    ('timestamp', 'datetime64[ns]'),
+    ('power', '<f8'),
+    ('interval', '<f4'),
+])
+
+
+# Statistics available from DeviceHistory.statistics
+STATISTICS = ('length', 'mean', 'median', 'mode', 'min', 'max', 'stddev', 'percentiles', 'energy', 'raw_from')
+DEFAULT_PERCENTILES = (5, 25, 75, 95)
+
+# Default usage graph size in inches and dots per inch
+GRAPH_SIZE = (10, 8)
+GRAPH_DPI = 100
+
+# Statistics which can be combined from rollup tiers, the others need raw data points
+ROLLUP_STATISTICS = ('length', 'mean', 'min', 'max', 'energy')
+
+
+def integrate(history,
+              mode=None,
+              max_gap=None):
+    """
+    Energy used between consecutive data points, from the actual time between them
+    Gaps (capture stopped, device missed) and unknown power contribute no energy rather than
+    being interpolated across
+
+    trapezoid: Power changes linearly between data points
+    step: Power is held until the next data point
+
+    :param history: Data points
+    :param mode: "trapezoid" or "step", defaults to integration_mode in configuration
+    :param max_gap: Seconds between data points above which no energy is counted, defaults to
+        max_gap_intervals times the capture interval of the later data point
+    :return: usage_kwh: Energy in KiloWatt Hours used up to each data point (first is always 0)
+    """
+    if mode is None:
+        mode = bia_config.get('integration_mode', 'trapezoid')
+
+    usage_kwh = np.zeros(len(history))
+    if len(history) < 2:
+        return usage_kwh
+
+    power = history['power']
+    delta = np.diff(history['timestamp']).astype('int64') / 1e9  # seconds between data points
+
+    if max_gap is None:
+        max_gap = history['interval'][1:] * bia_config.get('max_gap_intervals', 2.5)
+
+    if mode == 'trapezoid':
+        segment_power = (power[:-1] + power[1:]) / 2
+    elif mode == 'step':
+        segment_power = power[:-1]
+    else:
+        raise ValueError(f"Unknown integration mode {mode}")
+
+    counted = (delta <= max_gap) & ~np.isnan(segment_power)
+    usage_kwh[1:] = np.where(counted, segment_power * delta, 0) / 3600 / 1000
+
+    return usage_kwh
+
+
+def power_segments(history,
+                   mode=None,
+                   max_gap=None) -> tuple:
+    """
+    Pieces of the power curve energy is counted for, between consecutive data points, see integrate
+    Power changes linearly over each segment, from start power to end power
+
+    :param history: Data points, sorted by timestamp
+    :param mode: "trapezoid" or "step", defaults to integration_mode in configuration
+    :param max_gap: Seconds between data points above which no energy is counted, see integrate
+    :return: starts, ends: Nanoseconds since epoch, start_power, end_power: Watts
+    """
+    if mode is None:
+        mode = bia_config.get('integration_mode', 'trapezoid')
+
+    if len(history) < 2:
+        empty = np.zeros(0, dtype='int64')
+        return empty, empty, np.zeros(0), np.zeros(0)
+
+    timestamps = history['timestamp'].astype('int64')
+    power = history['power']
+    delta = np.diff(timestamps) / 1e9
+
+    if max_gap is None:
+        max_gap = history['interval'][1:] * bia_config.get('max_gap_intervals', 2.5)
+
+    if mode == 'trapezoid':
+        start_power, end_power = power[:-1], power[1:]
+    elif mode == 'step':
+        start_power, end_power = power[:-1], power[:-1]
+    else:
+        raise ValueError(f"Unknown integration mode {mode}")
+
+    counted = (delta <= max_gap) & ~np.isnan(start_power) & ~np.isnan(end_power)
+
+    return timestamps[:-1][counted], timestamps[1:][counted], start_power[counted], end_power[counted]
+
+
+def power_coverage(history, previous_ns=None) -> tuple:
+    """
+    Time each data point with known power stands for, its interval up to its timestamp but not before the
+    data point before it. A deadband data point closing a flat stretch covers the whole stretch
+
+    :param history: Data points, sorted by timestamp
+    :param previous_ns: Timestamp of the data point before history, None if there is none
+    :return: starts, ends: Nanoseconds since epoch, power: Watts
+    """
+    timestamps = history['timestamp'].astype('int64')
+    starts = timestamps - (history['interval'].astype('f8') * 1e9).astype('int64')
+
+    previous = np.empty(len(history), dtype='int64')
+    previous[1:] = timestamps[:-1]
+    if len(previous):
+        previous[0] = np.iinfo(np.int64).min if previous_ns is None else previous_ns
+    starts = np.maximum(starts, previous)
+
+    known = ~np.isnan(history['power'])
+    return starts[known], timestamps[known], history['power'][known]
+
+
+def clip_spans(starts, ends, start_ns, end_ns) -> tuple:
+    """
+    Part of each time span within a time range
+
+    :param starts: Span starts, nanoseconds since epoch
+    :param ends: Span ends (exclusive)
+    :param start_ns: Start of range
+    :param end_ns: End of range (exclusive)
+    :return: piece_starts, piece_ends, inside: Spans overlapping the range
+    """
+    piece_starts = np.maximum(starts, start_ns)
+    piece_ends = np.minimum(ends, end_ns)
+
+    return piece_starts, piece_ends, piece_ends > piece_starts
+
+
+def split_spans(starts, ends, width, origin=0) -> tuple:
+    """
+    Split time spans where they cross bucket boundaries, multiples of width from origin
+
+    :param starts: Span starts, nanoseconds since epoch
+    :param ends: Span ends (exclusive)
+    :param width: Bucket width in nanoseconds
+    :param origin: Start of a bucket
+    :return: spans: Span of each piece, buckets: Start of the bucket of each piece, piece_starts, piece_ends
+    """
+    first = (starts - origin) // width
+    last = (ends - 1 - origin) // width
+    counts = np.where(ends > starts, last - first + 1, 0)
+
+    spans = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(len(spans)) - np.repeat(np.cumsum(counts) - counts, counts)
+    buckets = origin + (first[spans] + offsets) * width
+
+    return spans, buckets, np.maximum(starts[spans], buckets), np.minimum(ends[spans], buckets + width)
+
+
+def span_energy(starts, ends, start_power, end_power, piece_starts, piece_ends) -> np.ndarray:
+    """
+    Energy of part of power segments, see power_segments
+
+    :param starts: Segment starts, nanoseconds since epoch
+    :param ends: Segment ends
+    :param start_power: Power at segment starts
+    :param end_power: Power at segment ends
+    :param piece_starts: Start of part of each segment
+    :param piece_ends: End of part of each segment
+    :return: energy: KiloWatt Hours of each part
+    """
+    slope = (end_power - start_power) / np.maximum(ends - starts, 1)
+    power_from = start_power + slope * (piece_starts - starts)
+    power_to = start_power + slope * (piece_ends - starts)
+
+    return (piece_ends - piece_starts) / 1e9 * (power_from + power_to) / 2 / 3600 / 1000
+
+
+def weighted_percentiles(sorted_values, sorted_weights, percentiles) -> np.ndarray:
+    """
+    Percentiles of weighted values, interpolated between values like numpy.percentile
+    Each value spreads its weight evenly either side of it, with equal weights the result is the
+    same as numpy.percentile
+
+    :param sorted_values: Values, ascending
+    :param sorted_weights: Weight of each value
+    :param percentiles: Percentiles to calculate (0-100)
+    :return: values
+    """
+    positions = np.cumsum(sorted_weights) - (sorted_weights + sorted_weights[0]) / 2
+    if positions[-1] <= 0:
+        return np.full(len(percentiles), sorted_values[-1], dtype='f8')
+
+    return np.interp(np.asarray(percentiles) / 100 * positions[-1], positions, sorted_values)
+
+
+def bounds(start_time, end_time):
+    """
+    Convert an inclusive datetime range to nanoseconds since epoch, end exclusive
+
+    :param start_time: Start time, None for no limit
+    :param end_time: End time, None for no limit
+    :return: start_ns, end_ns
+    """
+    start_ns = storage.to_epoch_ns(start_time) if start_time is not None else np.iinfo(np.int64).min + 1
+    end_ns = storage.to_epoch_ns(end_time) + 1 if end_time is not None else np.iinfo(np.int64).max
+    end_ns = min(end_ns, np.iinfo(np.int64).max)
+
+    return int(start_ns), int(end_ns)
+
+
+def to_datetime64(time_captured) -> np.datetime64:
+    """
+    Convert a datetime to datetime64, clamping datetime.min/max to the datetime64 range
+
+    :param time_captured: Datetime
+    :return: datetime64
+    """
+    return np.datetime64(storage.to_epoch_ns(time_captured), 'ns')
+
+
+def _sorted(history) -> np.ndarray:
+    """
+    Data points sorted by timestamp
+    Captures are appended in order, so only sorted (copied) if the clock went backwards
+
+    :param history: Data points (HISTORY_DTYPE)
+    :return: history
+    """
+    timestamps = history['timestamp']
+    if len(history) > 1 and not np.all(timestamps[1:] >= timestamps[:-1]):
+        history = history[np.argsort(timestamps, kind='stable')]
+
+    return history
 
 
 class DeviceHistory:
     """
     Loads device historical data and provides processing operations
+    History is held sorted by timestamp, so time windows resolve to slices with a binary search
 
     device_uuid: ID fo device in inventory file
+    history: Already loaded data points (HISTORY_DTYPE) sorted by timestamp, e.g. from history_cache
+    timestamps: Contiguous copy of the history timestamps
     """
-    def __init__(self, device_uuid):
-        with open(f'data/{device_uuid}.csv', 'r', newline='') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
+    def __init__(self, device_uuid, history=None, timestamps=None):
+        if history is None:
+            history = _sorted(storage.load(device_uuid).view(HISTORY_DTYPE))  # Memory mapped, nothing parsed
 
-            history_data = []
-            for row in csv_reader:
-                row['timestamp'] = ciso8601.parse_datetime(row['timestamp'])
-                history_data.append(row)
+        # Binary searches over the strided timestamp field would copy it on every search
+        if timestamps is None:
+            timestamps = np.ascontiguousarray(history['timestamp'])
 
-        self._history = np.array(history_data)
+        self._device_uuid = device_uuid
+        self._history = history
+        self._timestamps = timestamps
+        self._rollups = {}
+        self._retained = {}
 
     def __len__(self) -> int:
         """
@@ -57,130 +304,619 @@ class DeviceHistory:
 
         :return: mean: Mean power consumption
         """
-        power_values = self.history(start_time, end_time)[:, 1]
-
-        return stats.mean(power_values)
+        return self.statistics(start_time, end_time, names=('mean',))['mean']
 
-    def mode(self) -> float:
+    def mode(self,
+             start_time=None,
+             end_time=None) -> float:
         """
         Modal power consumption
 
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
         :return: mode: Modal power consumption
         """
-        power_captured = [float(capture['power']) for capture in self._history]
+        return self.statistics(start_time, end_time, names=('mode',))['mode']
 
-        return stats.mode(power_captured)
-
-    def median(self) -> float:
+    def median(self,
+               start_time=None,
+               end_time=None) -> float:
         """
         Median power consumption
 
-        :return: median: Modal power consumption
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
+        :return: median: Median power consumption
+        """
+        return self.statistics(start_time, end_time, names=('median',))['median']
+
+    def min(self,
+            start_time=None,
+            end_time=None) -> float:
+        """
+        Minimum power consumption
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
+        :return: min: Minimum power consumption
+        """
+        return self.statistics(start_time, end_time, names=('min',))['min']
+
+    def max(self,
+            start_time=None,
+            end_time=None) -> float:
+        """
+        Maximum power consumption
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
+        :return: max: Maximum power consumption
+        """
+        return self.statistics(start_time, end_time, names=('max',))['max']
+
+    def stddev(self,
+               start_time=None,
+               end_time=None) -> float:
         """
-        power_captured = [float(capture['power']) for capture in self._history]
+        Standard deviation of power consumption
 
-        return stats.median(power_captured)
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
+        :return: stddev: Standard deviation of power consumption
+        """
+        return self.statistics(start_time, end_time, names=('stddev',))['stddev']
+
+    def percentiles(self,
+                    start_time=None,
+                    end_time=None,
+                    percentiles=DEFAULT_PERCENTILES) -> dict:
+        """
+        Percentiles of power consumption
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+        :param percentiles: Percentiles to calculate (0-100)
+
+        :return: percentiles: Dictionary of percentile to power consumption
+        """
+        return self.statistics(start_time, end_time, names=('percentiles',), percentiles=percentiles)['percentiles']
+
+    def statistics(self,
+                   start_time=None,
+                   end_time=None,
+                   names=STATISTICS,
+                   percentiles=DEFAULT_PERCENTILES) -> dict:
+        """
+        Calculate several statistics at once over a single time window
+        Power values are only sorted once, shared by median, mode and percentiles
+        Data points with unknown power are ignored, statistics are None if no power is known
+
+        Power statistics are weighted by the seconds each data point covers within the window (its
+        interval, see power_coverage), so a deadband data point standing for a long flat stretch counts
+        for the part of it in the window. Energy is clipped to the window the same way. Length is the
+        number of stored data points, deadband devices store fewer than they poll
+
+        Length, mean, min, max and energy are combined from rollups (see plan), so they cover the whole
+        window after raw data points have expired (see retention). Median, mode, stddev and percentiles
+        need raw data points and only cover the part of the window still kept, raw_from gives where that
+        part starts if retention cut the window short
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+        :param names: Statistics to calculate, see STATISTICS
+        :param percentiles: Percentiles to calculate (0-100) if "percentiles" requested
+
+        :return: statistics: Dictionary of statistic name to value
+        """
+        start_ns, end_ns = bounds(start_time, end_time)
+        results = self._rollup_statistics(start_time, end_time, set(names) & set(ROLLUP_STATISTICS))
+
+        retained = self.retained_from('raw')
+        if retained is not None and start_ns < retained:
+            start_ns = retained
+            results['raw_from'] = storage.from_epoch_ns(retained)
+        else:
+            results['raw_from'] = None
+
+        if not set(names) - set(ROLLUP_STATISTICS) - {'raw_from'}:
+            return {name: results[name] for name in names}
+
+        _, power, seconds, history = self._clipped(start_ns, end_ns)
+        if np.sum(seconds) <= 0:
+            # Nothing covers any time, e.g. a window holding a single data point
+            power = history['power'][~np.isnan(history['power'])]
+            seconds = np.ones(len(power))
+
+        if len(power) == 0:
+            return {name: results.get(name) for name in names}
+
+        if 'stddev' in names:
+            mean = np.sum(power * seconds) / np.sum(seconds)
+            results['stddev'] = float(np.sqrt(np.sum((power - mean) ** 2 * seconds) / np.sum(seconds)))
+
+        if {'median', 'mode', 'percentiles'} & set(names):
+            order = np.argsort(power, kind='stable')
+            sorted_power = power[order]
+            sorted_seconds = seconds[order]
+
+            if 'median' in names or 'percentiles' in names:
+                quantiles = weighted_percentiles(sorted_power, sorted_seconds, [50, *percentiles])
+                results['median'] = float(quantiles[0])
+                results['percentiles'] = dict(zip(percentiles, quantiles[1:].tolist()))
+
+            if 'mode' in names:
+                # Run of equal values in sorted power covering the most time
+                run_starts = np.flatnonzero(np.diff(sorted_power, prepend=np.nan) != 0)
+                run_seconds = np.add.reduceat(sorted_seconds, run_starts)
+                results['mode'] = float(sorted_power[run_starts[np.argmax(run_seconds)]])
+
+        return {name: results[name] for name in names}
+
+    def around(self,
+               start_ns,
+               end_ns):
+        """
+        Data points from the one before start up to the one after end, as a view
+        Energy of the first data point in range is integrated from the one before it, the interval
+        of the one after it can reach back into the range
+
+        :param start_ns: Start, nanoseconds since epoch
+        :param end_ns: End (exclusive), nanoseconds since epoch
+
+        :return: history : Filtered data points
+        """
+        start_index, end_index = np.searchsorted(self._timestamps,
+                                                 np.array([start_ns, end_ns], dtype='datetime64[ns]'))
+
+        return self._history[max(start_index - 1, 0):max(start_index, end_index) + 1]
+
+    def _clipped(self,
+                 start_ns,
+                 end_ns,
+                 mode=None,
+                 max_gap=None) -> tuple:
+        """
+        Energy and power of raw data points within a time range, clipped to its edges
+
+        :param start_ns: Start, nanoseconds since epoch
+        :param end_ns: End (exclusive), nanoseconds since epoch
+        :param mode: "trapezoid" or "step", see integrate
+        :param max_gap: Seconds between data points above which no energy is counted
+
+        :return: energy: KiloWatt Hours, power, seconds: Power of data points covering part of the range and
+            seconds of it covered (see power_coverage), history: Data points in range
+        """
+        around = self.around(start_ns, end_ns)
+
+        segment_starts, segment_ends, start_power, end_power = power_segments(around, mode, max_gap)
+        piece_starts, piece_ends, inside = clip_spans(segment_starts, segment_ends, start_ns, end_ns)
+        energy = np.sum(span_energy(segment_starts[inside], segment_ends[inside], start_power[inside],
+                                    end_power[inside], piece_starts[inside], piece_ends[inside]))
+
+        cover_starts, cover_ends, power = power_coverage(around)
+        piece_starts, piece_ends, inside = clip_spans(cover_starts, cover_ends, start_ns, end_ns)
+
+        return (float(energy), power[inside], (piece_ends - piece_starts)[inside] / 1e9,
+                self.between(start_ns, end_ns))
+
+    def rollups(self, tier) -> np.ndarray:
+        """
+        Rollup records of a tier (see storage.TIER_WIDTHS), memory mapped on first use
+
+        :param tier: Rollup tier
+        :return: rollups
+        """
+        if tier not in self._rollups:
+            self._rollups[tier] = storage.load(self._device_uuid, tier)
+
+        return self._rollups[tier]
+
+    def retained_from(self, tier='raw'):
+        """
+        Start of the data kept for a tier, older data has been removed by compaction (see retention)
+
+        :param tier: Storage tier
+        :return: retained_from: Nanoseconds since epoch, None if nothing has been removed
+        """
+        if tier not in self._retained:
+            self._retained[tier] = storage.retained_from(self._device_uuid, tier)
+
+        return self._retained[tier]
+
+    def extent(self) -> tuple:
+        """
+        Time range covered by raw data and rollups, rollups reach further back once raw data has expired
+
+        :return: start_ns, end_ns: Nanoseconds since epoch, end exclusive, (0, 0) if there is no data
+        """
+        firsts = [int(self._timestamps[0].astype('int64'))] if len(self._history) else []
+        for tier in storage.TIER_WIDTHS:
+            rollups = self.rollups(tier)
+            if len(rollups):
+                firsts.append(int(rollups['timestamp'][0]))
+
+        if len(firsts) == 0:
+            return 0, 0
+
+        if len(self._history):
+            end_ns = int(self._timestamps[-1].astype('int64')) + 1
+        else:
+            end_ns = max(int(self.rollups(tier)['timestamp'][-1]) + width
+                         for tier, width in storage.TIER_WIDTHS.items() if len(self.rollups(tier)))
+
+        return min(firsts), end_ns
+
+    def plan(self,
+             start_ns,
+             end_ns,
+             tiers=None) -> list:
+        """
+        Split a time range into pieces answered by the coarsest rollup tier that fits
+        Whole buckets come from the tier, the ragged edges from finer tiers and finally raw data.
+        Where raw data has expired the finest rollup tier still kept takes its place
+
+        :param start_ns: Start of range, nanoseconds since epoch
+        :param end_ns: End of range (exclusive), nanoseconds since epoch
+        :param tiers: Tiers to use, coarsest first, defaults to all
+        :return: pieces: List of (tier, start_ns, end_ns), "raw" for raw data
+        """
+        if tiers is None:
+            tiers = list(reversed(storage.TIER_WIDTHS))
+
+        retained = self.retained_from('raw')
+        if retained is None or start_ns >= retained:
+            return self._plan(start_ns, end_ns, tiers)
+
+        return (self._expired_plan(start_ns, min(end_ns, retained), tiers, list(storage.TIER_WIDTHS)) +
+                self._plan(max(start_ns, retained), end_ns, tiers))
+
+    def _plan(self,
+              start_ns,
+              end_ns,
+              tiers,
+              leaf='raw') -> list:
+        """
+        Split a time range into pieces, see plan
+
+        :param start_ns: Start of range, nanoseconds since epoch
+        :param end_ns: End of range (exclusive), nanoseconds since epoch
+        :param tiers: Tiers to use, coarsest first
+        :param leaf: Tier answering whatever no tier in tiers covers
+        :return: pieces: List of (tier, start_ns, end_ns)
+        """
+        if start_ns >= end_ns:
+            return []
+
+        if len(tiers) == 0:
+            if leaf != 'raw':
+                # Buckets partly in range are only counted if they are mostly in range
+                width = storage.TIER_WIDTHS[leaf]
+                start_ns = (start_ns + width // 2) // width * width
+                end_ns = (end_ns + width // 2) // width * width
+                if start_ns >= end_ns:
+                    return []
+
+            return [(leaf, start_ns, end_ns)]
+
+        tier = tiers[0]
+        width = storage.TIER_WIDTHS[tier]
+        rollups = self.rollups(tier)
+
+        if len(rollups) == 0:
+            return self._plan(start_ns, end_ns, tiers[1:], leaf)
+
+        # Only buckets written so far, the bucket being filled is answered from finer data
+        covered_end = int(rollups['timestamp'][-1]) + width
+        first_bucket = max(-(-start_ns // width) * width, self.retained_from(tier) or 0)
+        last_bucket = min(end_ns // width * width, covered_end)
+
+        if first_bucket >= last_bucket:
+            return self._plan(start_ns, end_ns, tiers[1:], leaf)
+
+        return (self._plan(start_ns, first_bucket, tiers[1:], leaf) +
+                [(tier, first_bucket, last_bucket)] +
+                self._plan(last_bucket, end_ns, tiers[1:], leaf))
+
+    def _expired_plan(self,
+                      start_ns,
+                      end_ns,
+                      tiers,
+                      fallbacks) -> list:
+        """
+        Split a time range raw data has expired from into pieces, the finest fallback tier still
+        kept answers the ragged edges. Where it has expired too the next coarser one is used
+
+        :param start_ns: Start of range, nanoseconds since epoch
+        :param end_ns: End of range (exclusive), nanoseconds since epoch
+        :param tiers: Tiers to use for whole buckets, coarsest first
+        :param fallbacks: Rollup tiers to answer ragged edges, finest first
+        :return: pieces: List of (tier, start_ns, end_ns)
+        """
+        if start_ns >= end_ns or len(fallbacks) == 0:
+            return []
+
+        leaf = fallbacks[0]
+        coarser = [tier for tier in tiers if storage.TIER_WIDTHS[tier] > storage.TIER_WIDTHS[leaf]]
+        retained = self.retained_from(leaf)
+
+        if retained is None or retained <= start_ns:
+            return self._plan(start_ns, end_ns, coarser, leaf)
+
+        return (self._expired_plan(start_ns, min(end_ns, retained), tiers, fallbacks[1:]) +
+                self._plan(max(start_ns, retained), end_ns, coarser, leaf))
+
+    def _rollup_statistics(self,
+                           start_time,
+                           end_time,
+                           names) -> dict:
+        """
+        Calculate statistics that can be combined from rollups, see plan
+        Gives the same result as calculating over raw data points, without touching most of them.
+        Where raw data points have expired length counts those with known power, as rollups do
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+        :param names: Statistics to calculate, see ROLLUP_STATISTICS
+
+        :return: statistics: Dictionary of statistic name to value
+        """
+        start_ns, end_ns = bounds(start_time, end_time)
+        retained = self.retained_from('raw')
+
+        energy = 0.0
+        total = 0.0
+        seconds = 0.0  # Covered by data points with known power, see ROLLUP_DTYPE
+        count = 0
+        known_total = 0.0  # Sum of known power, for a mean of data points not covering any time
+        expired = 0  # Data points only known from rollups
+        minimum = np.inf
+        maximum = -np.inf
+
+        for tier, piece_start, piece_end in self.plan(start_ns, end_ns):
+            if tier == 'raw':
+                piece_energy, power, piece_seconds, records = self._clipped(piece_start, piece_end)
+                known = records['power'][~np.isnan(records['power'])]
+
+                energy += piece_energy
+                total += np.sum(power * piece_seconds)
+                seconds += np.sum(piece_seconds)
+                count += len(known)
+                known_total += np.sum(known)
+                minimum = min(minimum, np.min(power, initial=np.inf), np.min(known, initial=np.inf))
+                maximum = max(maximum, np.max(power, initial=-np.inf), np.max(known, initial=-np.inf))
+            else:
+                rollups = self.rollups(tier)
+                start_index, end_index = np.searchsorted(rollups['timestamp'], [piece_start, piece_end])
+                rollups = rollups[start_index:end_index]
+
+                energy += np.sum(rollups['energy'])
+                total += np.nansum(rollups['mean'] * rollups['seconds'])
+                seconds += np.sum(rollups['seconds'])
+                count += int(np.sum(rollups['count']))
+                minimum = np.fmin(minimum, np.nanmin(rollups['min'], initial=np.inf))
+                maximum = np.fmax(maximum, np.nanmax(rollups['max'], initial=-np.inf))
+                if retained is not None and piece_end <= retained:
+                    expired += int(np.sum(rollups['count']))
+
+        results = {
+            'length': expired + len(self.between(start_ns if retained is None else max(start_ns, retained), end_ns)),
+            'energy': float(energy),
+            'mean': float(total / seconds) if seconds else float(known_total / count) if count else None,
+            'min': float(minimum) if np.isfinite(minimum) else None,
+            'max': float(maximum) if np.isfinite(maximum) else None,
+        }
+
+        return {name: results[name] for name in names}
 
     def raw_data(self):
         """
-        Get raw historic data
+        Iterate raw historic data, one data point at a time
 
-        :return: data : List of history in raw data form
+        :return: data : Generator of history in raw data form
         """
-        return self._history.tolist()
+        for capture in self._history:
+            yield _data_point(capture)
+
+    def window(self,
+               start_time=None,
+               end_time=None):
+        """
+        Index range of data points between start and end time (inclusive)
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+
+        :return: start_index, end_index
+        """
+        start_index = 0
+        end_index = len(self._timestamps)
+
+        if start_time is not None:
+            start_index = int(np.searchsorted(self._timestamps, to_datetime64(start_time), side='left'))
+
+        if end_time is not None:
+            end_index = int(np.searchsorted(self._timestamps, to_datetime64(end_time), side='right'))
+
+        return start_index, max(start_index, end_index)
 
     def history(self,
                 start_time=None,
                 end_time=None):
         """
-        Used to parse all data points and convert to python objects
-        Can be filtered by start and end date
+        Data points filtered by start and end date
+        Returned as a view (no copy) with timestamp, power and interval columns. Only raw data points still
+        kept are returned, older ones have expired to rollups (see retained_from)
 
         :param start_time: Start time to filter data points
         :param end_time: End time to filter data points
 
         :return: history : Filtered data points
         """
-        # If no start_time passed
-        if start_time is None:
-            start_time = datetime.datetime.min
+        start_index, end_index = self.window(start_time, end_time)
 
-        if end_time is None:
-            end_time = datetime.datetime.max
+        return self._history[start_index:end_index]
 
-        history_data = []
-        for capture in self._history:
-            if end_time >= capture['timestamp'] >= start_time:
-                history_data.append([
-                    capture['timestamp'],
-                    float(capture['power']),
-                    capture['interval']
-                ])
-
-        if len(history_data) == 0:
-            return np.zeros((0, 4), dtype='float') # incase no captures yet
-        else:
-            return np.array(history_data)
+    def between(self,
+                start_ns,
+                end_ns):
+        """
+        Data points from start up to (not including) end, as a view
+
+        :param start_ns: Start, nanoseconds since epoch
+        :param end_ns: End (exclusive), nanoseconds since epoch
+
+        :return: history : Filtered data points
+        """
+        start_index, end_index = np.searchsorted(self._timestamps,
+                                                 np.array([start_ns, end_ns], dtype='datetime64[ns]'))
+
+        return self._history[start_index:max(start_index, end_index)]
 
     def usage(self,
               start_time=None,
-              end_time=None):
+              end_time=None,
+              mode=None,
+              max_gap=None):
         """
         Return calculate usage
-        Uses "time_interval" as capture time and adds up all usage in these times
-        Will change to use an "area under the graph" type calculation in future
+        Area under the graph between each data point and the one before it, see integrate.
+        Only covers raw data points still kept, see retained_from and sum_usage
 
         :param start_time: Start time to filter data points
         :param end_time: End time to filter data points
+        :param mode: "trapezoid" or "step"
+        :param max_gap: Seconds between data points above which no energy is counted
 
-        :return usage_kwh: Usage in KiloWatt Hours
+        :return usage_kwh: Usage in KiloWatt Hours and seconds covered, for each data point
         """
-        usage_kwh = []
-
-        for capture in self.history(start_time, end_time):
-            power = float(capture[1])  # measured in watts
-            interval = int(capture[2])  # measured in seconds
-
-            # convert interval ot hours
-            interval_hour = interval / 3600
+        history = self.history(start_time, end_time)
 
-            usage_kwh.append([((power * interval_hour) / 1000), interval])
+        seconds = np.zeros(len(history))
+        seconds[1:] = np.diff(history['timestamp']).astype('int64') / 1e9
 
-        return np.array(usage_kwh)
+        return np.column_stack((integrate(history, mode, max_gap), seconds))
 
     def sum_usage(self,
                   start_time=None,
-                  end_time=None):
+                  end_time=None,
+                  mode=None,
+                  max_gap=None) -> float:
         """
         Calculate usage for a given timeperiod
-        Uses "time_interval" as capture time and adds up all usage in these times
+        Combined from rollups where raw data points have expired, unless integrated with a mode or max_gap
+        other than the configured ones, which needs raw data points
 
-        :return:
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+        :param mode: "trapezoid" or "step"
+        :param max_gap: Seconds between data points above which no energy is counted
+
+        :return: usage_kwh: Usage in KiloWatt Hours
+        """
+        if mode is None and max_gap is None:
+            return self._rollup_statistics(start_time, end_time, names=('energy',))['energy']
+
+        return self._clipped(*bounds(start_time, end_time), mode, max_gap)[0]
+
+    def series(self,
+               start_time=None,
+               end_time=None,
+               points=None,
+               envelope=False):
         """
-        total_usage = self.usage(start_time, end_time)
+        Power over time, from the coarsest rollup tier still giving at least points values
+        Rollup buckets are placed at their midpoint with their mean power
+
+        :param start_time: Start time to filter data points
+        :param end_time: End time to filter data points
+        :param points: Resolution wanted, None for raw data points
+        :param envelope: Use min and max of rollup buckets instead of mean, so spikes are kept
+
+        :return: timestamps, power
+        """
+        history = self.history(start_time, end_time)
+        start_ns, end_ns = bounds(start_time, end_time)
+        expired = self.retained_from('raw') is not None and start_ns < self.retained_from('raw')
 
-        return sum(total_usage)
+        if points is None or (len(history) <= points and not expired):
+            return history['timestamp'], history['power']
+
+        if expired:
+            # Older power is only known from rollups
+            first_ns, last_ns = self.extent()
+            start_ns, end_ns = max(start_ns, first_ns), min(end_ns, last_ns)
+        else:
+            start_ns = int(history['timestamp'][0].astype('int64'))
+            end_ns = int(history['timestamp'][-1].astype('int64')) + 1
+
+        tiers = [tier for tier, width in reversed(storage.TIER_WIDTHS.items()) if width * points <= end_ns - start_ns]
+        if len(tiers) == 0 and not expired:
+            return history['timestamp'], history['power']
+
+        timestamps = []
+        power = []
+        for tier, piece_start, piece_end in self.plan(start_ns, end_ns, tiers[:1]):
+            if tier == 'raw':
+                piece = history[np.searchsorted(history['timestamp'], np.datetime64(piece_start, 'ns')):
+                                np.searchsorted(history['timestamp'], np.datetime64(piece_end, 'ns'))]
+                timestamps.append(piece['timestamp'])
+                power.append(piece['power'])
+            else:
+                rollups = self.rollups(tier)
+                start_index, end_index = np.searchsorted(rollups['timestamp'], [piece_start, piece_end])
+                rollups = rollups[start_index:end_index]
+                midpoints = (rollups['timestamp'] + storage.TIER_WIDTHS[tier] // 2).astype('datetime64[ns]')
+                if envelope:
+                    timestamps.append(np.repeat(midpoints, 2))
+                    power.append(np.column_stack((rollups['min'], rollups['max'])).ravel())
+                else:
+                    timestamps.append(midpoints)
+                    power.append(rollups['mean'])
+
+        if len(timestamps) == 0:
+            return history['timestamp'], history['power']
+
+        return np.concatenate(timestamps), np.concatenate(power)
 
     def usage_graph(self,
                     start_time=None,
-                    end_time=None):
+                    end_time=None,
+                    size=GRAPH_SIZE,
+                    dpi=GRAPH_DPI,
+                    method=None):
         """
         Create a matplotlib graph, showing usage
+        Downsampled to one point per horizontal pixel, so render cost depends on figure size only
 
         :param start_time: Start time to filter data points
         :param end_time: End time to filter data points
+        :param size: Figure size in inches (width, height)
+        :param dpi: Figure dots per inch
+        :param method: Downsampling method, "lttb" or "minmax", defaults to graph_downsample in configuration
 
         :return: usage_graph: Graph showing device power usage
         """
-        history = self.history(start_time, end_time)
-        np_history = history[:, 1]
-        np_time = history[:, 0]
+        if method is None:
+            method = bia_config.get('graph_downsample', 'lttb')
+
+        points = int(size[0] * dpi)
+        np_time, np_history = self.series(start_time, end_time, points=points, envelope=(method == 'minmax'))
+        np_time, np_history = downsample(np_time, np_history, points, method)
 
-        fig = plt.figure(figsize=(10, 8))
-        plt.xticks(rotation=40)
-        plt.plot(np_time, np_history)
-        plt.xlabel('Timestamp')
-        plt.ylabel('Watt')
+        # Figure used directly rather than through pyplot, so graphs can be drawn from any thread
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=size, dpi=dpi)
+        ax = fig.subplots()
+        ax.tick_params(axis='x', labelrotation=40)
+        ax.plot(np_time, np_history)
+        ax.set_xlabel('Timestamp')
+        ax.set_ylabel('Watt')
 
         return fig
 
@@ -195,25 +931,309 @@ class DeviceHistory:
         else:
             return False
 
-def get_all_data_points():
+
+class _CachedHistory:
+    """
+    Data points of a device held in memory by HistoryCache
+
+    buffer: Data points, sorted by timestamp, with spare capacity for appended records
+    length: Number of data points in buffer
+    segments: (inode, records read) of each segment read so far
+    timestamps: Contiguous copy of buffer timestamps, copied from buffer if not given
+    """
+    def __init__(self, buffer, length, segments, timestamps=None):
+        if timestamps is None:
+            timestamps = np.ascontiguousarray(buffer['timestamp'])
+
+        self.buffer = buffer
+        self.timestamps = timestamps
+        self.length = length
+        self.segments = segments
+        self.device_history = None  # Built on first access after each read
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by entry
+
+        :return: nbytes
+        """
+        return self.buffer.nbytes + self.timestamps.nbytes
+
+    def tail(self, states):
+        """
+        Ranges of records appended since last read
+
+        :param states: Current segment states, see storage.segment_states
+        :return: ranges: List of (segment index, start record, stop record), None if a segment was rewritten
+        """
+        if len(states) < len(self.segments):
+            return None
+
+        ranges = []
+        for index, (_, inode, size) in enumerate(states):
+            stop_record = size // storage.RECORD_DTYPE.itemsize
+            start_record = 0
+            if index < len(self.segments):
+                read_inode, start_record = self.segments[index]
+                if inode != read_inode or stop_record < start_record:
+                    return None
+
+            if stop_record > start_record:
+                ranges.append((index, start_record, stop_record))
+
+        return ranges
+
+
+class HistoryCache:
+    """
+    Process wide cache of device data points, so repeated views of a device do not reload its history
+    Each device remembers how far into each segment it has read, later accesses only read the
+    appended tail. Least recently used devices are evicted once max_bytes is exceeded
+
+    Segments are read under a lock per device, only publishing the result takes the cache wide lock,
+    so a slow read of one device does not hold up lookups of others
+
+    max_bytes: Total size of cached data points
+    """
+    def __init__(self, max_bytes):
+        self._lock = Lock()
+        self._device_locks = {}  # device ID -> Lock held while reading its segments
+        self._entries = OrderedDict()  # device ID -> _CachedHistory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0  # Served from memory, at most reading the appended tail
+        self.misses = 0
+
+    def get(self, device_id) -> DeviceHistory:
+        """
+        Up to date history of a device
+
+        :param device_id: Device ID
+        :return: device_history
+        """
+        device_id = str(device_id)
+
+        with self._device_lock(device_id):
+            with self._lock:
+                cached = self._entries.get(device_id)
+
+            states = storage.segment_states(device_id)
+
+            entry = cached
+            if entry is not None:
+                ranges = entry.tail(states)
+                if ranges is None:
+                    entry = None  # Segments rewritten
+                elif ranges:
+                    entry = self._extend(entry, states, ranges)
+
+            hit = entry is not None
+            if entry is None:
+                entry = self._load(states)
+
+            if entry.device_history is None:
+                entry.device_history = DeviceHistory(device_id,
+                                                     entry.buffer[:entry.length],
+                                                     entry.timestamps[:entry.length])
+
+            with self._lock:
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+
+                if cached is not None and self._entries.get(device_id) is cached:
+                    del self._entries[device_id]
+                    self.size -= cached.nbytes
+
+                if entry.nbytes <= self.max_bytes:
+                    self._entries[device_id] = entry
+                    self.size += entry.nbytes
+
+                    while self.size > self.max_bytes:
+                        _, evicted = self._entries.popitem(last=False)
+                        self.size -= evicted.nbytes
+
+            return entry.device_history
+
+    def invalidate(self, device_id):
+        """
+        Drop cached history of a device, e.g. once deleted
+
+        :param device_id: Device ID
+        """
+        device_id = str(device_id)
+
+        with self._device_lock(device_id):
+            with self._lock:
+                entry = self._entries.pop(device_id, None)
+                if entry is not None:
+                    self.size -= entry.nbytes
+
+    def _device_lock(self, device_id) -> Lock:
+        """
+        Lock serialising reads of a devices segments
+
+        :param device_id: Device ID
+        :return: lock
+        """
+        with self._lock:
+            return self._device_locks.setdefault(device_id, Lock())
+
+    @staticmethod
+    def _load(states) -> _CachedHistory:
+        """
+        Read all segments of a device
+
+        :param states: Segment states, see storage.segment_states
+        :return: entry
+        """
+        segments = []
+        records = []
+        for path, inode, size in states:
+            stop_record = size // storage.RECORD_DTYPE.itemsize
+            records.append(storage.read_segment(path, 0, stop_record))
+            segments.append((inode, stop_record))
+
+        if records:
+            history = _sorted(np.concatenate(records).view(HISTORY_DTYPE))
+        else:
+            history = np.zeros(0, dtype=HISTORY_DTYPE)
+
+        return _CachedHistory(history, len(history), segments)
+
+    def _extend(self, entry, states, ranges) -> _CachedHistory:
+        """
+        Read appended records into an entry, growing its buffer geometrically
+
+        :param entry: Cached entry
+        :param states: Current segment states
+        :param ranges: Appended ranges, see _CachedHistory.tail
+        :return: entry: New entry sharing the buffer of entry where it has room, or a reloaded one if
+            appended records are out of order. Entry itself is left unchanged, it may still be cached
+        """
+        appended = np.concatenate([storage.read_segment(states[index][0], start_record, stop_record)
+                                   for index, start_record, stop_record in ranges]).view(HISTORY_DTYPE)
+
+        timestamps = appended['timestamp']
+        if (np.any(timestamps[1:] < timestamps[:-1]) or
+                (entry.length and timestamps[0] < entry.buffer['timestamp'][entry.length - 1])):
+            return self._load(states)  # Clock went backwards
+
+        buffer = entry.buffer
+        timestamps = entry.timestamps
+        length = entry.length + len(appended)
+        if length > len(buffer):
+            capacity = max(length, 2 * len(buffer))
+            buffer = np.zeros(capacity, dtype=HISTORY_DTYPE)
+            buffer[:entry.length] = entry.buffer[:entry.length]
+            timestamps = np.zeros(capacity, dtype=entry.timestamps.dtype)
+            timestamps[:entry.length] = entry.timestamps[:entry.length]
+
+        # Existing views only cover data points before entry.length, so filling beyond it is safe
+        buffer[entry.length:length] = appended
+        timestamps[entry.length:length] = appended['timestamp']
+
+        segments = list(entry.segments)
+        for index, _, stop_record in ranges:
+            if index < len(segments):
+                segments[index] = (segments[index][0], stop_record)
+            else:
+                segments.append((states[index][1], stop_record))
+
+        return _CachedHistory(buffer, length, segments, timestamps)
+
+
+def _data_point(capture) -> dict:
     """
-    Return all energy data points in each data folder
-    Used primarily for controls page
+    Convert a stored capture record to a raw data point
 
-    :return: data_points
+    :param capture: Capture record
+    :return: data_point
     """
+    return {
+        'timestamp': storage.from_epoch_ns(capture['timestamp'].astype('int64')).isoformat(),
+        'power': float(capture['power']),
+        'interval': float(capture['interval']),
+    }
 
-    data_points = []
 
-    # get all data points
-    directory = os.fsencode('data')
+def page_data_points(device_ids=None,
+                     after=None,
+                     limit=1000):
+    """
+    One page of data points, ordered by device then timestamp
+    Only indexes are worked out, records stay memory mapped until the page is iterated
+
+    :param device_ids: Devices to include, defaults to all devices with stored data
+    :param after: Cursor (device ID, timestamp in nanoseconds, data points with that timestamp sent) of the
+        last data point of the previous page
+    :param limit: Maximum data points in page
+
+    :return: page: List of (device ID, records), next_cursor: None if there are no more data points
+    """
+    if device_ids is None:
+        device_ids = storage.list_series()
+
+    page = []
+    next_cursor = None
+    remaining = limit
+
+    for device_id in sorted(str(device_id) for device_id in device_ids):
+        if after is not None and device_id < after[0]:
+            continue
+
+        device_history = DeviceHistory(device_id)
+        timestamps = device_history._timestamps
+        start_index = 0
+        if after is not None and device_id == after[0]:
+            # Data points sharing a timestamp can be split across pages, skip those already sent
+            after_timestamp = np.datetime64(after[1], 'ns')
+            first_index = int(np.searchsorted(timestamps, after_timestamp, side='left'))
+            end_index = int(np.searchsorted(timestamps, after_timestamp, side='right'))
+            start_index = min(first_index + after[2], end_index)
+
+        records = device_history._history[start_index:start_index + remaining]
+        if len(records) == 0:
+            continue
+
+        page.append((device_id, records))
+        remaining -= len(records)
+
+        if remaining == 0:
+            last_timestamp = records['timestamp'][-1]
+            sent = start_index + len(records) - int(np.searchsorted(timestamps, last_timestamp, side='left'))
+            next_cursor = (device_id, int(last_timestamp.astype('int64')), sent)
+            break
+
+    return page, next_cursor
 
-    for device_data in os.listdir(directory):
-        with open(f'data/{device_data.decode("utf-8")}', 'r', newline='') as csv_file:
-            csv_reader = csv.DictReader(csv_file)
 
-            for row in csv_reader:
-                row['device'] = device_data.decode("utf-8")
-                data_points.append(row)
+def iter_data_points(page):
+    """
+    Iterate the data points of a page, see page_data_points
+
+    :param page: List of (device ID, records)
+    :return: data_points: Generator of data points, including device ID
+    """
+    for device_id, records in page:
+        for capture in records:
+            data_point = _data_point(capture)
+            data_point['device'] = device_id
+            yield data_point
+
+
+def get_all_data_points():
+    """
+    Iterate all energy data points in the data folder, device by device
+    Nothing is held in memory beyond the current data point
+
+    :return: data_points: Generator of data points
+    """
+    page, _ = page_data_points(limit=np.iinfo(np.int64).max)
+    yield from iter_data_points(page)
+
 
-    return data_points
+history_cache = HistoryCache(bia_config.get('history_cache_bytes', 256 * 1024 * 1024))
+metrics.register_cache('history', history_cache)
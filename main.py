@@ -1,25 +1,46 @@
-import history
+from aggregate import fleet_statistics
 from devices import DeviceType
 from devices import device_factory
 from devices import get_devices
 from devices import delete_device
+from export import FORMATS
+from export import decode_cursor
+from export import encode_cursor
+from export import stream
 from capture import snapshot
-from capture import Periodic
-from history import DeviceHistory
+from capture import refresh_status
+from capture import capture_sched
+from capture import device_sched
+from capture import flush_deadband
+from capture import deadband_filter
+from capture import status_sched
+from graphs import RenderQueueFull
+from graphs import usage_graph_png
+from history import history_cache
+from history import page_data_points
+from metrics import CONTENT_TYPE
+from metrics import poll_traces
+from metrics import registry
+from profiling import init_app
+from profiling import render_template
+from profiling import timed
+from retention import compact_sched
+from rollups import rollup_writer
+from status import status_cache
 
 import datetime
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from flask import Flask, render_template, request, redirect, Response
+import os
+import threading
+from flask import Flask, request, redirect, Response
 import yaml
 import json
-import io
 
 # Read configuration
 with open('configuration.yaml', 'r') as config_file:
     bia_config = yaml.safe_load(config_file)
 
 app = Flask(__name__)
-capture_sched = Periodic(bia_config['time_interval'], snapshot)
+init_app(app)  # Server-Timing headers, see profiling
 
 
 @app.route('/')
@@ -27,8 +48,12 @@ capture_sched = Periodic(bia_config['time_interval'], snapshot)
 def devices():
     """
     Provide details on all devices
+    Live values come from the status cache, devices are not contacted while rendering
     """
-    return render_template('devices.html', devices=get_devices())
+    with timed('inventory'):
+        all_devices = get_devices()
+
+    return render_template('devices.html', devices=all_devices, statuses=status_cache.all())
 
 
 @app.route('/device/<device_id>', methods=['GET', 'POST', 'DELETE'])
@@ -55,11 +80,21 @@ def device(
             end_time = datetime.datetime.max
             end_time_raw = end_time.strftime('%Y-%m-%dT%H:%M')
 
-        device_history = DeviceHistory(device_id)
+        with timed('inventory'):
+            inventory_device = get_devices(device_id)
+
+        with timed('history'):
+            device_history = history_cache.get(device_id)
+
+        stat_names = ('energy', 'mean', 'length', 'raw_from')
+        with timed('stats', ', '.join(stat_names)):
+            device_stats = device_history.statistics(start_time, end_time, names=stat_names)
 
         return render_template('device.html',
-                               device=get_devices(device_id),
+                               device=inventory_device,
+                               status=status_cache.get(device_id),
                                dev_history=device_history,
+                               dev_stats=device_stats,
                                start_time=start_time,
                                end_time=end_time,
                                start_time_raw=start_time_raw,
@@ -67,21 +102,70 @@ def device(
 
     if request.method == "DELETE":
         delete_device(device_id)
+        status_cache.forget(device_id)
+        history_cache.invalidate(device_id)
+        deadband_filter.forget(device_id)
+        rollup_writer.forget(device_id)
         return redirect("/devices")
 
 
+@app.route('/history')
+def fleet_history():
+    """
+    Aggregate historic statistics across all devices
+    Start and End time supplied as arguments in request
+    """
+    start_time = None
+    end_time = None
+
+    if request.args.get('start_time'):
+        start_time = datetime.datetime.strptime(request.args.get('start_time'), '%Y-%m-%dT%H:%M')
+
+    if request.args.get('end_time'):
+        end_time = datetime.datetime.strptime(request.args.get('end_time'), '%Y-%m-%dT%H:%M')
+
+    with timed('inventory'):
+        fleet_devices = get_devices()
+
+    with timed('stats', "fleet"):
+        fleet_stats = fleet_statistics([fleet_device.uuid for fleet_device in fleet_devices], start_time, end_time)
+
+    return render_template('statistics.html',
+                           devices=fleet_devices,
+                           fleet_stats=fleet_stats,
+                           start_time=start_time,
+                           end_time=end_time)
+
+
 @app.route('/controls')
 def controls():
     """
     Controls is the settings page
-    Work needed here to make settings usable - currently loads off configuration.yaml and requires restart
+    Capture interval starts from configuration.yaml and can be changed while running
     """
-    data_points = history.get_all_data_points()
+    with timed('inventory'):
+        all_devices = get_devices()
 
     return render_template('controls.html',
                            capturing=capture_sched.stopped,
-                           time_interval=bia_config['time_interval'],
-                           data_points=data_points)
+                           time_interval=capture_sched.interval,
+                           capture_stats=capture_sched.stats(),
+                           device_intervals=device_sched.intervals(),
+                           devices={str(device.uuid): device for device in all_devices})
+
+
+@app.route('/capture_interval', methods=['POST'])
+def capture_interval():
+    """
+    Change capture interval without restarting, takes effect from the next interval boundary
+    """
+    if request.method == "POST":
+        try:
+            capture_sched.set_interval(float(request.form.get('time_interval', '')))
+        except ValueError:
+            return Response("Capture interval must be a positive number of seconds", status=400)
+
+        return redirect("/controls")
 
 
 @app.route('/add_device', methods=['GET', 'POST'])
@@ -94,6 +178,17 @@ def add_device():
         return render_template('add_device.html', device_types=device_types)
     elif request.method == "POST":
         device_type = request.form.get('device_type')
+
+        # Optional own polling schedule, otherwise device is captured by the global snapshot
+        try:
+            device_interval = float(request.form['device_interval']) if request.form.get('device_interval') else None
+        except ValueError:
+            device_interval = -1
+        if device_interval is not None and not device_interval > 0:
+            return Response("Polling interval must be a positive number of seconds", status=400)
+        device_adaptive = request.form.get('device_adaptive') == 'on'
+        device_deadband = request.form.get('device_deadband') == 'on'
+
         if device_type == "SMARTPLUG":
             # Get details from form
             device_name = request.form.get('device_name')
@@ -105,6 +200,9 @@ def add_device():
                 device_address
             )
 
+            unsaved_device.interval = device_interval
+            unsaved_device.adaptive = device_adaptive
+            unsaved_device.deadband = device_deadband
             unsaved_device.save()
 
         if device_type == "CISCO":
@@ -122,6 +220,9 @@ def add_device():
                 device_password=device_password
             )
 
+            unsaved_device.interval = device_interval
+            unsaved_device.adaptive = device_adaptive
+            unsaved_device.deadband = device_deadband
             unsaved_device.save()
 
         return redirect("/")
@@ -134,7 +235,8 @@ def device_snapshot():
     Adds consumption to "data" folder
     """
     if request.method == "POST":
-        snapshot()
+        with timed('device_io', "snapshot"):
+            snapshot()
 
         return redirect("/controls")
 
@@ -146,6 +248,7 @@ def enable_capture():
     """
     if request.method == "POST":
         capture_sched.start()
+        device_sched.start()
 
         return redirect("/controls")
 
@@ -157,9 +260,68 @@ def disable_capture():
     """
     if request.method == "POST":
         capture_sched.stop()
+        device_sched.stop()
+        flush_deadband()
 
         return redirect("/controls")
 
+@app.route('/data')
+def data():
+    """
+    Stream raw data points a page at a time, ordered by device then timestamp
+    Arguments: device (repeatable, defaults to all), cursor (from previous page), limit, format (jsonl or csv)
+    Cursor of the next page is returned in the X-Next-Cursor header, absent on the last page
+
+    :return: response_data
+    """
+    output_format = request.args.get('format', 'jsonl')
+    if output_format not in FORMATS:
+        return Response(f"Unknown format {output_format}", status=400)
+
+    max_page_size = bia_config.get('data_page_size', 1000)
+    try:
+        limit = min(int(request.args.get('limit', max_page_size)), max_page_size)
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+    with timed('history', "page"):
+        page, next_cursor = page_data_points(request.args.getlist('device') or None, cursor, max(limit, 1))
+
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = encode_cursor(next_cursor)
+
+    return Response(stream(page, output_format), mimetype=FORMATS[output_format], headers=headers)
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Poll, capture and cache metrics in the Prometheus text format
+
+    :return: response_metrics
+    """
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/metrics/traces')
+def traces():
+    """
+    Recent poll traces as JSON, newest first, each with the time taken by every phase
+    Arguments: device (optional), limit
+
+    :return: response_traces
+    """
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError as error:
+        return Response(str(error), status=400)
+
+    return Response(json.dumps([trace.to_dict() for trace in poll_traces.recent(request.args.get('device'), limit)]),
+                    mimetype='application/json')
+
+
 @app.route('/device/<device_id>/usage_graph.png')
 def device_image(device_id):
     """
@@ -179,12 +341,25 @@ def device_image(device_id):
     if request.args.get('end_time'):
         end_time = datetime.datetime.strptime(request.args.get('end_time'), '%Y-%m-%dT%H:%M')
 
-    device_history = DeviceHistory(device_id)
-    usage_graph = device_history.usage_graph(start_time, end_time)
-    output = io.BytesIO()
-    FigureCanvas(usage_graph).print_png(output)
-    return Response(output.getvalue(), mimetype='image/png')
+    try:
+        with timed('png'):
+            png = usage_graph_png(device_id, start_time, end_time)
+    except RenderQueueFull:
+        return Response("Graph renderer busy", status=503, headers={'Retry-After': '1'})
+    except TimeoutError:
+        return Response("Graph render timed out", status=504)
+
+    return Response(png, mimetype='image/png')
 
 
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=8080, debug=True)
+    debug = True
+
+    # With debug on the reloader runs this module twice, background work only starts in the process serving requests
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Fill status cache straight away rather than after the first interval
+        threading.Thread(target=refresh_status, daemon=True).start()
+        status_sched.start()
+        compact_sched.start()
+
+    app.run(host='127.0.0.1', port=8080, debug=debug)
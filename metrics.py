@@ -0,0 +1,389 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+import datetime
+import math
+import time
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds in seconds, polls are given deadlines of a few seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values) -> str:
+    """
+    Prometheus label set, e.g. {device="...",phase="connect"}
+
+    :param names: Label names
+    :param values: Label values, same order as names
+    :return: labels: Empty string if there are no labels
+    """
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value) -> str:
+    """
+    Prometheus sample value
+
+    :param value: Number
+    :return: value
+    """
+    if value is None or math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count, per label set
+
+    name: Metric name
+    help: Description
+    labels: Label names
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self._lock = Lock()
+        self._values = {}  # label values -> count
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increase count
+
+        :param label_values: Label values, same order as labels
+        :param amount: Amount to increase by
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> list:
+        """
+        Current samples
+
+        :return: samples: List of (suffix, label names, label values, value)
+        """
+        with self._lock:
+            return [('', self.labels, label_values, value) for label_values, value in self._values.items()]
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. latencies) in cumulative buckets, per label set
+
+    name: Metric name
+    help: Description
+    labels: Label names
+    buckets: Bucket upper bounds, ascending
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self._lock = Lock()
+        self._values = {}  # label values -> [bucket counts, sum, count]
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """
+        Record an observation
+
+        :param value: Observed value
+        :param label_values: Label values, same order as labels
+        """
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> list:
+        """
+        Current samples, buckets are cumulative
+
+        :return: samples: List of (suffix, label names, label values, value)
+        """
+        with self._lock:
+            values = [(label_values, list(state[0]), state[1], state[2])
+                      for label_values, state in self._values.items()]
+
+        samples = []
+        bucket_labels = self.labels + ('le',)
+        for label_values, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', bucket_labels, label_values + (_format_value(bound),), cumulative))
+            samples.append(('_bucket', bucket_labels, label_values + ('+Inf',), count))
+            samples.append(('_sum', self.labels, label_values, total))
+            samples.append(('_count', self.labels, label_values, count))
+
+        return samples
+
+
+class Collected:
+    """
+    Metric read from its owner when scraped, e.g. counters a cache already keeps
+    Several collectors can contribute samples with different label values
+
+    name: Metric name
+    help: Description
+    type: "counter" or "gauge"
+    labels: Label names
+    """
+    def __init__(self, name, help, type, labels=()):
+        self._lock = Lock()
+        self._collectors = []
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(labels)
+
+    def add(self, collector):
+        """
+        Add a collector
+
+        :param collector: Function returning a dictionary of label values (tuple) to value
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def samples(self) -> list:
+        """
+        Current samples
+
+        :return: samples: List of (suffix, label names, label values, value)
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+
+        samples = []
+        for collector in collectors:
+            for label_values, value in collector().items():
+                samples.append(('', self.labels, label_values, value))
+
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Process wide set of metrics, rendered in the Prometheus text format
+    Metrics are created once and registered by name, asking for an existing name returns it
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # name -> metric
+
+    def counter(self, name, help, labels=()) -> Counter:
+        return self._register(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labels, buckets)
+
+    def collect(self, name, help, type, collector, labels=()):
+        """
+        Register a metric read when scraped
+
+        :param name: Metric name
+        :param help: Description
+        :param type: "counter" or "gauge"
+        :param collector: Function returning a dictionary of label values (tuple) to value
+        :param labels: Label names
+        """
+        self._register(Collected, name, help, type, labels).add(collector)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+
+        :return: text
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, label_names, label_values, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(label_names, label_values)} '
+                             f'{_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric_class, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} already registered as {metric.type}")
+
+            return metric
+
+
+class PollTrace:
+    """
+    Timeline of a single device poll
+
+    device_id: Device ID
+    started: Datetime poll started
+    phases: List of (phase, seconds), in the order they finished
+    outcome: "ok", "unreachable", "timeout" or "error", None while polling
+    duration: Seconds poll took
+    """
+    def __init__(self, device_id):
+        self.device_id = str(device_id)
+        self.started = datetime.datetime.now()
+        self.phases = []
+        self.outcome = None
+        self.duration = None
+
+    def to_dict(self) -> dict:
+        return {
+            'device': self.device_id,
+            'started': self.started.isoformat(),
+            'phases': [{'phase': name, 'seconds': seconds} for name, seconds in self.phases],
+            'outcome': self.outcome,
+            'duration': self.duration,
+        }
+
+
+class TraceBuffer:
+    """
+    Ring buffer of recent poll traces, oldest traces are dropped once full
+
+    size: Number of traces kept
+    """
+    def __init__(self, size):
+        self._traces = deque(maxlen=size)  # Appends are atomic, no lock needed
+
+    def add(self, trace):
+        self._traces.append(trace)
+
+    def recent(self, device_id=None, limit=None) -> list:
+        """
+        Most recent traces, newest first
+
+        :param device_id: Only traces of this device
+        :param limit: Maximum number of traces
+        :return: traces
+        """
+        traces = [trace for trace in reversed(list(self._traces))
+                  if device_id is None or trace.device_id == str(device_id)]
+
+        return traces[:limit]
+
+
+# Trace of the poll running in the current thread or task, phases are added to it
+current_trace = ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def phase(device_id, name):
+    """
+    Time a phase of polling a device (e.g. connect, command, parse)
+    Recorded in the phase histogram and the trace of the poll in progress, if any
+
+    :param device_id: Device ID
+    :param name: Phase name
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        poll_phase_seconds.observe(seconds, str(device_id), name)
+
+        trace = current_trace.get()
+        if trace is not None:
+            trace.phases.append((name, seconds))
+
+
+def start_trace(device_id) -> PollTrace:
+    """
+    Start tracing a poll in the current context, phases timed until finish_trace are added to it
+
+    :param device_id: Device ID
+    :return: trace
+    """
+    trace = PollTrace(device_id)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, outcome, duration):
+    """
+    Record a finished poll
+
+    :param trace: Trace from start_trace
+    :param outcome: "ok", "unreachable", "timeout" or "error"
+    :param duration: Seconds poll took
+    """
+    trace.outcome = outcome
+    trace.duration = duration
+
+    poll_seconds.observe(duration, trace.device_id)
+    polls_total.inc(trace.device_id, outcome)
+    poll_traces.add(trace)
+
+
+def register_cache(name, cache):
+    """
+    Expose hits, misses and hit ratio of a cache keeping hits and misses attributes
+
+    :param name: Cache label, e.g. "history"
+    :param cache: Cache
+    """
+    def hit_ratio():
+        lookups = cache.hits + cache.misses
+        return {(name,): cache.hits / lookups if lookups else math.nan}
+
+    registry.collect('bia_cache_hits_total', "Lookups answered by a cache", 'counter',
+                     lambda: {(name,): cache.hits}, ('cache',))
+    registry.collect('bia_cache_misses_total', "Lookups a cache could not answer", 'counter',
+                     lambda: {(name,): cache.misses}, ('cache',))
+    registry.collect('bia_cache_hit_ratio', "Fraction of lookups answered by a cache", 'gauge',
+                     hit_ratio, ('cache',))
+
+
+registry = MetricsRegistry()
+
+poll_seconds = registry.histogram('bia_poll_seconds', "Time taken to poll a device", ('device',))
+poll_phase_seconds = registry.histogram('bia_poll_phase_seconds', "Time taken by each phase of polling a device",
+                                        ('device', 'phase'))
+polls_total = registry.counter('bia_polls_total', "Device polls by outcome", ('device', 'outcome'))
+snapshot_seconds = registry.histogram('bia_snapshot_seconds', "Time taken by a capture snapshot")
+rows_written_total = registry.counter('bia_rows_written_total', "Data points written to storage")
+rows_suppressed_total = registry.counter('bia_rows_suppressed_total', "Data points held back by the deadband filter")
+
+poll_traces = TraceBuffer(bia_config.get('poll_trace_size', 256))
@@ -0,0 +1,240 @@
+from flask import g, has_request_context, request
+import flask
+
+from collections import Counter
+from contextlib import contextmanager
+import datetime
+import os
+import sys
+import threading
+import time
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+
+class RequestProfile:
+    """
+    Time spent in each phase of handling a request (e.g. inventory, history, render)
+    A phase entered more than once adds up
+
+    started: perf_counter time request started
+    phases: Phase name -> [seconds, description]
+    stacks: Sampled call stacks, see StackSampler, None if not sampled
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.stacks = None
+
+    @property
+    def duration(self) -> float:
+        """
+        Seconds since request started
+
+        :return: duration
+        """
+        return time.perf_counter() - self.started
+
+    def add(self, name, seconds, description=None):
+        """
+        Add time spent in a phase
+
+        :param name: Phase name, a Server-Timing token (no spaces)
+        :param seconds: Seconds spent
+        :param description: Shown next to phase, e.g. in browser developer tools
+        """
+        phase = self.phases.setdefault(name, [0.0, description])
+        phase[0] += seconds
+
+    def server_timing(self) -> str:
+        """
+        Phases as a Server-Timing header value, including the total
+
+        :return: server_timing
+        """
+        timings = []
+        for name, (seconds, description) in self.phases.items():
+            timing = f'{name};dur={seconds * 1000:.1f}'
+            if description:
+                timing += ';desc="{}"'.format(description.replace('"', "'"))
+            timings.append(timing)
+        timings.append(f'total;dur={self.duration * 1000:.1f}')
+
+        return ', '.join(timings)
+
+
+@contextmanager
+def timed(name, description=None):
+    """
+    Time a phase of the current request, does nothing outside of a request
+
+    :param name: Phase name
+    :param description: Phase description
+    """
+    profile = g.get('profile') if has_request_context() else None
+    if profile is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started, description)
+
+
+def render_template(template_name, **context) -> str:
+    """
+    flask.render_template, timed as the render phase
+
+    :param template_name: Template to render
+    :param context: Template variables
+    :return: html
+    """
+    with timed('render', template_name):
+        return flask.render_template(template_name, **context)
+
+
+class StackSampler:
+    """
+    Sampling profiler for request threads
+    A single thread records the call stack of every registered thread each interval, so sampling
+    costs the same however slow the request. Stacks are kept as counts of folded stacks
+    ("outer;inner;innermost"), the input format of flame graph tools
+
+    interval: Seconds between samples
+    """
+    def __init__(self, interval):
+        self._lock = threading.Lock()
+        self._threads = {}  # thread ID -> Counter of folded stacks
+        self._thread = None
+        self.interval = interval
+
+    def add(self, thread_id) -> Counter:
+        """
+        Start sampling a thread
+
+        :param thread_id: Thread identifier
+        :return: stacks: Counter of folded stacks, filled until removed
+        """
+        stacks = Counter()
+        with self._lock:
+            self._threads[thread_id] = stacks
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="stack-sampler", daemon=True)
+                self._thread.start()
+
+        return stacks
+
+    def remove(self, thread_id):
+        """
+        Stop sampling a thread
+
+        :param thread_id: Thread identifier
+        """
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def _sample(self):
+        """
+        Sampling thread
+        """
+        while True:
+            time.sleep(self.interval)
+
+            with self._lock:
+                if not self._threads:
+                    continue
+
+                frames = sys._current_frames()
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame) -> str:
+        """
+        Folded call stack of a frame, outermost call first
+
+        :param frame: Innermost frame
+        :return: stack
+        """
+        calls = []
+        while frame is not None:
+            code = frame.f_code
+            calls.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+
+        return ';'.join(reversed(calls))
+
+
+def write_profile(profile, directory) -> str:
+    """
+    Write the sampled stacks of a slow request
+
+    :param profile: RequestProfile with stacks
+    :param directory: Directory to write to, created if missing
+    :return: path
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    endpoint = (request.endpoint or 'unknown').replace('.', '_')
+    path = os.path.join(directory, f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{endpoint}.folded")
+    with open(path, 'w') as profile_file:
+        profile_file.write(f"# {request.method} {request.full_path} {profile.duration * 1000:.1f}ms\n")
+        profile_file.write(f"# {profile.server_timing()}\n")
+        for stack, count in profile.stacks.most_common():
+            profile_file.write(f"{stack} {count}\n")
+
+    return path
+
+
+def init_app(app):
+    """
+    Profile every request of a Flask app
+    Phase timings are returned in a Server-Timing header (server_timing in configuration).
+    If profile_slow_requests is set, requests are also sampled (every profile_interval seconds)
+    and the stacks of requests slower than slow_request_threshold seconds are written to profile_directory
+
+    :param app: Flask app
+    """
+    sampler = None
+    if bia_config.get('profile_slow_requests', False):
+        sampler = StackSampler(bia_config.get('profile_interval', 0.005))
+    threshold = bia_config.get('slow_request_threshold', 1.0)
+    directory = bia_config.get('profile_directory', 'profiles')
+
+    @app.before_request
+    def start_profile():
+        g.profile = RequestProfile()
+        if sampler is not None:
+            g.profile.stacks = sampler.add(threading.get_ident())
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+
+        if profile.stacks is not None:
+            sampler.remove(threading.get_ident())
+            if profile.duration > threshold and profile.stacks:
+                print(f"Slow request {request.full_path} took {profile.duration * 1000:.0f}ms, "
+                      f"profile written to {write_profile(profile, directory)}")
+
+        if bia_config.get('server_timing', True):
+            response.headers['Server-Timing'] = profile.server_timing()
+
+        return response
+
+    @app.teardown_request
+    def stop_sampling(error=None):
+        # after_request is skipped if the view raised
+        if sampler is not None:
+            sampler.remove(threading.get_ident())
+
@@ -0,0 +1,152 @@
+from capture import Periodic
+from rollups import fill
+from rollups import rollup_writer
+import storage
+
+import numpy as np
+
+import argparse
+from datetime import datetime
+import os
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+# Cutoffs are aligned to the widest rollup bucket, so expired data always ends on a bucket
+# boundary of every tier that answers for it instead
+CUTOFF_ALIGNMENT = max(storage.TIER_WIDTHS.values())
+
+
+def retention_days(tier):
+    """
+    Days a tier is kept for, from retention in configuration
+
+    :param tier: Storage tier
+    :return: days: None if kept forever
+    """
+    return bia_config.get('retention', {}).get(tier)
+
+
+def compact_tier(device_id, tier, cutoff_ns) -> int:
+    """
+    Remove records of a device tier older than cutoff
+    Segments entirely before the cutoff are removed, the segment holding the cutoff is rewritten
+    atomically. Appends to the device are held off while segments change, other devices keep capturing.
+    The last raw data point before the cutoff is kept, the energy of the first one after it
+    is integrated from it. Before raw data is removed any rollup buckets missing before the cutoff
+    are built from it, so it is never removed without being rolled up
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :param cutoff_ns: Nanoseconds since epoch, aligned to CUTOFF_ALIGNMENT
+    :return: removed: Number of records removed
+    """
+    retained = storage.retained_from(device_id, tier)
+    if retained is not None and retained >= cutoff_ns:
+        return 0
+
+    keep_previous = tier == 'raw'
+    removed = 0
+
+    with rollup_writer.exclusive(device_id):
+        if tier == 'raw':
+            fill(device_id, cutoff_ns)
+
+        previous_path = None  # Expired segment holding the last record before the cutoff
+        previous_records = None
+
+        for path in storage.segment_paths(device_id, tier):
+            records = storage.read_segment(path, tier=tier)
+            expired = records['timestamp'] < cutoff_ns
+
+            if np.all(expired):
+                if previous_path is not None:
+                    os.remove(previous_path)
+                    removed += len(previous_records)
+                previous_path, previous_records = path, records
+                continue
+
+            first_kept = int(np.argmax(~expired))
+            if keep_previous and first_kept > 0:
+                first_kept -= 1
+            elif previous_path is not None and keep_previous and len(previous_records):
+                storage.rewrite_segment(previous_path, previous_records[-1:])
+                removed += len(previous_records) - 1
+                previous_path = None
+            if previous_path is not None:
+                os.remove(previous_path)
+                removed += len(previous_records)
+                previous_path = None
+
+            if first_kept > 0:
+                storage.rewrite_segment(path, records[first_kept:])
+                removed += first_kept
+            break
+
+        else:
+            # Everything expired, e.g. device no longer captured
+            if previous_path is not None:
+                if keep_previous and len(previous_records):
+                    storage.rewrite_segment(previous_path, previous_records[-1:])
+                    removed += len(previous_records) - 1
+                else:
+                    os.remove(previous_path)
+                    removed += len(previous_records)
+
+        storage.set_retained_from(device_id, tier, cutoff_ns)
+
+    return removed
+
+
+def compact(device_id, now=None) -> dict:
+    """
+    Apply retention to every tier of a device
+    Raw data is compacted first, after folding it into any rollup buckets missing (see compact_tier)
+
+    :param device_id: Device ID
+    :param now: Current time, defaults to now
+    :return: removed: Dictionary of tier to number of records removed
+    """
+    if now is None:
+        now = datetime.now()
+    now_ns = storage.to_epoch_ns(now)
+
+    removed = {}
+    for tier in storage.TIER_DTYPES:
+        days = retention_days(tier)
+        if days is None or not storage.segment_paths(device_id, tier):
+            continue
+
+        cutoff_ns = (now_ns - int(days * 86400 * 1_000_000_000)) // CUTOFF_ALIGNMENT * CUTOFF_ALIGNMENT
+        removed[tier] = compact_tier(device_id, tier, cutoff_ns)
+
+    return removed
+
+
+def compact_all():
+    """
+    Apply retention to every device with stored data
+    """
+    for device_id in storage.list_series():
+        removed = compact(device_id)
+        if any(removed.values()):
+            print(f"Compacted {device_id}: {removed}")
+
+
+compact_sched = Periodic(bia_config.get('compaction_interval', 3600), compact_all, name='compaction')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NetworkBia retention tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = subparsers.add_parser('compact', help="Remove data older than its tiers retention")
+    compact_parser.add_argument('device_ids', nargs='*', help="Devices to compact, defaults to all")
+
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        for compact_device in args.device_ids or storage.list_series():
+            print(f"{compact_device}: {compact(compact_device)}")
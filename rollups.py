@@ -0,0 +1,301 @@
+from history import HISTORY_DTYPE
+from history import power_coverage
+from history import power_segments
+from history import span_energy
+from history import split_spans
+import storage
+
+import numpy as np
+
+import argparse
+from contextlib import contextmanager
+from threading import Lock
+
+
+def build_rollups(history, width, previous=None) -> np.ndarray:
+    """
+    Aggregate sorted data points into time buckets
+    Energy and the time each data point covers (see history.power_coverage) are split at bucket boundaries,
+    so a deadband data point closing a long flat stretch counts towards every bucket of the stretch
+
+    :param history: Data points (HISTORY_DTYPE), sorted by timestamp
+    :param width: Bucket width in nanoseconds
+    :param previous: Data point before history (1 element array), energy and coverage since it are included
+    :return: rollups: One ROLLUP_DTYPE record per bucket with data points, energy or covered time
+    """
+    if len(history) == 0:
+        return np.zeros(0, dtype=storage.ROLLUP_DTYPE)
+
+    with_previous = history if previous is None or len(previous) == 0 else np.concatenate((previous, history))
+    previous_ns = None if with_previous is history else int(previous['timestamp'][0].astype('int64'))
+
+    segment_starts, segment_ends, start_power, end_power = power_segments(with_previous)
+    segments, segment_buckets, piece_starts, piece_ends = split_spans(segment_starts, segment_ends, width)
+    energy = span_energy(segment_starts[segments], segment_ends[segments], start_power[segments],
+                         end_power[segments], piece_starts, piece_ends)
+
+    cover_starts, cover_ends, power = power_coverage(history, previous_ns)
+    spans, cover_buckets, piece_starts, piece_ends = split_spans(cover_starts, cover_ends, width)
+    seconds = (piece_ends - piece_starts) / 1e9
+
+    timestamps = history['timestamp'].astype('int64')
+    point_buckets = timestamps - timestamps % width
+
+    buckets = np.unique(np.concatenate((point_buckets, segment_buckets, cover_buckets)))
+    point_indexes = np.searchsorted(buckets, point_buckets)
+    cover_indexes = np.searchsorted(buckets, cover_buckets)
+
+    rollups = np.zeros(len(buckets), dtype=storage.ROLLUP_DTYPE)
+    rollups['timestamp'] = buckets
+    rollups['min'] = np.nan
+    rollups['max'] = np.nan
+    np.fmin.at(rollups['min'], point_indexes, history['power'])
+    np.fmax.at(rollups['max'], point_indexes, history['power'])
+    np.fmin.at(rollups['min'], cover_indexes, power[spans])
+    np.fmax.at(rollups['max'], cover_indexes, power[spans])
+    rollups['count'] = np.bincount(point_indexes, weights=~np.isnan(history['power']), minlength=len(buckets))
+    rollups['seconds'] = np.bincount(cover_indexes, weights=seconds, minlength=len(buckets))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rollups['mean'] = np.bincount(cover_indexes, weights=power[spans] * seconds,
+                                      minlength=len(buckets)) / rollups['seconds']
+    rollups['energy'] = np.bincount(np.searchsorted(buckets, segment_buckets), weights=energy,
+                                    minlength=len(buckets))
+
+    return rollups
+
+
+def merge_rollups(first, second) -> np.ndarray:
+    """
+    Merge two rollups of the same bucket
+
+    :param first: Rollup record (1 element array), its timestamp is kept
+    :param second: Rollup record (1 element array)
+    :return: merged
+    """
+    merged = first.copy()
+    seconds = first['seconds'] + second['seconds']
+
+    merged['min'] = np.fmin(first['min'], second['min'])
+    merged['max'] = np.fmax(first['max'], second['max'])
+    merged['count'] = first['count'] + second['count']
+    merged['seconds'] = seconds
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged['mean'] = (np.nan_to_num(first['mean']) * first['seconds'] +
+                          np.nan_to_num(second['mean']) * second['seconds']) / seconds
+    merged['energy'] = first['energy'] + second['energy']
+
+    return merged
+
+
+class RollupWriter:
+    """
+    Writes capture records and keeps each devices rollup tiers up to date as it goes
+
+    The bucket currently being filled is held in memory and written once a record for a later
+    bucket arrives. On first use for a device the open buckets are rebuilt from raw records
+    after the last written bucket, so rollups survive restarts. Each device is written under its own
+    lock, so a device held up (e.g. by compaction) does not hold up the others
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._device_locks = {}  # device ID -> Lock held while writing the device
+        self._previous = {}  # device ID -> last data point written
+        self._open = {}  # (device ID, tier) -> bucket being filled
+
+    def append(self, device_id, records):
+        """
+        Append records to raw storage and roll them up
+
+        :param device_id: Device ID
+        :param records: Capture records (RECORD_DTYPE)
+        """
+        device_id = str(device_id)
+
+        with self._device_lock(device_id):
+            if device_id not in self._previous:
+                self._restore(device_id)
+
+            storage.segment_writer.append(device_id, records)
+
+            history = np.asarray(records, dtype=storage.RECORD_DTYPE).view(HISTORY_DTYPE)
+            previous = self._previous[device_id]
+
+            for tier, width in storage.TIER_WIDTHS.items():
+                self._roll(device_id, tier, build_rollups(history, width, previous))
+
+            self._previous[device_id] = history[-1:].copy()
+
+    def forget(self, device_id):
+        """
+        Drop in memory state of a device, e.g. after its data has been removed or rewritten
+
+        :param device_id: Device ID
+        """
+        device_id = str(device_id)
+
+        with self._device_lock(device_id):
+            self._drop(device_id)
+
+    @contextmanager
+    def exclusive(self, device_id):
+        """
+        Hold off writes to a device while its stored data is rewritten, other devices keep writing
+        Its in memory state is dropped afterwards, open buckets are restored from storage on the next append
+
+        :param device_id: Device ID
+        """
+        device_id = str(device_id)
+
+        with self._device_lock(device_id), storage.segment_writer.exclusive(device_id):
+            try:
+                yield
+            finally:
+                self._drop(device_id)
+
+    def _drop(self, device_id):
+        """
+        Drop in memory state of a device, must be called with its lock held
+
+        :param device_id: Device ID
+        """
+        self._previous.pop(device_id, None)
+        for tier in storage.TIER_WIDTHS:
+            self._open.pop((device_id, tier), None)
+
+    def _device_lock(self, device_id) -> Lock:
+        """
+        Lock serialising writes to a device
+
+        :param device_id: Device ID
+        :return: lock
+        """
+        with self._lock:
+            return self._device_locks.setdefault(device_id, Lock())
+
+    def _roll(self, device_id, tier, rollups):
+        """
+        Add rollups to the open bucket of a tier, writing buckets that are complete
+
+        :param device_id: Device ID
+        :param tier: Rollup tier
+        :param rollups: Rollups of newly appended records
+        """
+        open_bucket = self._open.get((device_id, tier))
+        if open_bucket is not None:
+            if rollups['timestamp'][0] <= open_bucket['timestamp'][0]:
+                # Same bucket (or clock went backwards), keep filling it
+                rollups[:1] = merge_rollups(open_bucket, rollups[:1])
+            else:
+                rollups = np.concatenate((open_bucket, rollups))
+
+        if len(rollups) > 1:
+            storage.segment_writer.append(device_id, rollups[:-1], tier)
+
+        self._open[(device_id, tier)] = rollups[-1:].copy()
+
+    def _restore(self, device_id):
+        """
+        Rebuild open buckets from raw records after the last written bucket of each tier
+        Complete buckets found on the way (e.g. captured before a restart) are written
+
+        :param device_id: Device ID
+        """
+        raw_history = storage.load(device_id).view(HISTORY_DTYPE)
+        timestamps = raw_history['timestamp'].astype('int64')
+
+        for tier, width in storage.TIER_WIDTHS.items():
+            written = storage.load(device_id, tier)
+            covered_end = int(written['timestamp'][-1]) + width if len(written) else None
+
+            start_index = 0 if covered_end is None else int(np.searchsorted(timestamps, covered_end))
+            previous = raw_history[max(start_index - 1, 0):start_index]
+            rollups = build_rollups(raw_history[start_index:], width, previous)
+            if covered_end is not None:
+                # What the first pending data point adds to written buckets was written with them
+                rollups = rollups[rollups['timestamp'] >= covered_end]
+            if len(rollups) > 1:
+                storage.segment_writer.append(device_id, rollups[:-1], tier)
+
+            self._open[(device_id, tier)] = rollups[-1:].copy() if len(rollups) else None
+
+        self._previous[device_id] = raw_history[-1:].copy() if len(raw_history) else None
+
+
+def rebuild(device_id):
+    """
+    Rebuild all rollup tiers of a device from its raw records
+    Used after migrating or rewriting raw data, capture must not be writing to the device
+
+    :param device_id: Device ID
+    """
+    history = storage.load(device_id).view(HISTORY_DTYPE)
+    history = history[np.argsort(history['timestamp'], kind='stable')]
+
+    for tier, width in storage.TIER_WIDTHS.items():
+        storage.delete_tier(device_id, tier)
+
+        # Last bucket is left open for the writer to continue filling
+        rollups = build_rollups(history, width)
+        if len(rollups) > 1:
+            storage.append_records(device_id, rollups[:-1], tier)
+
+    rollup_writer.forget(device_id)
+
+
+def fill(device_id, end_ns) -> int:
+    """
+    Write rollup buckets missing before end from raw records, e.g. of data captured before rollups
+    were kept or migrated without a rebuild. Buckets already written or expired are left alone.
+    Must be called with writes to the device held off, see RollupWriter.exclusive
+
+    :param device_id: Device ID
+    :param end_ns: Nanoseconds since epoch, multiple of every tier width
+    :return: added: Number of buckets written
+    """
+    history = storage.load(device_id).view(HISTORY_DTYPE)
+    history = history[np.argsort(history['timestamp'], kind='stable')]
+    # The data point after end can cover time and energy before it
+    history = history[:np.searchsorted(history['timestamp'], np.datetime64(end_ns, 'ns')) + 1]
+    if len(history) == 0:
+        return 0
+
+    added = 0
+    for tier, width in storage.TIER_WIDTHS.items():
+        rollups = build_rollups(history, width)
+        written = storage.load(device_id, tier)
+        retained = storage.retained_from(device_id, tier)
+
+        missing = ~np.isin(rollups['timestamp'], written['timestamp']) & (rollups['timestamp'] < end_ns)
+        if retained is not None:
+            missing &= rollups['timestamp'] >= retained
+        if not np.any(missing):
+            continue
+
+        merged = np.concatenate((written, rollups[missing]))
+        merged = merged[np.argsort(merged['timestamp'], kind='stable')]
+
+        storage.delete_tier(device_id, tier)
+        storage.append_records(device_id, merged, tier)
+        if retained is not None:
+            storage.set_retained_from(device_id, tier, retained)
+        added += int(np.sum(missing))
+
+    return added
+
+
+rollup_writer = RollupWriter()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NetworkBia rollup tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = subparsers.add_parser('rebuild', help="Rebuild rollup tiers from raw data")
+    rebuild_parser.add_argument('device_ids', nargs='*', help="Devices to rebuild, defaults to all")
+
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        for rebuild_device in args.device_ids or storage.list_series():
+            rebuild(rebuild_device)
+            print(f"{rebuild_device}: rebuilt")
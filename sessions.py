@@ -0,0 +1,248 @@
+import metrics
+
+import atexit
+import time
+from collections import defaultdict
+from threading import Condition
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+# Errors meaning a connection is no longer usable, drivers add their own (see SessionPool.run)
+CONNECTION_ERRORS = (OSError, EOFError)
+
+
+class _Session:
+    """
+    Authenticated connection held by the pool
+
+    connection: Open driver connection (napalm device, scrapli driver etc)
+    disconnect: Function to close the connection
+    is_alive: Function to check connection is still usable
+    """
+    def __init__(self, connection, disconnect, is_alive):
+        self.connection = connection
+        self.disconnect = disconnect
+        self.is_alive = is_alive
+        self.last_used = time.monotonic()
+
+    def healthy(self, health_check_after) -> bool:
+        """
+        Check idle session is still usable
+        Sessions used recently are trusted without a health check
+
+        :param health_check_after: Seconds idle before a health check is required
+        :return: healthy
+        """
+        if self.is_alive is None or time.monotonic() - self.last_used < health_check_after:
+            return True
+
+        try:
+            return bool(self.is_alive(self.connection))
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.disconnect(self.connection)
+        except Exception:
+            pass  # Already dead, nothing else to clean up
+
+
+class SessionPool:
+    """
+    Keyed pool of authenticated sessions, shared by all devices in the process
+    Keys are tuples starting with the host, so sessions of different kinds (napalm, scrapli)
+    to the same host share the per host session cap
+
+    max_per_host: Maximum number of open sessions to a single host
+    health_check_after: Seconds a session can be idle before being health checked on reuse
+    max_idle: Seconds a session can be idle before being closed
+    acquire_timeout: Seconds to wait for a free session slot
+    """
+    def __init__(self,
+                 max_per_host=2,
+                 health_check_after=30,
+                 max_idle=300,
+                 acquire_timeout=10):
+        self._condition = Condition()
+        self._idle = defaultdict(list)
+        self._open = defaultdict(int)
+        self.hits = 0  # Operations run on a reused session
+        self.misses = 0  # Operations needing a new connection (login)
+        self.max_per_host = max_per_host
+        self.health_check_after = health_check_after
+        self.max_idle = max_idle
+        self.acquire_timeout = acquire_timeout
+
+    def run(self,
+            key,
+            connect,
+            operation,
+            disconnect=None,
+            is_alive=None,
+            connection_errors=CONNECTION_ERRORS):
+        """
+        Run an operation against a pooled session, connecting only if no idle session is available
+        If a reused session turns out to be stale (the operation raises one of connection_errors) it is
+        dropped and the operation retried once on a fresh connection. Any other error is raised straight
+        away and the session, still usable, goes back to the pool
+
+        :param key: Session key, first element must be the host
+        :param connect: Function returning a new, open connection
+        :param operation: Function taking the connection, result is returned
+        :param disconnect: Function to close a connection, defaults to connection.close()
+        :param is_alive: Function to check a connection is still usable
+        :param connection_errors: Exception types meaning the connection is no longer usable
+        :return: result: Result of operation
+        """
+        if disconnect is None:
+            disconnect = lambda connection: connection.close()
+
+        session = self._checkout(key)
+        reused = session is not None
+
+        while True:
+            if session is None:
+                try:
+                    session = _Session(connect(), disconnect, is_alive)
+                except BaseException:
+                    self._release_slot(key)
+                    raise
+
+            try:
+                result = operation(session.connection)
+            except connection_errors:
+                if not reused:
+                    self._discard(key, session)
+                    raise
+
+                # Stale session, retry once on a new connection in the same slot
+                session.close()
+                session = None
+                reused = False
+                continue
+            except Exception:
+                # Operation failed on a working connection, e.g. a command the device rejected
+                self._checkin(key, session, reused)
+                raise
+
+            self._checkin(key, session, reused)
+            return result
+
+    def close_all(self):
+        """
+        Close all idle sessions
+        """
+        with self._condition:
+            idle_sessions = [session for sessions in self._idle.values() for session in sessions]
+            for key, sessions in self._idle.items():
+                self._open[key[0]] -= len(sessions)
+            self._idle.clear()
+            self._condition.notify_all()
+
+        for session in idle_sessions:
+            session.close()
+
+    def _checkout(self, key):
+        """
+        Take an idle session for key, or reserve a slot for a new one
+
+        :param key: Session key
+        :return: session: Idle session, None if a new connection should be made
+        """
+        expired = []
+        try:
+            session = self._acquire(key, expired)
+        finally:
+            for expired_session in expired:
+                expired_session.close()
+
+        if session is not None and not session.healthy(self.health_check_after):
+            # Stale, reuse the slot for a new connection
+            session.close()
+            return None
+
+        return session
+
+    def _acquire(self, key, expired):
+        """
+        Wait for an idle session or a free slot for the host
+        Sessions that need closing are added to expired, to be closed outside the lock
+
+        :param key: Session key
+        :param expired: List of sessions to be closed by the caller
+        :return: session: Idle session, None if a slot was reserved for a new connection
+        """
+        with self._condition:
+            deadline = time.monotonic() + self.acquire_timeout
+            while True:
+                expired.extend(self._reap(key[0]))
+
+                if self._idle.get(key):
+                    return self._idle[key].pop()
+
+                if self._open[key[0]] < self.max_per_host:
+                    self._open[key[0]] += 1
+                    return None
+
+                # Host at capacity, give up an idle session of another kind
+                for other_key, sessions in self._idle.items():
+                    if other_key[0] == key[0] and sessions:
+                        expired.append(sessions.pop(0))
+                        return None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free session to {key[0]}")
+                self._condition.wait(remaining)
+
+    def _reap(self, host):
+        """
+        Remove sessions idle for longer than max_idle for a host
+        Must be called with the lock held, returned sessions must be closed by the caller
+
+        :param host: Host to reap sessions for
+        :return: expired: Expired sessions
+        """
+        expired = []
+        now = time.monotonic()
+        for key, sessions in self._idle.items():
+            if key[0] != host:
+                continue
+            for session in list(sessions):
+                if now - session.last_used > self.max_idle:
+                    sessions.remove(session)
+                    expired.append(session)
+
+        self._open[host] -= len(expired)
+        return expired
+
+    def _checkin(self, key, session, reused):
+        session.last_used = time.monotonic()
+        with self._condition:
+            self._idle[key].append(session)
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._condition.notify()
+
+    def _discard(self, key, session):
+        session.close()
+        self._release_slot(key)
+
+    def _release_slot(self, key):
+        with self._condition:
+            self._open[key[0]] -= 1
+            self._condition.notify()
+
+
+session_pool = SessionPool(max_per_host=bia_config.get('ssh_max_sessions_per_host', 2),
+                           health_check_after=bia_config.get('ssh_health_check_after', 30),
+                           max_idle=bia_config.get('ssh_max_idle', 300))
+metrics.register_cache('session', session_pool)
+
+atexit.register(session_pool.close_all)
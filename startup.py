@@ -0,0 +1,67 @@
+import argparse
+import subprocess
+import sys
+import time
+
+
+def import_times(module) -> list:
+    """
+    Measure import cost of a module and everything it imports, in a fresh interpreter
+    Uses Pythons -X importtime output
+
+    :param module: Module to import, e.g. "main"
+    :return: import_times: List of (module, self microseconds, cumulative microseconds, depth), in import order
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), int(self_us), int(cumulative_us), depth))
+
+    return times
+
+
+def startup_report(module='main', top=15) -> str:
+    """
+    Report of a modules cold import cost, split by top level package
+
+    :param module: Module to import
+    :param top: Number of packages to list
+    :return: report
+    """
+    start = time.perf_counter()
+    times = import_times(module)
+    wall_time = time.perf_counter() - start
+
+    packages = {}
+    for name, self_us, _, _ in times:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    total_us = sum(packages.values())
+    lines = [f"Import of {module}: {total_us / 1000:.1f}ms ({wall_time * 1000:.1f}ms including interpreter start)",
+             f"{'Package':<30}{'ms':>10}{'%':>8}"]
+    for package, package_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        lines.append(f"{package:<30}{package_us / 1000:>10.1f}{package_us / total_us * 100:>8.1f}")
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NetworkBia startup time report")
+    parser.add_argument('modules', nargs='*', default=['main'], help="Modules to measure, defaults to main")
+    parser.add_argument('--top', type=int, default=15, help="Number of packages to list")
+
+    args = parser.parse_args()
+
+    for report_module in args.modules:
+        print(startup_report(report_module, args.top))
+        print()
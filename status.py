@@ -0,0 +1,135 @@
+import datetime
+from threading import Lock
+import time
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+
+class DeviceStatus:
+    """
+    Last known live state of a device
+
+    reachable: Device answered last poll
+    properties: Properties from last successful poll (may be older than last poll)
+    capability: Capability from last time it was fetched
+    capability_time: Monotonic time capability was fetched
+    last_polled: Datetime of last poll
+    last_seen: Datetime of last successful poll, None if never reachable
+    latency: Seconds last poll took
+    ttl: Seconds after which status is considered stale
+    """
+    def __init__(self, reachable, properties, capability, capability_time, last_polled, last_seen, latency, ttl):
+        self.reachable = reachable
+        self.properties = properties
+        self.capability = capability
+        self.capability_time = capability_time
+        self.last_polled = last_polled
+        self.last_seen = last_seen
+        self.latency = latency
+        self.ttl = ttl
+        self._polled_at = time.monotonic()
+
+    @property
+    def age(self) -> float:
+        """
+        Seconds since device was last polled
+
+        :return: age
+        """
+        return time.monotonic() - self._polled_at
+
+    @property
+    def stale(self) -> bool:
+        """
+        Status is older than its ttl, e.g. collector stopped or device polls timing out
+
+        :return: stale
+        """
+        return self.age > self.ttl
+
+
+class StatusCache:
+    """
+    In memory live status of every device, filled by polls so pages never wait on devices
+
+    ttl: Seconds after which a status is considered stale
+    """
+    def __init__(self, ttl):
+        self._lock = Lock()
+        self._statuses = {}
+        self.ttl = ttl
+
+    def record(self, device_id, properties, latency):
+        """
+        Record result of polling a device
+        Properties and capability from earlier polls are kept while a device is unreachable
+
+        :param device_id: Device ID
+        :param properties: Properties returned by poll, None if unreachable
+        :param latency: Seconds poll took
+        """
+        device_id = str(device_id)
+        now = datetime.datetime.now()
+        reachable = properties is not None
+
+        with self._lock:
+            previous = self._statuses.get(device_id)
+
+            capability = None
+            capability_time = None
+            last_seen = now if reachable else None
+            if previous is not None:
+                capability = previous.capability
+                capability_time = previous.capability_time
+                if not reachable:
+                    properties = previous.properties
+                    last_seen = previous.last_seen
+
+            self._statuses[device_id] = DeviceStatus(reachable, properties, capability, capability_time,
+                                                     now, last_seen, latency, self.ttl)
+
+    def record_capability(self, device_id, capability):
+        """
+        Record capability of a polled device
+
+        :param device_id: Device ID
+        :param capability: Device capability
+        """
+        with self._lock:
+            status = self._statuses.get(str(device_id))
+            if status is not None:
+                status.capability = capability
+                status.capability_time = time.monotonic()
+
+    def get(self, device_id):
+        """
+        Get status of a device
+
+        :param device_id: Device ID
+        :return: status: None if device not polled yet
+        """
+        return self._statuses.get(str(device_id))
+
+    def all(self) -> dict:
+        """
+        Status of every polled device
+
+        :return: statuses: Dictionary of device ID to status
+        """
+        with self._lock:
+            return dict(self._statuses)
+
+    def forget(self, device_id):
+        """
+        Drop status of a device, e.g. once removed from inventory
+
+        :param device_id: Device ID
+        """
+        with self._lock:
+            self._statuses.pop(str(device_id), None)
+
+
+status_cache = StatusCache(ttl=bia_config.get('status_ttl', 90))
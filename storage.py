@@ -0,0 +1,625 @@
+import ciso8601
+import numpy as np
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import argparse
+import atexit
+import csv
+import datetime
+import os
+import shutil
+import time
+import yaml
+
+# Read configuration
+with open('configuration.yaml', 'r') as config_file:
+    bia_config = yaml.safe_load(config_file)
+
+DATA_DIRECTORY = 'data'
+SEGMENT_SUFFIX = '.seg'
+RETENTION_FILE = 'retained_from'
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# When buffered capture records are flushed to segment files, see SegmentWriter
+DURABILITY_POLICIES = ('snapshot', 'interval', 'fsync')
+
+# Fixed width capture record, timestamp in nanoseconds since epoch, power in Watts (NaN if
+# unknown) and interval in seconds
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('power', '<f8'),
+    ('interval', '<f4'),
+])
+
+# Aggregate of all records in a time bucket, timestamp is the bucket start. Mean, min and max
+# are over records with known power (count), mean weighted by the seconds each record covers
+# (its interval, seconds in total), energy in KiloWatt Hours
+ROLLUP_DTYPE = np.dtype([
+    ('timestamp', '<i8'),
+    ('min', '<f8'),
+    ('max', '<f8'),
+    ('mean', '<f8'),
+    ('count', '<i8'),
+    ('energy', '<f8'),
+    ('seconds', '<f8'),
+])
+
+TIER_DTYPES = {
+    'raw': RECORD_DTYPE,
+    'minute': ROLLUP_DTYPE,
+    'hour': ROLLUP_DTYPE,
+    'day': ROLLUP_DTYPE,
+}
+
+# Bucket width of each rollup tier in nanoseconds, finest first
+TIER_WIDTHS = {
+    'minute': 60 * 1_000_000_000,
+    'hour': 3600 * 1_000_000_000,
+    'day': 86400 * 1_000_000_000,
+}
+
+
+def to_epoch_ns(time_captured: datetime.datetime) -> int:
+    """
+    Convert a (naive) datetime to nanoseconds since epoch
+    Clamped to the int64 range, so datetime.min/max can be used as open bounds
+
+    :param time_captured: Datetime
+    :return: epoch_ns
+    """
+    delta = time_captured - EPOCH
+    epoch_ns = (delta.days * 86400 + delta.seconds) * 1_000_000_000 + delta.microseconds * 1000
+
+    # int64 min is reserved for NaT by numpy datetime64
+    return max(min(epoch_ns, np.iinfo(np.int64).max), np.iinfo(np.int64).min + 1)
+
+
+def from_epoch_ns(epoch_ns: int) -> datetime.datetime:
+    """
+    Convert nanoseconds since epoch to a (naive) datetime
+
+    :param epoch_ns: Nanoseconds since epoch
+    :return: time_captured
+    """
+    return EPOCH + datetime.timedelta(microseconds=int(epoch_ns) // 1000)
+
+
+def series_directory(device_id, tier='raw') -> str:
+    """
+    Directory holding a devices segment files for a tier
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: path
+    """
+    return os.path.join(DATA_DIRECTORY, str(device_id), tier)
+
+
+def segment_paths(device_id, tier='raw') -> list:
+    """
+    Segment files of a device tier, oldest first
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: paths
+    """
+    directory = series_directory(device_id, tier)
+    if not os.path.isdir(directory):
+        return []
+
+    return [os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith(SEGMENT_SUFFIX)]
+
+
+def segment_path(device_id, number, tier='raw') -> str:
+    """
+    Path of a numbered segment file
+
+    :param device_id: Device ID
+    :param number: Segment number
+    :param tier: Storage tier
+    :return: path
+    """
+    return os.path.join(series_directory(device_id, tier), f'{number:08d}{SEGMENT_SUFFIX}')
+
+
+def segment_number(path) -> int:
+    """
+    Number of a segment file, numbers keep increasing when old segments are removed by compaction
+
+    :param path: Segment path
+    :return: number
+    """
+    return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+
+
+def retained_from(device_id, tier='raw'):
+    """
+    Start of the data kept for a device tier, older data has been removed by compaction
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: retained_from: Nanoseconds since epoch, None if nothing has been removed
+    """
+    try:
+        with open(os.path.join(series_directory(device_id, tier), RETENTION_FILE), 'r') as retention_file:
+            return int(retention_file.read())
+    except FileNotFoundError:
+        return None
+
+
+def set_retained_from(device_id, tier, epoch_ns):
+    """
+    Record the start of the data kept for a device tier
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :param epoch_ns: Nanoseconds since epoch
+    """
+    path = os.path.join(series_directory(device_id, tier), RETENTION_FILE)
+    with open(f'{path}.tmp', 'w') as retention_file:
+        retention_file.write(str(epoch_ns))
+        retention_file.flush()
+        os.fsync(retention_file.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def rewrite_segment(path, records):
+    """
+    Atomically replace the records of a segment file
+    Readers holding the old file (e.g. memory maps) keep seeing the old records
+
+    :param path: Segment path
+    :param records: Records to keep
+    """
+    with open(f'{path}.tmp', 'wb') as segment_file:
+        segment_file.write(records.tobytes())
+        segment_file.flush()
+        os.fsync(segment_file.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def create_series(device_id):
+    """
+    Create storage for a new device
+
+    :param device_id: Device ID
+    """
+    os.makedirs(series_directory(device_id), exist_ok=True)
+
+
+def delete_series(device_id):
+    """
+    Remove all stored data of a device
+
+    :param device_id: Device ID
+    """
+    segment_writer.close(device_id)
+    shutil.rmtree(os.path.join(DATA_DIRECTORY, str(device_id)), ignore_errors=True)
+
+
+def delete_tier(device_id, tier):
+    """
+    Remove all stored data of a single device tier
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    """
+    segment_writer.close(device_id)
+    shutil.rmtree(series_directory(device_id, tier), ignore_errors=True)
+
+
+def list_series() -> list:
+    """
+    IDs of all devices with stored data
+
+    :return: device_ids
+    """
+    if not os.path.isdir(DATA_DIRECTORY):
+        return []
+
+    return [name for name in sorted(os.listdir(DATA_DIRECTORY))
+            if os.path.isdir(os.path.join(DATA_DIRECTORY, name))]
+
+
+def make_records(timestamps, powers, intervals) -> np.ndarray:
+    """
+    Build capture records from columns
+
+    :param timestamps: Nanoseconds since epoch
+    :param powers: Power in Watts, None/NaN if unknown
+    :param intervals: Interval in seconds
+    :return: records
+    """
+    records = np.empty(len(timestamps), dtype=RECORD_DTYPE)
+    records['timestamp'] = timestamps
+    records['power'] = [np.nan if power is None else power for power in powers]
+    records['interval'] = intervals
+    return records
+
+
+def append_records(device_id, records, tier='raw'):
+    """
+    Append records to the last segment of a device tier
+    A new segment is started once a segment holds segment_records records
+
+    :param device_id: Device ID
+    :param records: Records with the tiers dtype
+    :param tier: Storage tier
+    """
+    dtype = TIER_DTYPES[tier]
+    records = np.asarray(records, dtype=dtype)
+    max_records = bia_config.get('segment_records', 1048576)
+
+    os.makedirs(series_directory(device_id, tier), exist_ok=True)
+    paths = segment_paths(device_id, tier)
+    number = segment_number(paths[-1]) if paths else 0
+
+    while len(records):
+        path = segment_path(device_id, number, tier)
+        stored_records = 0
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % dtype.itemsize:
+                # Drop partial record left by an interrupted write
+                os.truncate(path, size - size % dtype.itemsize)
+            stored_records = size // dtype.itemsize
+
+        free_records = max_records - stored_records
+        if free_records <= 0:
+            number += 1
+            continue
+
+        with open(path, 'ab') as segment_file:
+            segment_file.write(records[:free_records].tobytes())
+
+        records = records[free_records:]
+
+
+class _OpenSegment:
+    """
+    Segment file held open for appending by SegmentWriter
+
+    number: Segment number
+    file: File opened for buffered appending
+    stored_records: Records in segment, including buffered ones
+    """
+    def __init__(self, number, file, stored_records):
+        self.number = number
+        self.file = file
+        self.stored_records = stored_records
+
+
+class SegmentWriter:
+    """
+    Appends records through segment files kept open between writes
+    Records are buffered and only become visible to readers once flushed, how often is set by durability:
+        snapshot: Flush after every committed batch (e.g. capture snapshot)
+        interval: Flush once flush_interval seconds have passed since the last flush
+        fsync: Flush and fsync after every committed batch, survives power loss
+
+    durability: "snapshot", "interval" or "fsync"
+    flush_interval: Seconds between flushes for the interval policy
+    max_open: Maximum segment files held open, least recently used are closed first
+    """
+    def __init__(self, durability, flush_interval, max_open):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy {durability}")
+
+        self._lock = Lock()
+        self._series_locks = {}  # device ID -> Lock, held by appends and while segments are rewritten
+        self._segments = OrderedDict()  # (device ID, tier) -> _OpenSegment
+        self._last_flush = time.monotonic()
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.max_open = max_open
+
+    def append(self, device_id, records, tier='raw'):
+        """
+        Append records to the last segment of a device tier, starting a new segment once
+        a segment holds segment_records records
+
+        :param device_id: Device ID
+        :param records: Records with the tiers dtype
+        :param tier: Storage tier
+        """
+        records = np.asarray(records, dtype=TIER_DTYPES[tier])
+        max_records = bia_config.get('segment_records', 1048576)
+        key = (str(device_id), tier)
+
+        with self._series_lock(device_id), self._lock:
+            while len(records):
+                segment = self._open(key)
+
+                free_records = max_records - segment.stored_records
+                if free_records <= 0:
+                    self._close(key)
+                    self._open(key, segment.number + 1)
+                    continue
+
+                segment.file.write(records[:free_records].tobytes())
+                segment.stored_records += len(records[:free_records])
+                records = records[free_records:]
+
+    @contextmanager
+    def exclusive(self, device_id):
+        """
+        Hold off appends to a device while its segments are rewritten, other devices keep appending
+        Open segments of the device are closed first, they are reopened on the next append
+
+        :param device_id: Device ID
+        """
+        with self._series_lock(device_id):
+            with self._lock:
+                for key in [key for key in self._segments if key[0] == str(device_id)]:
+                    self._close(key)
+
+            yield
+
+    def commit(self):
+        """
+        End of a batch of appends, flushes according to the durability policy
+        """
+        if self.durability == 'fsync':
+            self.flush(fsync=True)
+        elif self.durability == 'snapshot':
+            self.flush()
+        elif time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, fsync=False):
+        """
+        Write buffered records of all open segments
+
+        :param fsync: Also wait for the operating system to write them to disk
+        """
+        with self._lock:
+            for segment in self._segments.values():
+                segment.file.flush()
+                if fsync:
+                    os.fsync(segment.file.fileno())
+
+            self._last_flush = time.monotonic()
+
+    def close(self, device_id):
+        """
+        Flush and close all open segments of a device, e.g. before its files are removed or rewritten
+
+        :param device_id: Device ID
+        """
+        with self._lock:
+            for key in [key for key in self._segments if key[0] == str(device_id)]:
+                self._close(key)
+
+    def close_all(self):
+        """
+        Flush and close all open segments
+        """
+        with self._lock:
+            for key in list(self._segments):
+                self._close(key)
+
+    def _series_lock(self, device_id) -> Lock:
+        """
+        Lock serialising appends to a device with rewrites of its segments
+        Always taken before the writer wide lock
+
+        :param device_id: Device ID
+        :return: lock
+        """
+        with self._lock:
+            return self._series_locks.setdefault(str(device_id), Lock())
+
+    def _open(self, key, number=None) -> _OpenSegment:
+        """
+        Open segment of a device tier, opening the last segment if none is open
+        Must be called with the lock held
+
+        :param key: (device ID, tier)
+        :param number: Segment number to open, defaults to the last segment
+        :return: segment
+        """
+        segment = self._segments.get(key)
+        if segment is not None and (number is None or segment.number == number):
+            self._segments.move_to_end(key)
+            return segment
+
+        device_id, tier = key
+        dtype = TIER_DTYPES[tier]
+        if number is None:
+            paths = segment_paths(device_id, tier)
+            number = segment_number(paths[-1]) if paths else 0
+
+        os.makedirs(series_directory(device_id, tier), exist_ok=True)
+        path = segment_path(device_id, number, tier)
+
+        stored_records = 0
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+            if size % dtype.itemsize:
+                # Drop partial record left by an interrupted write
+                os.truncate(path, size - size % dtype.itemsize)
+            stored_records = size // dtype.itemsize
+
+        segment = _OpenSegment(number, open(path, 'ab'), stored_records)
+        self._segments[key] = segment
+
+        while len(self._segments) > self.max_open:
+            self._close(next(iter(self._segments)))
+
+        return segment
+
+    def _close(self, key):
+        """
+        Flush and close an open segment, must be called with the lock held
+
+        :param key: (device ID, tier)
+        """
+        segment = self._segments.pop(key)
+        if self.durability == 'fsync':
+            segment.file.flush()
+            os.fsync(segment.file.fileno())
+        segment.file.close()
+
+
+def append(device_id, time_captured, power, interval):
+    """
+    Append a single capture record
+
+    :param device_id: Device ID
+    :param time_captured: Datetime of capture
+    :param power: Consumption of device in Watts
+    :param interval: Capture interval in seconds
+    """
+    append_records(device_id, make_records([to_epoch_ns(time_captured)], [power], [interval]))
+
+
+def data_version(device_id, tier='raw') -> tuple:
+    """
+    Cheap identifier of a device tiers stored data, changes whenever records are appended
+    or segments rewritten
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: version
+    """
+    paths = segment_paths(device_id, tier)
+    if len(paths) == 0:
+        return '', 0, 0, 0, 0
+
+    # Compaction removes or rewrites the oldest segments
+    first_segment = os.stat(paths[0])
+    last_segment = os.stat(paths[-1])
+    return paths[0], first_segment.st_ino, len(paths), last_segment.st_size, last_segment.st_mtime_ns
+
+
+def segment_states(device_id, tier='raw') -> list:
+    """
+    State of each segment file of a device tier, oldest first
+    A rewritten segment gets a new inode, an appended one a larger size
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: states: List of (path, inode, size in bytes)
+    """
+    states = []
+    for path in segment_paths(device_id, tier):
+        segment = os.stat(path)
+        states.append((path, segment.st_ino, segment.st_size))
+
+    return states
+
+
+def read_segment(path, start_record=0, stop_record=None, tier='raw') -> np.ndarray:
+    """
+    Read a range of records from a segment file into memory
+
+    :param path: Segment path
+    :param start_record: First record to read
+    :param stop_record: Record to stop before, defaults to end of file
+    :param tier: Storage tier
+    :return: records
+    """
+    dtype = TIER_DTYPES[tier]
+    if stop_record is None:
+        stop_record = os.path.getsize(path) // dtype.itemsize
+
+    return np.fromfile(path, dtype=dtype, count=max(stop_record - start_record, 0),
+                       offset=start_record * dtype.itemsize)
+
+
+def load(device_id, tier='raw') -> np.ndarray:
+    """
+    Load all records of a device tier
+    Segments are memory mapped, a single segment is returned without copying
+
+    :param device_id: Device ID
+    :param tier: Storage tier
+    :return: records
+    """
+    dtype = TIER_DTYPES[tier]
+
+    segments = []
+    for path in segment_paths(device_id, tier):
+        stored_records = os.path.getsize(path) // dtype.itemsize
+        if stored_records:
+            segments.append(np.memmap(path, dtype=dtype, mode='r', shape=(stored_records,)))
+
+    if len(segments) == 0:
+        return np.zeros(0, dtype=dtype)
+    elif len(segments) == 1:
+        return segments[0]
+    else:
+        return np.concatenate(segments)
+
+
+def migrate_csv(device_id, delete_csv=False) -> int:
+    """
+    Convert a devices legacy data/<uuid>.csv history to segment files
+    Devices which already have stored records are skipped
+
+    :param device_id: Device ID
+    :param delete_csv: Remove CSV once converted, otherwise it is renamed to .csv.migrated
+    :return: migrated: Number of records migrated
+    """
+    csv_path = os.path.join(DATA_DIRECTORY, f'{device_id}.csv')
+    if len(load(device_id)):
+        return 0
+
+    timestamps = []
+    powers = []
+    intervals = []
+    with open(csv_path, 'r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            timestamps.append(to_epoch_ns(ciso8601.parse_datetime(row['timestamp'])))
+            powers.append(float(row['power']) if row['power'] not in ('', 'None') else None)
+            intervals.append(float(row['interval']))
+
+    create_series(device_id)
+    append_records(device_id, make_records(timestamps, powers, intervals))
+
+    if delete_csv:
+        os.remove(csv_path)
+    else:
+        os.rename(csv_path, f'{csv_path}.migrated')
+
+    return len(timestamps)
+
+
+def migrate_all(delete_csv=False):
+    """
+    Convert every legacy CSV in the data folder
+
+    :param delete_csv: Remove CSVs once converted
+    :return: migrated: Dictionary of device ID to number of records migrated
+    """
+    migrated = {}
+    for name in sorted(os.listdir(DATA_DIRECTORY)):
+        if name.endswith('.csv'):
+            device_id = name[:-len('.csv')]
+            migrated[device_id] = migrate_csv(device_id, delete_csv)
+
+    return migrated
+
+
+segment_writer = SegmentWriter(durability=bia_config.get('capture_durability', 'snapshot'),
+                               flush_interval=bia_config.get('capture_flush_interval', 5),
+                               max_open=bia_config.get('max_open_segments', 256))
+atexit.register(segment_writer.close_all)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="NetworkBia storage tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help="Convert legacy data/<uuid>.csv files")
+    migrate_parser.add_argument('--delete-csv', action='store_true', help="Remove CSVs once converted")
+
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        for migrated_device, migrated_records in migrate_all(args.delete_csv).items():
+            print(f"{migrated_device}: {migrated_records} records")
@@ -0,0 +1,60 @@
+from aggregate import fleet_statistics
+from rollups import rebuild
+import storage
+
+import numpy as np
+import pytest
+
+import datetime
+
+START = datetime.datetime(2024, 1, 1)
+START_NS = storage.to_epoch_ns(START)
+
+
+def capture(device_id, seconds, power, intervals):
+    """
+    Store data points of a device and build its rollups
+
+    :param device_id: Device ID
+    :param seconds: Capture times, seconds after START
+    :param power: Power of each data point
+    :param intervals: Interval of each data point
+    """
+    timestamps = START_NS + np.asarray(seconds, dtype='int64') * 1_000_000_000
+    storage.append_records(device_id, storage.make_records(timestamps, power, intervals))
+    rebuild(device_id)
+
+
+@pytest.mark.parametrize('hours', [1, 24])
+def test_mixed_poll_intervals(hours):
+    span = hours * 3600
+    fast = np.arange(0, span + 1, 10)
+    slow = np.arange(0, span + 1, 300)
+    capture('fast', fast, np.full(len(fast), 100.0), np.full(len(fast), 10))
+    capture('slow', slow, np.full(len(slow), 50.0), np.full(len(slow), 300))
+
+    statistics = fleet_statistics(['fast', 'slow'], START, START + datetime.timedelta(seconds=span))
+
+    assert not np.any(np.isnan(statistics['device_power']['slow']))
+    assert statistics['mean'] == pytest.approx(150)
+    assert statistics['energy'] == pytest.approx(0.15 * hours)
+
+
+def test_deadband_stretch_is_carried():
+    # Flat stretch closed by a data point whose interval spans it, as written by DeadbandFilter
+    capture('plug', [0, 10, 910, 1810, 1820], [20.0, 80.0, 80.0, 80.0, 20.0], [10, 10, 900, 900, 10])
+    capture('router', np.arange(0, 1821, 10), np.full(183, 100.0), np.full(183, 10))
+
+    statistics = fleet_statistics(['plug', 'router'], START, START + datetime.timedelta(seconds=1820))
+
+    assert not np.any(np.isnan(statistics['device_power']['plug']))
+    assert statistics['mean'] == pytest.approx(180, abs=1)
+
+
+def test_gap_is_not_carried():
+    # Capture stopped for an hour, longer than max_gap_intervals of the next interval
+    capture('plug', [0, 10, 3610, 3620], [50.0] * 4, [10] * 4)
+
+    statistics = fleet_statistics(['plug'], START, START + datetime.timedelta(seconds=3620))
+
+    assert np.mean(np.isnan(statistics['power'])) > 0.9
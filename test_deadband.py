@@ -0,0 +1,71 @@
+from deadband import DeadbandFilter
+from history import integrate
+import storage
+
+import numpy as np
+import pytest
+
+SECOND = 1_000_000_000
+
+
+def run(deadband_filter, power, interval=10, device_id='plug'):
+    """
+    Filter samples captured every interval seconds
+
+    :return: written: Records written
+    """
+    samples = []
+    for number, value in enumerate(power):
+        samples.extend(deadband_filter.filter(device_id, number * interval * SECOND, value, interval))
+
+    return samples
+
+
+def test_flat_stretch_is_closed_by_one_sample():
+    deadband_filter = DeadbandFilter(absolute=1, percent=0, heartbeat=3600, max_gap_intervals=2.5)
+
+    written = run(deadband_filter, [50.0, 50.5, 49.5, 50.0, 80.0])
+
+    assert written == [(0, 50.0, 10), (30 * SECOND, 50.0, 30.0), (40 * SECOND, 80.0, 10)]
+
+
+def test_energy_is_unchanged():
+    deadband_filter = DeadbandFilter(absolute=0, percent=0, heartbeat=3600, max_gap_intervals=2.5)
+    power = np.repeat(np.random.default_rng(0).uniform(0, 100, 50).round(), 20)
+
+    written = run(deadband_filter, power.tolist()) + list(deadband_filter.flush().values())
+    everything = storage.make_records(np.arange(len(power)) * 10 * SECOND, power, np.full(len(power), 10))
+    filtered = storage.make_records(*zip(*written))
+
+    assert len(filtered) < len(everything) / 5
+    assert np.sum(integrate(filtered)) == pytest.approx(np.sum(integrate(everything)))
+
+
+def test_heartbeat_writes_flat_power():
+    deadband_filter = DeadbandFilter(absolute=1, percent=0, heartbeat=60, max_gap_intervals=2.5)
+
+    written = run(deadband_filter, [50.0] * 14)
+
+    assert [sample[0] // SECOND for sample in written] == [0, 60, 120]
+    assert [sample[2] for sample in written] == [10, 60.0, 60.0]
+
+
+def test_gap_and_unknown_power_end_a_stretch():
+    deadband_filter = DeadbandFilter(absolute=1, percent=0, heartbeat=3600, max_gap_intervals=2.5)
+
+    written = deadband_filter.filter('plug', 0, 50.0, 10)
+    written += deadband_filter.filter('plug', 10 * SECOND, 50.0, 10)
+    written += deadband_filter.filter('plug', 600 * SECOND, 50.0, 10)  # Capture stopped in between
+    written += deadband_filter.filter('plug', 610 * SECOND, None, 10)
+
+    assert written == [(0, 50.0, 10), (10 * SECOND, 50.0, 10.0), (600 * SECOND, 50.0, 10),
+                       (610 * SECOND, None, 10)]
+
+
+def test_flush_releases_held_samples():
+    deadband_filter = DeadbandFilter(absolute=1, percent=0, heartbeat=3600, max_gap_intervals=2.5)
+    run(deadband_filter, [50.0, 50.0, 50.0], device_id='plug')
+    run(deadband_filter, [20.0], device_id='router')
+
+    assert deadband_filter.flush() == {'plug': (20 * SECOND, 50.0, 20.0)}
+    assert deadband_filter.flush() == {}
@@ -0,0 +1,90 @@
+from devices import CiscoDevice
+from devices import DeviceRegistry
+from devices import SmartPlugDevice
+import devices
+
+import pytest
+
+import json
+import os
+
+
+@pytest.fixture
+def inventory(tmp_path):
+    return str(tmp_path / 'devices.json')
+
+
+def write_inventory(path, details):
+    with open(path, 'w') as device_file:
+        json.dump(details, device_file)
+
+
+def test_saved_devices_are_read_back(inventory):
+    registry = DeviceRegistry(inventory, check_interval=0)
+    registry.save(SmartPlugDevice('Plug', '10.0.0.2', 'plug'))
+    registry.save(CiscoDevice('Switch', '10.0.0.3', 'switch', 'admin', 'secret'))
+
+    reloaded = DeviceRegistry(inventory, check_interval=0)
+
+    assert [device.uuid for device in reloaded.all()] == ['plug', 'switch']
+    assert reloaded.get('switch').inventory_details()['username'] == 'admin'
+    assert os.listdir(os.path.dirname(inventory)) == ['devices.json']
+
+
+def test_unchanged_devices_are_kept_on_reload(inventory):
+    registry = DeviceRegistry(inventory, check_interval=0)
+    registry.save(SmartPlugDevice('Plug', '10.0.0.2', 'plug'))
+    registry.save(SmartPlugDevice('Lamp', '10.0.0.4', 'lamp'))
+    plug = registry.get('plug')
+    lamp = registry.get('lamp')
+
+    with open(inventory) as device_file:
+        details = json.load(device_file)
+    details['lamp']['name'] = 'Desk lamp'
+    write_inventory(inventory, details)
+
+    assert registry.get('plug') is plug
+    assert registry.get('lamp') is not lamp
+    assert registry.get('lamp').inventory_details()['name'] == 'Desk lamp'
+
+
+def test_changes_are_checked_every_check_interval(inventory):
+    registry = DeviceRegistry(inventory, check_interval=3600)
+    registry.save(SmartPlugDevice('Plug', '10.0.0.2', 'plug'))
+    registry.all()
+
+    write_inventory(inventory, {})
+    assert len(registry.all()) == 1
+
+    registry._checked -= 3600
+    assert registry.all() == []
+
+
+def test_delete_writes_inventory(inventory):
+    registry = DeviceRegistry(inventory, check_interval=0)
+    registry.save(SmartPlugDevice('Plug', '10.0.0.2', 'plug'))
+
+    registry.delete('plug')
+
+    with pytest.raises(KeyError):
+        registry.get('plug')
+    with open(inventory) as device_file:
+        assert json.load(device_file) == {}
+
+
+def test_failed_write_keeps_inventory(inventory, monkeypatch):
+    registry = DeviceRegistry(inventory, check_interval=0)
+    registry.save(SmartPlugDevice('Plug', '10.0.0.2', 'plug'))
+    with open(inventory, 'rb') as device_file:
+        content = device_file.read()
+
+    def fail(*args):
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(devices.os, 'fsync', fail)
+    with pytest.raises(OSError):
+        registry.save(SmartPlugDevice('Lamp', '10.0.0.4', 'lamp'))
+
+    with open(inventory, 'rb') as device_file:
+        assert device_file.read() == content
+    assert os.listdir(os.path.dirname(inventory)) == ['devices.json']
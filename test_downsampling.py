@@ -0,0 +1,70 @@
+from downsampling import downsample
+from downsampling import lttb
+from downsampling import min_max
+
+import numpy as np
+import pytest
+
+TIMESTAMPS = np.datetime64('2024-01-01', 'ns') + np.arange(10_000) * np.timedelta64(10, 's')
+
+
+def signal(seed=0):
+    power = np.random.default_rng(seed).normal(100, 5, len(TIMESTAMPS))
+    power[4321] = 2000.0  # Spike
+    return power
+
+
+@pytest.mark.parametrize('method', ['lttb', 'minmax'])
+def test_budget_and_order(method):
+    timestamps, power = downsample(TIMESTAMPS, signal(), 500, method)
+
+    assert len(timestamps) == len(power) == 500
+    assert np.all(np.diff(timestamps.astype('int64')) > 0)
+    assert np.isin(timestamps, TIMESTAMPS).all()
+
+
+@pytest.mark.parametrize('function', [lttb, min_max])
+def test_spike_is_kept(function):
+    timestamps, power = function(TIMESTAMPS, signal(), 200)
+
+    assert power.max() == 2000.0
+    assert timestamps[np.argmax(power)] == TIMESTAMPS[4321]
+
+
+def test_lttb_keeps_end_points():
+    timestamps, power = lttb(TIMESTAMPS, signal(), 100)
+
+    assert timestamps[0] == TIMESTAMPS[0]
+    assert timestamps[-1] == TIMESTAMPS[-1]
+
+
+def test_min_max_keeps_bucket_extremes():
+    power = signal()
+
+    _, kept = min_max(TIMESTAMPS, power, 100)
+
+    buckets = power.reshape(50, -1)
+    assert kept.reshape(50, 2).min(axis=1).tolist() == buckets.min(axis=1).tolist()
+    assert kept.reshape(50, 2).max(axis=1).tolist() == buckets.max(axis=1).tolist()
+
+
+@pytest.mark.parametrize('method', ['lttb', 'minmax'])
+def test_short_series_is_unchanged(method):
+    timestamps, power = downsample(TIMESTAMPS[:50], signal()[:50], 500, method)
+
+    assert len(timestamps) == 50
+
+
+def test_unknown_power_is_dropped():
+    power = signal()
+    power[::2] = np.nan
+
+    timestamps, kept = downsample(TIMESTAMPS, power, 10_000)
+
+    assert len(kept) == 5000
+    assert not np.any(np.isnan(kept))
+
+
+def test_unknown_method_is_refused():
+    with pytest.raises(ValueError):
+        downsample(TIMESTAMPS, signal(), 100, 'average')
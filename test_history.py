@@ -0,0 +1,133 @@
+from export import decode_cursor
+from export import encode_cursor
+from history import DeviceHistory
+from history import HistoryCache
+from history import page_data_points
+from rollups import rebuild
+import storage
+
+import numpy as np
+import pytest
+
+import datetime
+import os
+import threading
+import time
+
+START = datetime.datetime(2024, 1, 1)
+START_NS = storage.to_epoch_ns(START)
+
+
+def test_statistics_weighted_by_interval():
+    # Power changing every 10 seconds, then a 900 second deadband stretch at 80 Watts
+    seconds = np.array([0, 10, 20, 30, 40, 50, 60, 960])
+    power = [20.0, 25.0, 30.0, 35.0, 40.0, 45.0, 80.0, 80.0]
+    intervals = [10, 10, 10, 10, 10, 10, 10, 900]
+    storage.append_records('plug', storage.make_records(START_NS + seconds * 1_000_000_000, power, intervals))
+    rebuild('plug')
+
+    device_history = DeviceHistory('plug')
+    statistics = device_history.statistics()
+
+    assert statistics['mean'] == pytest.approx((10 * (20 + 25 + 30 + 35 + 40 + 45 + 80) + 900 * 80) / 970)
+    assert statistics['median'] == 80
+    assert statistics['mode'] == 80
+    assert statistics['length'] == 8
+
+    # Rollups give the same weighted mean
+    end_time = START + datetime.timedelta(days=1)
+    assert device_history.statistics(end_time=end_time, names=('mean',))['mean'] == pytest.approx(statistics['mean'])
+
+
+def test_equal_intervals_match_numpy():
+    power = np.random.default_rng(0).uniform(0, 100, 1000)
+    timestamps = START_NS + np.arange(1000) * 10_000_000_000
+    storage.append_records('router', storage.make_records(timestamps, power, np.full(1000, 10)))
+
+    statistics = DeviceHistory('router').statistics()
+
+    assert statistics['mean'] == pytest.approx(np.mean(power))
+    assert statistics['stddev'] == pytest.approx(np.std(power))
+    assert statistics['median'] == pytest.approx(np.median(power))
+    assert list(statistics['percentiles'].values()) == pytest.approx(np.percentile(power, [5, 25, 75, 95]))
+
+
+@pytest.mark.parametrize('names', [('energy', 'mean', 'length'), ('energy', 'mean', 'median', 'length')])
+@pytest.mark.parametrize('start, end', [(310, 610), (0, 460), (460, 915)])
+def test_deadband_stretch_clipped_to_window(names, start, end):
+    # Flat stretch at 80 Watts from 10 to 910 seconds, closed by a data point whose interval spans it
+    seconds = np.array([0, 10, 910, 920])
+    storage.append_records('plug', storage.make_records(START_NS + seconds * 1_000_000_000,
+                                                        [20.0, 80.0, 80.0, 20.0], [10, 10, 900, 10]))
+    rebuild('plug')
+
+    statistics = DeviceHistory('plug').statistics(START + datetime.timedelta(seconds=start),
+                                                  START + datetime.timedelta(seconds=end), names=names)
+
+    # Trapezoids between data points, clipped to the window
+    fine = np.arange(start, end, 0.25) + 0.125
+    fine_power = np.interp(fine, seconds, [20.0, 80.0, 80.0, 20.0])
+    assert statistics['energy'] == pytest.approx(np.sum(fine_power) * 0.25 / 3600 / 1000)
+    assert statistics['length'] == int(np.sum((seconds >= start) & (seconds < end)))
+    if end <= 910:
+        assert statistics['mean'] == pytest.approx(80)
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 4, 7])
+def test_pages_keep_data_points_sharing_a_timestamp(limit):
+    seconds = np.array([0, 10, 10, 10, 20, 20, 30])
+    power = np.arange(len(seconds), dtype='f8')
+    storage.append_records('plug', storage.make_records(START_NS + seconds * 1_000_000_000, power, [10] * 7))
+
+    paged = []
+    cursor = None
+    while True:
+        page, cursor = page_data_points(['plug'], cursor, limit)
+        paged.extend(float(power) for _, records in page for power in records['power'])
+        if cursor is None:
+            break
+        cursor = decode_cursor(encode_cursor(cursor))
+
+    assert paged == power.tolist()
+
+
+def test_cache_reads_appended_data_points():
+    cache = HistoryCache(2 ** 30)
+    timestamps = START_NS + np.arange(10) * 10_000_000_000
+    storage.append_records('plug', storage.make_records(timestamps[:5], [1.0] * 5, [10] * 5))
+    first = cache.get('plug')
+
+    storage.append_records('plug', storage.make_records(timestamps[5:], [2.0] * 5, [10] * 5))
+    second = cache.get('plug')
+
+    assert len(first) == 5
+    assert second.history()['power'].tolist() == [1.0] * 5 + [2.0] * 5
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_slow_device_does_not_block_others(monkeypatch):
+    for device_id in ('slow', 'fast'):
+        storage.append_records(device_id, storage.make_records([START_NS], [1.0], [10]))
+
+    reading = threading.Event()
+    release = threading.Event()
+    read_segment = storage.read_segment
+
+    def slow_read_segment(path, *args, **kwargs):
+        if f'{os.sep}slow{os.sep}' in path:
+            reading.set()
+            release.wait(5)
+        return read_segment(path, *args, **kwargs)
+
+    monkeypatch.setattr(storage, 'read_segment', slow_read_segment)
+    cache = HistoryCache(2 ** 30)
+    slow = threading.Thread(target=cache.get, args=('slow',))
+    slow.start()
+    try:
+        assert reading.wait(5)
+        started = time.monotonic()
+        assert len(cache.get('fast')) == 1
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        slow.join()
@@ -0,0 +1,82 @@
+from history import DeviceHistory
+from retention import compact
+from retention import compact_tier
+from rollups import rollup_writer
+import storage
+
+import numpy as np
+import pytest
+
+import datetime
+import threading
+
+START_NS = storage.to_epoch_ns(datetime.datetime(2024, 1, 1))
+DAY_NS = 86400 * 1_000_000_000
+
+
+def records(timestamps):
+    return storage.make_records(timestamps, [10.0] * len(timestamps), [10] * len(timestamps))
+
+
+def test_compaction_keeps_last_record_before_cutoff():
+    timestamps = START_NS + np.arange(4) * DAY_NS
+    storage.append_records('plug', records(timestamps))
+
+    removed = compact_tier('plug', 'raw', START_NS + 2 * DAY_NS)
+
+    assert removed == 1
+    assert storage.load('plug')['timestamp'].tolist() == timestamps[1:].tolist()
+    assert storage.retained_from('plug', 'raw') == START_NS + 2 * DAY_NS
+
+
+def test_compaction_only_holds_off_its_own_device():
+    appended = {}
+
+    def append(device_id):
+        rollup_writer.append(device_id, records([START_NS]))
+        appended[device_id] = True
+
+    with storage.segment_writer.exclusive('plug'):
+        compacted = threading.Thread(target=append, args=('plug',))
+        other = threading.Thread(target=append, args=('router',))
+        compacted.start()
+        other.start()
+
+        other.join(5)
+        assert appended == {'router': True}
+
+    compacted.join(5)
+    assert appended == {'router': True, 'plug': True}
+
+
+def test_compaction_rolls_up_raw_data_first():
+    # Captured before rollups were kept, or migrated without a rebuild
+    timestamps = START_NS + np.arange(60 * 1440) * 60_000_000_000
+    storage.append_records('plug', storage.make_records(timestamps, [100.0] * len(timestamps),
+                                                        [60] * len(timestamps)))
+    energy = DeviceHistory('plug').sum_usage()
+
+    removed = compact('plug', now=datetime.datetime(2024, 3, 1))
+
+    assert removed['raw'] > 0
+    assert all(len(storage.load('plug', tier)) for tier in storage.TIER_WIDTHS)
+    assert DeviceHistory('plug').sum_usage() == pytest.approx(energy, abs=0.1 / 60)
+
+
+def test_statistics_agree_after_compaction():
+    timestamps = START_NS + np.arange(60 * 1440) * 60_000_000_000
+    power = np.random.default_rng(0).uniform(0, 100, len(timestamps))
+    storage.append_records('plug', storage.make_records(timestamps, power, [60] * len(timestamps)))
+    names = ('length', 'mean', 'min', 'max', 'energy')
+    before = DeviceHistory('plug').statistics(names=names)
+
+    compact('plug', now=datetime.datetime(2024, 3, 1))
+
+    device_history = DeviceHistory('plug')
+    combined = device_history.statistics(names=names)
+    everything = device_history.statistics()
+
+    assert combined == pytest.approx(before)
+    assert {name: everything[name] for name in names} == combined
+    assert everything['raw_from'] == storage.from_epoch_ns(device_history.retained_from('raw'))
+    assert everything['median'] is not None
@@ -0,0 +1,110 @@
+from capture import Periodic
+import metrics
+
+import pytest
+
+import threading
+import time
+
+INTERVAL = 0.05
+
+
+class Recorder:
+    """
+    Function for a scheduler to run, recording when each run starts and ends
+    """
+    def __init__(self, duration=0.0):
+        self._lock = threading.Lock()
+        self.duration = duration
+        self.running = 0
+        self.overlapped = False
+        self.starts = []
+        self.ends = []
+
+    def __call__(self):
+        with self._lock:
+            self.running += 1
+            self.overlapped |= self.running > 1
+            self.starts.append(time.time())
+        time.sleep(self.duration)
+        with self._lock:
+            self.running -= 1
+            self.ends.append(time.time())
+
+
+def boundary_offsets(times):
+    return [(moment + INTERVAL / 2) % INTERVAL - INTERVAL / 2 for moment in times]
+
+
+def run_for(scheduler, seconds):
+    scheduler.start()
+    try:
+        time.sleep(seconds)
+    finally:
+        scheduler.stop()
+
+
+def scheduler_samples(name):
+    return [line for line in metrics.registry.render().splitlines() if f'scheduler="{name}"' in line]
+
+
+def test_rebuilt_scheduler_metrics_are_not_duplicated():
+    Periodic(10, print, name='rebuilt')
+    rebuilt = Periodic(20, print, name='rebuilt')
+
+    samples = scheduler_samples('rebuilt')
+
+    assert len(samples) == 3
+    assert 'bia_scheduler_interval_seconds{scheduler="rebuilt"} 20' in samples
+    rebuilt.set_interval(30)
+    assert 'bia_scheduler_interval_seconds{scheduler="rebuilt"} 30' in scheduler_samples('rebuilt')
+
+
+def test_runs_on_interval_boundaries():
+    recorder = Recorder()
+
+    run_for(Periodic(INTERVAL, recorder, name='boundaries'), 0.5)
+
+    assert 5 <= len(recorder.starts) <= 11
+    assert max(abs(offset) for offset in boundary_offsets(recorder.starts)) < INTERVAL / 4
+
+
+@pytest.mark.parametrize('policy', ['skip', 'coalesce'])
+def test_overruns_never_overlap(policy):
+    recorder = Recorder(duration=2.5 * INTERVAL)
+    scheduler = Periodic(INTERVAL, recorder, policy=policy, name=f'overrun-{policy}')
+
+    run_for(scheduler, 0.6)
+    time.sleep(4 * INTERVAL)
+
+    assert not recorder.overlapped
+    assert scheduler.overruns > 0
+    gaps = [start - end for start, end in zip(recorder.starts[1:], recorder.ends)]
+    if policy == 'coalesce':
+        # Coalesced run starts as soon as the previous one finishes
+        assert min(gaps) < INTERVAL / 2
+    else:
+        # Skipped runs wait for the next boundary
+        assert min(gaps) > 0
+        assert max(abs(offset) for offset in boundary_offsets(recorder.starts)) < INTERVAL / 4
+
+
+def test_stop_ends_runs():
+    recorder = Recorder()
+    scheduler = Periodic(INTERVAL, recorder, name='stopped')
+
+    run_for(scheduler, 0.2)
+    runs = len(recorder.starts)
+    time.sleep(4 * INTERVAL)
+
+    assert runs > 0
+    assert len(recorder.starts) == runs
+    assert scheduler.stats()['next_run'] is None
+
+
+def test_invalid_settings_are_refused():
+    with pytest.raises(ValueError):
+        Periodic(INTERVAL, print, policy='queue')
+
+    with pytest.raises(ValueError):
+        Periodic(INTERVAL, print).set_interval(0)
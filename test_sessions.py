@@ -0,0 +1,93 @@
+from sessions import SessionPool
+
+import pytest
+
+
+class Connection:
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Connector:
+    def __init__(self):
+        self.connections = []
+
+    def __call__(self):
+        self.connections.append(Connection(len(self.connections)))
+        return self.connections[-1]
+
+
+def fail(error):
+    def operation(connection):
+        raise error
+
+    return operation
+
+
+def test_reused_session_is_retried_on_connection_error():
+    pool = SessionPool()
+    connect = Connector()
+    pool.run(('host',), connect, lambda connection: None)
+
+    calls = []
+
+    def operation(connection):
+        calls.append(connection.number)
+        if connection.number == 0:
+            raise EOFError("Session closed by device")
+        return 'ok'
+
+    assert pool.run(('host',), connect, operation) == 'ok'
+    assert calls == [0, 1]
+    assert connect.connections[0].closed
+    assert (pool.hits, pool.misses) == (0, 2)
+
+
+def test_other_errors_are_not_retried():
+    pool = SessionPool()
+    connect = Connector()
+    pool.run(('host',), connect, lambda connection: None)
+
+    with pytest.raises(ValueError):
+        pool.run(('host',), connect, fail(ValueError("Invalid input")))
+
+    # Session was fine, it is back in the pool and reused
+    assert len(connect.connections) == 1
+    assert not connect.connections[0].closed
+    assert pool.run(('host',), connect, lambda connection: connection.number) == 0
+    assert pool.hits == 2
+
+
+def test_new_session_is_not_retried():
+    pool = SessionPool(max_per_host=1, acquire_timeout=0)
+    connect = Connector()
+
+    with pytest.raises(OSError):
+        pool.run(('host',), connect, fail(OSError("Connection reset")))
+
+    assert len(connect.connections) == 1
+    assert connect.connections[0].closed
+    # Slot was released
+    assert pool.run(('host',), connect, lambda connection: connection.number) == 1
+
+
+def test_driver_connection_errors_are_retried():
+    class Disconnected(Exception):
+        pass
+
+    pool = SessionPool()
+    connect = Connector()
+    pool.run(('host',), connect, lambda connection: None)
+
+    def operation(connection):
+        if connection.number == 0:
+            raise Disconnected()
+        return connection.number
+
+    assert pool.run(('host',), connect, operation, connection_errors=(Disconnected,)) == 1
+    with pytest.raises(Disconnected):
+        pool.run(('host',), connect, fail(Disconnected()))
@@ -0,0 +1,98 @@
+from storage import SegmentWriter
+import storage
+
+import numpy as np
+import pytest
+
+
+def records(count, first=0):
+    timestamps = (first + np.arange(count)) * 10_000_000_000
+    return storage.make_records(timestamps, np.full(count, 50.0), np.full(count, 10))
+
+
+@pytest.fixture
+def writer_factory():
+    writers = []
+
+    def make(durability='snapshot', flush_interval=5, max_open=256):
+        writers.append(SegmentWriter(durability, flush_interval, max_open))
+        return writers[-1]
+
+    yield make
+    for writer in writers:
+        writer.close_all()
+
+
+def test_snapshot_flushes_on_commit(writer_factory):
+    writer = writer_factory('snapshot')
+
+    writer.append('plug', records(3))
+    assert len(storage.load('plug')) == 0
+
+    writer.commit()
+    assert len(storage.load('plug')) == 3
+
+
+def test_interval_flushes_once_interval_passed(writer_factory):
+    writer = writer_factory('interval', flush_interval=60)
+
+    writer.append('plug', records(3))
+    writer.commit()
+    assert len(storage.load('plug')) == 0
+
+    writer._last_flush -= 60
+    writer.commit()
+    assert len(storage.load('plug')) == 3
+
+
+def test_fsync_syncs_on_commit(writer_factory, monkeypatch):
+    synced = []
+    monkeypatch.setattr(storage.os, 'fsync', synced.append)
+    writer = writer_factory('fsync')
+
+    writer.append('plug', records(3))
+    writer.commit()
+
+    assert len(synced) == 1
+    assert len(storage.load('plug')) == 3
+
+
+def test_segments_roll_over(writer_factory, monkeypatch):
+    monkeypatch.setitem(storage.bia_config, 'segment_records', 4)
+    writer = writer_factory()
+
+    writer.append('plug', records(6))
+    writer.append('plug', records(5, first=6))
+    writer.close_all()
+
+    assert len(storage.segment_paths('plug')) == 3
+    assert storage.load('plug')['timestamp'].tolist() == records(11)['timestamp'].tolist()
+
+
+def test_partial_record_is_dropped_on_reopen(writer_factory):
+    writer = writer_factory()
+    writer.append('plug', records(2))
+    writer.close_all()
+    with open(storage.segment_paths('plug')[-1], 'ab') as segment_file:
+        segment_file.write(b'\0' * 5)  # Write interrupted part way through a record
+
+    writer.append('plug', records(1, first=2))
+    writer.close_all()
+
+    assert storage.load('plug')['timestamp'].tolist() == records(3)['timestamp'].tolist()
+
+
+def test_least_recently_used_segments_are_closed(writer_factory):
+    writer = writer_factory(max_open=2)
+
+    for device_id in ('first', 'second', 'third'):
+        writer.append(device_id, records(1))
+
+    # Closing flushes, so the least recently used device is readable without a commit
+    assert [len(storage.load(device_id)) for device_id in ('first', 'second', 'third')] == [1, 0, 0]
+    assert len(writer._segments) == 2
+
+
+def test_unknown_durability_is_refused():
+    with pytest.raises(ValueError):
+        SegmentWriter('sometimes', 5, 256)